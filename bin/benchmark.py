@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+# Benchmark for loadbalancer.py and http.py
+#
+# Everything runs on this machine: echo backends, fake SOCKS5 servers
+# (standing in for the ssh -D tunnels) and a fake HTTP proxy (standing in
+# for the upstream proxy) are started locally, the load balancer is started
+# through its real config parsing and listeners, the injector through its
+# real Server. Results are printed as JSON, to compare runs across commits:
+#
+#   python3 bin/benchmark.py -o before.json
+#   python3 bin/benchmark.py -o after.json
+
+import argparse
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
+import platform
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+BIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ('lb', 'lb-socks', 'http')
+
+SOCKS5_GREETING = b'\x05\x01\x00'
+SOCKS5_REQUEST = b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 22)
+HTTP_CONNECT = b'CONNECT 127.0.0.1:22 HTTP/1.1\r\n\r\n'
+PAYLOAD = 'CONNECT [host_port] [protocol][crlf]Host: [host][crlf][crlf]'
+
+CHUNK = 65536
+
+# the modules are loaded from their files, http.py would shadow the
+# standard library's http package as a regular import
+def load_module(name, filename):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(BIN_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# stand-ins
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+def recv_head(sock):
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+
+def echo(sock, data=b''):
+    buf = bytearray(CHUNK)
+    view = memoryview(buf)
+    if data:
+        sock.sendall(data)
+    while True:
+        received = sock.recv_into(buf)
+        if not received:
+            break
+        sock.sendall(view[:received])
+
+
+# echo backend
+def handle_echo(sock):
+    echo(sock)
+
+
+# ssh -D: SOCKS5 no-auth CONNECT, then the tunnel's far end echoes
+def handle_socks(sock):
+    greeting = recv_exact(sock, 2)
+    recv_exact(sock, greeting[1])
+    sock.sendall(b'\x05\x00')
+    request = recv_exact(sock, 4)
+    if request[3] == 1:
+        recv_exact(sock, 4 + 2)
+    elif request[3] == 3:
+        recv_exact(sock, recv_exact(sock, 1)[0] + 2)
+    else:
+        recv_exact(sock, 16 + 2)
+    sock.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') +
+                 struct.pack('>H', 22))
+    echo(sock)
+
+
+# upstream proxy: answers every request head, the tunnel then echoes
+def handle_proxy(sock):
+    data = recv_head(sock)
+    head, _sep, rest = data.partition(b'\r\n\r\n')
+    sock.sendall(b'HTTP/1.1 200 OK\r\n\r\n')
+    echo(sock, rest)
+
+
+def serve(port, handler):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1024)
+
+    def run(sock):
+        try:
+            handler(sock)
+        except Exception:
+            pass
+        finally:
+            sock.close()
+
+    while True:
+        sock, _addr = server.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=run, args=(sock,), daemon=True).start()
+
+
+def run_standins(servers):
+    silence()
+    for port, handler in servers:
+        threading.Thread(target=serve, args=(port, handler),
+                         daemon=True).start()
+    threading.Event().wait()
+
+
+# systems under test
+
+def silence():
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.close(devnull)
+
+
+def run_balancer(config_file):
+    silence()
+    pumpkinlb = load_module('pumpkinlb', 'loadbalancer.py')
+    config = pumpkinlb.PumpkinConfig(config_file)
+    config.parse()
+    options = config.getOptions()
+    listeners = []
+    for mapping in config.getMappings().values():
+        for listener_num in range(options['listener_processes']):
+            listener = pumpkinlb.PumpkinListener(
+                mapping.localAddr, mapping.localPort, mapping.workers,
+                options['buffer_size'], options, listener_num)
+            listener.start()
+            listeners.append(listener)
+
+    def stop(*args):
+        for listener in listeners:
+            listener.terminate()
+        for listener in listeners:
+            listener.join(5)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        time.sleep(1)
+
+
+def run_injector(config, port):
+    silence()
+    injector = load_module('injector', 'http.py')
+    injector.Server(config, port).main_loop()
+
+
+# process accounting, over the process and all its descendants
+
+def process_tree(pid):
+    pids = [pid]
+    for pid in pids:
+        try:
+            for task in os.listdir('/proc/%d/task' % pid):
+                with open('/proc/%d/task/%s/children' % (pid, task)) as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def cpu_seconds(pid):
+    ticks = 0
+    for tree_pid in process_tree(pid):
+        try:
+            with open('/proc/%d/stat' % tree_pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime stime cutime cstime, cutime/cstime hold the reaped children
+        ticks += sum(int(field) for field in fields[11:15])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+# proportional set size, so pages shared between forked processes are not
+# counted once per process
+def memory_bytes(pid):
+    total = 0
+    for tree_pid in process_tree(pid):
+        for filename, key in (('smaps_rollup', 'Pss:'), ('status', 'VmRSS:')):
+            try:
+                with open('/proc/%d/%s' % (tree_pid, filename)) as f:
+                    for line in f:
+                        if line.startswith(key):
+                            total += int(line.split()[1]) * 1024
+                            break
+                break
+            except OSError:
+                continue
+    return total
+
+
+# clients
+
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def open_tunnel(port, handshake):
+    sock = socket.create_connection(('127.0.0.1', port), 10)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if handshake == 'socks':
+        sock.sendall(SOCKS5_GREETING)
+        if recv_exact(sock, 2) != b'\x05\x00':
+            raise ConnectionError('SOCKS5 greeting refused')
+        sock.sendall(SOCKS5_REQUEST)
+        if recv_exact(sock, 10)[1] != 0:
+            raise ConnectionError('SOCKS5 request refused')
+    elif handshake == 'http':
+        sock.sendall(HTTP_CONNECT)
+        if not recv_head(sock).startswith(b'HTTP/1.1 200'):
+            raise ConnectionError('CONNECT refused')
+    else:
+        # plain relay, one round trip proves the worker is connected
+        sock.sendall(b'x')
+        recv_exact(sock, 1)
+    return sock
+
+
+# open, establish and close tunnels one after another until the deadline
+def connect_loop(port, handshake, duration, results):
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            sock = open_tunnel(port, handshake)
+        except OSError:
+            errors += 1
+            continue
+        latencies.append(time.monotonic() - start)
+        sock.close()
+    results.put((latencies, errors))
+
+
+def stream(port, handshake, size, results):
+    sock = open_tunnel(port, handshake)
+    data = b'\x00' * CHUNK
+
+    def send():
+        remaining = size
+        while remaining > 0:
+            sent = sock.send(data[:min(remaining, CHUNK)])
+            remaining -= sent
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    buf = bytearray(CHUNK)
+    received = 0
+    while received < size:
+        count = sock.recv_into(buf)
+        if not count:
+            break
+        received += count
+    sender.join()
+    sock.close()
+    results.put(received)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure_connects(ctx, port, handshake, args):
+    results = ctx.Queue()
+    clients = [ctx.Process(target=connect_loop,
+                           args=(port, handshake, args.duration, results))
+               for i in range(args.clients)]
+    start = time.monotonic()
+    for client in clients:
+        client.start()
+    latencies = []
+    errors = 0
+    for client in clients:
+        client_latencies, client_errors = results.get()
+        latencies += client_latencies
+        errors += client_errors
+    elapsed = time.monotonic() - start
+    for client in clients:
+        client.join()
+    return {
+        'connections': len(latencies),
+        'errors': errors,
+        'conn_per_sec': round(len(latencies) / elapsed, 1),
+        'connect_p50_ms': round(percentile(latencies, .50) * 1000, 3) if latencies else None,
+        'connect_p99_ms': round(percentile(latencies, .99) * 1000, 3) if latencies else None,
+    }
+
+
+def measure_bulk(ctx, pid, port, handshake, args):
+    results = ctx.Queue()
+    size = args.bulk_mb * 1024 * 1024
+    streams = [ctx.Process(target=stream,
+                           args=(port, handshake, size, results))
+               for i in range(args.streams)]
+    cpu_start = cpu_seconds(pid)
+    start = time.monotonic()
+    for client in streams:
+        client.start()
+    received = sum(results.get() for client in streams)
+    elapsed = time.monotonic() - start
+    cpu = cpu_seconds(pid) - cpu_start
+    for client in streams:
+        client.join()
+    # relayed in both directions
+    relayed = received * 2
+    return {
+        'bulk_bytes': relayed,
+        'bulk_mb_per_sec': round(relayed / elapsed / 1000000, 1),
+        'cpu_sec_per_gb': round(cpu / (relayed / 1000000000), 3) if relayed else None,
+    }
+
+
+def measure_idle(pid, port, handshake, args):
+    time.sleep(0.5)
+    before = memory_bytes(pid)
+    sockets = [open_tunnel(port, handshake) for i in range(args.idle)]
+    time.sleep(0.5)
+    after = memory_bytes(pid)
+    for sock in sockets:
+        sock.close()
+    return {
+        'idle_connections': args.idle,
+        'memory_bytes': after,
+        'memory_per_conn_bytes': (after - before) // args.idle if args.idle else None,
+    }
+
+
+def run_scenario(ctx, scenario, args):
+    base = args.base_port
+    echo_ports = (base + 1, base + 2)
+    socks_ports = (base + 11, base + 12)
+    proxy_port = base + 21
+    listen_port = base
+
+    if scenario == 'http':
+        config_file = None
+        config = {'http': {'buffer': args.buffer_size, 'ip': '127.0.0.1',
+                           'port': listen_port, 'info': 'benchmark',
+                           'payload': PAYLOAD, 'split_delay': 0,
+                           'proxy': {'ip': '127.0.0.1', 'port': proxy_port}}}
+        handshake = 'http'
+        target = ctx.Process(target=run_injector,
+                             args=(io.StringIO(json.dumps(config)), listen_port))
+    else:
+        workers = socks_ports if scenario == 'lb-socks' else echo_ports
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.cfg', delete=False)
+        with config_file:
+            config_file.write('[options]\n')
+            config_file.write('buffer_size=%d\n' % args.buffer_size)
+            config_file.write('engine=%s\n' % args.engine)
+            config_file.write('listener_processes=%d\n' % args.listener_processes)
+            config_file.write('health_socks=%d\n' % (scenario == 'lb-socks'))
+            config_file.write('\n[mappings]\n%d=%s\n' % (
+                listen_port, ','.join('127.0.0.1:%d' % port for port in workers)))
+        handshake = 'socks' if scenario == 'lb-socks' else 'raw'
+        target = ctx.Process(target=run_balancer, args=(config_file.name,))
+
+    target.start()
+    try:
+        wait_listening(listen_port)
+        result = {'scenario': scenario}
+        result.update(measure_connects(ctx, listen_port, handshake, args))
+        result.update(measure_bulk(ctx, target.pid, listen_port, handshake, args))
+        result.update(measure_idle(target.pid, listen_port, handshake, args))
+        return result
+    finally:
+        target.terminate()
+        target.join(10)
+        if config_file is not None:
+            os.unlink(config_file.name)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BIN_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='benchmark',
+        description='Benchmark loadbalancer.py and http.py against local stand-ins')
+    parser.add_argument('-s', dest='scenarios', default=','.join(SCENARIOS),
+                        help='comma separated scenarios, of: %s' % ', '.join(SCENARIOS))
+    parser.add_argument('-o', dest='output', help='write the JSON results to this file')
+    parser.add_argument('--engine', default='eventloop', help='load balancer engine')
+    parser.add_argument('--listener-processes', type=int, default=1,
+                        help='load balancer listener_processes')
+    parser.add_argument('--buffer-size', type=int, default=32768,
+                        help='buffer size of both load balancer and injector')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds of the connection rate test')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='client processes of the connection rate test')
+    parser.add_argument('--streams', type=int, default=4,
+                        help='parallel streams of the bulk test')
+    parser.add_argument('--bulk-mb', type=int, default=64,
+                        help='MiB echoed per stream in the bulk test')
+    parser.add_argument('--idle', type=int, default=200,
+                        help='connections held open by the memory test')
+    parser.add_argument('--base-port', type=int, default=20000,
+                        help='first of the local ports used')
+    args = parser.parse_args()
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',')]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario %s' % scenario)
+
+    ctx = multiprocessing.get_context('fork')
+    base = args.base_port
+    standins = ctx.Process(target=run_standins, args=(
+        [(base + 1, handle_echo), (base + 2, handle_echo),
+         (base + 11, handle_socks), (base + 12, handle_socks),
+         (base + 21, handle_proxy)],), daemon=True)
+    standins.start()
+    for port in (base + 1, base + 2, base + 11, base + 12, base + 21):
+        wait_listening(port)
+
+    report = {
+        'revision': git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'parameters': vars(args),
+        'results': [],
+    }
+    try:
+        for scenario in scenarios:
+            report['results'].append(run_scenario(ctx, scenario, args))
+    finally:
+        standins.terminate()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
@@ -6,44 +6,203 @@
 # credit: https://github.com/mientz/python-http-injector
 
 import socket
-import select
+import selectors
+import errno
+import heapq
+import itertools
+import os
 import time
 import argparse
+import collections
 import json
 import logging
+import logging.handlers
+import queue
+import re
+import signal
 import sys
+import threading
+
+LOG_FILE = '/tmp/http-injector2.log'
+# records waiting for the log writer thread, beyond that they are dropped
+LOG_QUEUE_MAX = 10000
+LOG_FLUSH_INTERVAL = .1
+ANSI_COLOR = re.compile(r'\033\[\d+m')
+
+
+# handshake phases of a session, per direction
+REQUEST = 0  # client: waiting for the CONNECT request to rewrite
+RESPONSE = 1  # remote: rewriting the proxy's HTTP responses
+SCAN = 2  # remote: looking for the ssh kex to report Connected!
+TUNNEL = 3  # pass-through
+
+# longest request/response head buffered while in the handshake phases
+MAX_HEAD = 16384
+# chunks after the proxy handshake searched for the ssh kex
+SCAN_CHUNKS = 4
+# bytes queued per direction before reading from the sending side pauses
+# (http.max_pending in the payload file)
+MAX_PENDING = 262144
+# seconds a listen socket is left alone after accept() failed (e.g. EMFILE),
+# instead of spinning on it while it stays readable
+ACCEPT_BACKOFF = 1.0
+
+ESTABLISHED = b'HTTP/1.1 200 Connection established\r\n\r\n'
+
+
+# log records are queued by the loop and written by a background thread in
+# batches, one write and flush per stream every LOG_FLUSH_INTERVAL, so a slow
+# terminal or flash never stalls the relays
+class LogWriter(logging.Handler):
+    def __init__(self, filename=LOG_FILE):
+        super().__init__()
+        self.streams = [(sys.stdout, logging.Formatter('%(message)s'))]
+        if filename:
+            self.streams.append((open(filename, 'w'), logging.Formatter(
+                '%(asctime)s %(message)s')))
+        self.sample = 1
+        self.conn_events = itertools.count()
+        self.start()
+        # the thread is not forked along, each process needs its own
+        os.register_at_fork(after_in_child=self.start)
+
+    def configure(self, level='info', sample=1, json_format=False):
+        log.setLevel(level.upper())
+        self.sample = sample
+        if json_format:
+            self.streams[1:] = [(stream, JsonFormatter())
+                                for stream, _formatter in self.streams[1:]]
+
+    def start(self):
+        self.records = collections.deque()
+        self.dropped = 0
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        # a deque append takes no lock, so signal handlers may log too
+        if len(self.records) >= LOG_QUEUE_MAX:
+            self.dropped += 1
+        else:
+            self.records.append(record)
 
-logging.basicConfig(filename='/tmp/http-injector2.log',
-                    filemode='w',
-                    format='%(asctime)s %(message)s',
-                    level=logging.DEBUG)
-
-
-# forward trafic to remote proxy
-class Forwarder:
-    def __init__(self):
-        self.forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-    def start(self, host, port):
-        try:
-            self.forward.connect((host, port))
-            return self.forward
-        except Exception as e:
-            print(e)
-            logging.error(e)
-            return False
-
-
-# injector server
-class Server:
-    sockets = []
-    tx_chan = {}
-    rx_chan = {}
-    request = {}
-
-    def __init__(self, config, port):
+    def run(self):
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        # also called by logging.shutdown() at exit
+        with self.write_lock:
+            records = []
+            while self.records:
+                records.append(self.records.popleft())
+            if self.dropped:
+                records.append(log.makeRecord(
+                    log.name, logging.ERROR, __file__, 0,
+                    'Log queue full, dropped %d messages', (self.dropped,),
+                    None))
+                self.dropped = 0
+            if not records:
+                return
+            for stream, formatter in self.streams:
+                try:
+                    stream.write(''.join(formatter.format(record) + '\n'
+                                         for record in records))
+                    stream.flush()
+                except Exception:
+                    pass
+
+
+# one JSON object per line, without the terminal colours
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            'time': self.formatTime(record),
+            'level': record.levelname.lower(),
+            'pid': record.process,
+            'msg': ANSI_COLOR.sub('', record.getMessage()),
+        })
+
+
+log = logging.getLogger('http-injector')
+log.propagate = False
+log.setLevel(logging.INFO)
+log_writer = LogWriter()
+log.addHandler(log_writer)
+
+
+def log_conn(level, msg):
+    # events of single connections, only 1 in log_sample of them is logged
+    if log_writer.sample <= 1 or \
+            next(log_writer.conn_events) % log_writer.sample == 0:
+        log.log(level, msg)
+
+
+# payload compiled once into literal byte chunks and placeholders,
+# rendered with a single join per connection
+class Payload:
+    PLACEHOLDER = re.compile(rb'(\[host_port\]|\[host\]|\[port\])')
+
+    def __init__(self, payload):
+        pay = payload.encode('utf-8').split(b'[split]')
+        self.split = len(pay) > 1
+        self.first = self.compile(pay[0])
+        self.second = self.compile(pay[1]) if self.split else []
+
+    def compile(self, payload):
+        return [part for part in self.PLACEHOLDER.split(payload) if part]
+
+    def render(self, host_port):
+        host, _sep, port = host_port.partition(b':')
+        values = {b'[host_port]': host_port, b'[host]': host, b'[port]': port}
+        first = b''.join([values.get(part, part) for part in self.first])
+        second = b''.join([values.get(part, part) for part in self.second])
+        return first, second
+
+
+# state of one client <-> remote proxy connection
+class Session:
+    __slots__ = ('injector', 'client', 'remote', 'connected', 'to_client', 'to_remote',
+                 'client_phase', 'remote_phase', 'client_head',
+                 'remote_head', 'scanned', 'request', 'held',
+                 'split_timer', 'client_events', 'remote_events',
+                 'client_eof', 'remote_eof', 'client_shut', 'remote_shut',
+                 'closed')
+
+    def __init__(self, injector, client, remote):
+        self.injector = injector  # listen port (and payload) the client came in on
+        self.client = client
+        self.remote = remote
+        self.connected = False  # remote proxy connect completed
+        self.to_client = bytearray()  # pending data, not yet accepted by the socket
+        self.to_remote = bytearray()
+        self.client_phase = REQUEST
+        self.remote_phase = RESPONSE
+        self.client_head = b''  # partial request/response head
+        self.remote_head = b''
+        self.scanned = 0  # chunks searched in the SCAN phase
+        self.request = b''  # second half of a [split] payload, sent on the proxy response
+        self.held = bytearray()  # response held back until the split delay passed
+        self.split_timer = None
+        self.client_events = 0  # events registered with the selector
+        self.remote_events = 0
+        # a side that sent EOF is no longer read from; once what it sent is
+        # delivered, the other side is shut down for writing
+        self.client_eof = False
+        self.remote_eof = False
+        self.client_shut = False  # shut down for writing
+        self.remote_shut = False
+        self.closed = False
+
+
+# one payload config and its listen port
+class Injector:
+
+    def __init__(self, config, port, reuse_port=False):
         # load payload config
-        payload_file = json.load(config)
+        payload_file = json.load(config) if hasattr(config, 'read') else config
         payload = payload_file['http']['payload']
         payload = payload.replace('[crlf]', '\r\n')
         payload = payload.replace('[lf]', '\n')
@@ -51,154 +210,418 @@ class Server:
         payload = payload.replace('[protocol]', 'HTTP/1.1')
 
         # initalize payload
-        self.payload = payload
+        self.payload = Payload(payload)
         self.forward_to = (payload_file['http']['proxy']['ip'],
                            payload_file['http']['proxy']['port'])
         self.buffer_size = payload_file['http']['buffer']
+        self.max_pending = int(payload_file['http'].get('max_pending', MAX_PENDING))
+        # delay before sending the second half of a [split] payload
+        self.split_delay = float(payload_file['http'].get('split_delay', 0.5))
+        self.info = payload_file['http']['info']
+        self.port = port
 
         # initalize injector server
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # every worker process binds the port, the kernel spreads the accepts
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind(('127.0.0.1', port))
         self.server.listen(200)
+        self.server.setblocking(False)
 
-        print('Config: \033[96m{}\033[0m'.format(payload_file['http']['info']))
-        logging.info('Config: \033[96m{}\033[0m'.format(payload_file['http']['info']))
-
-    def on_accept(self):
-        forward = Forwarder().start(self.forward_to[0], self.forward_to[1])
-        clientsock, _clientaddr = self.server.accept()
-        if forward:
-            self.sockets.append(clientsock)
-            self.sockets.append(forward)
-            self.tx_chan[clientsock] = forward
-            self.tx_chan[forward] = clientsock
-            self.rx_chan[clientsock] = forward
-            self.rx_chan[forward] = forward
-        else:
-            print('\033[91mUnable connect to proxy server\033[0m')
-            logging.error('\033[91mUnable connect to proxy server\033[0m')
-            clientsock.close()
-
-    def on_close(self):
-        # remove socket
-        self.sockets.remove(self.s)
-        self.sockets.remove(self.tx_chan[self.s])
-
-        # closing socket channel
-        out = self.tx_chan[self.s]
-        self.tx_chan[out].close()
-        self.rx_chan[out].close()
-        self.tx_chan[self.s].close()
-        self.rx_chan[self.s].close()
-
-        # remove socket channel
-        del self.tx_chan[out]
-        del self.rx_chan[out]
-        del self.tx_chan[self.s]
-        del self.rx_chan[self.s]
-
-    def on_execute(self):
-        netdata = self.netdata
-
-        # modify received netdata from injector server to sender socket
-        try:
-            netdata = netdata.decode('ascii')
-            if netdata.find('CONNECT') == 0:
-                req = netdata.split('HTTP')[0]
-                req = req.split(' ')
-                host_port = req[1].split(':')
-                payloads = self.payload
-                payloads = payloads.replace('[host_port]', req[1])
-                payloads = payloads.replace('[host]', host_port[0])
-                payloads = payloads.replace('[port]', host_port[1])
-                if payloads.find('[split]') != -1:
-                    pay = payloads.split('[split]')
-                    self.request[self.tx_chan[self.s]] = pay[1]
-                    netdata = pay[0]
-                else:
-                    netdata = payloads
-                print('\033[93mConnecting\033[0m')
-                logging.info('\033[93mConnecting\033[0m')
-            netdata = netdata.encode('ascii')
-        except Exception as e:
-            # print(e)
-            pass
+        # counters, logged on SIGUSR2
+        self.accepted = 0
+        self.active = 0
+        self.failed = 0  # remote proxy connects that failed
+        self.established = 0  # reached the ssh kex through the proxy
 
-        # print("Execute netdata: {}".format(netdata))
 
-        try:
-            self.tx_chan[self.s].send(netdata)
-        except Exception as e:
-            # print(e)
-            pass
+# injector server, serving any number of Injectors from one loop
+class Server:
 
-    def on_outbounddata(self):
-        netdata = self.netdata
+    def __init__(self, config=None, port=None, reuse_port=False):
+        self.selector = selectors.DefaultSelector()
+        self.injectors = {}  # listen socket fileno -> Injector
+        self.reuse_port = reuse_port
+        self.timers = []  # heap of (deadline, sequence, timer)
+        self.timer_sequence = itertools.count()
+        if config is not None:
+            self.add(config, port)
+
+    def add(self, config, port):
+        injector = Injector(config, port, self.reuse_port)
+        self.injectors[injector.server.fileno()] = injector
+        self.selector.register(injector.server, selectors.EVENT_READ, None)
+
+        log.info('Config: \033[96m{}\033[0m (port {})'.format(injector.info, port))
+        return injector
+
+    def print_stats(self, *args):
+        for injector in self.injectors.values():
+            line = 'Port {}: accepted={} active={} failed={} established={} ({})'.format(
+                injector.port, injector.accepted, injector.active,
+                injector.failed, injector.established, injector.info)
+            log.info(line)
+
+    def call_later(self, delay, callback, *args):
+        timer = [callback, args]
+        heapq.heappush(self.timers, (time.monotonic() + delay,
+                                     next(self.timer_sequence), timer))
+        return timer
+
+    def cancel_timer(self, timer):
+        if timer is not None:
+            timer[0] = None
+
+    def run_timers(self):
+        # run due timers, return seconds until the next one (or None)
+        while self.timers:
+            deadline, _sequence, timer = self.timers[0]
+            now = time.monotonic()
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.timers)
+            if timer[0] is not None:
+                timer[0](*timer[1])
+        return None
+
+    def on_accept(self, injector):
+        while True:
+            try:
+                clientsock, _clientaddr = injector.server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                log.error(e)
+                self.selector.unregister(injector.server)
+                self.call_later(ACCEPT_BACKOFF, self.resume_accept, injector)
+                return
+            clientsock.setblocking(False)
+
+            # connect to remote proxy without blocking the loop, the
+            # client is only read from once the connect completed
+            forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            forward.setblocking(False)
+            session = Session(injector, clientsock, forward)
+            injector.accepted += 1
+            injector.active += 1
+            try:
+                err = forward.connect_ex(injector.forward_to)
+            except Exception as e:
+                err = e
+            if err not in (0, errno.EINPROGRESS):
+                self.on_connect_failed(session, err)
+                continue
+            session.remote_events = selectors.EVENT_WRITE
+            self.selector.register(forward, selectors.EVENT_WRITE, session)
+
+    def resume_accept(self, injector):
+        self.selector.register(injector.server, selectors.EVENT_READ, None)
+
+    def on_connect(self, session):
+        err = session.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.on_connect_failed(session, os.strerror(err))
+            return
+        session.connected = True
+        self.update_events(session)
+
+    def on_connect_failed(self, session, err):
+        log_conn(logging.ERROR, '\033[91mUnable connect to proxy server\033[0m ({})'.format(err))
+        session.injector.failed += 1
+        self.on_close(session, notify=False)
+
+    def on_close(self, session, notify=True):
+        if session.closed:
+            return
+        session.closed = True
+        session.injector.active -= 1
+        self.cancel_timer(session.split_timer)
+        if notify:
+            log_conn(logging.INFO, '\033[91mDisconnected!\033[0m')
+
+        # remove and close socket channel
+        for sock, events in ((session.client, session.client_events),
+                             (session.remote, session.remote_events)):
+            if events:
+                self.selector.unregister(sock)
+            sock.close()
+        session.client_events = session.remote_events = 0
+
+    def on_execute(self, session, netdata):
+        # modify received netdata from injector server to sender socket,
+        # only until the CONNECT request has been rewritten
+        if session.client_phase == REQUEST:
+            netdata = self.rewrite_request(session, netdata)
+            if not netdata:
+                return
 
-        # modify received netdata from response
-        try:
-            netdata = netdata.decode('ascii')
-            if netdata.find('HTTP/1.') == 0:
-                if self.payload.find('[split]') != -1:
-                    try:
-                        if self.request[self.s] != '':
-                            time.sleep(0.5)
-                            self.request[self.s] = self.request[self.s].encode(
-                                'ascii')
-                            self.rx_chan[self.s].send(self.request[self.s])
-                            self.request[self.s] = ''
-                    except Exception as e:
-                        # print(e)
-                        pass
-                netdata = 'HTTP/1.1 200 Connection established\r\n\r\n'
-            netdata = netdata.encode('ascii')
-        except Exception as e:
-            # print(e)
-            pass
+        # print("Execute netdata: {}".format(netdata))
 
-        # print("Outbound netdata: {}".format(netdata))
+        self.send(session, session.remote, session.to_remote, netdata)
+
+    def rewrite_request(self, session, netdata):
+        head = session.client_head + netdata
+        if not head.startswith(b'CONNECT') and not b'CONNECT'.startswith(head):
+            session.client_phase = TUNNEL
+            session.client_head = b''
+            return head
+
+        end = head.find(b'\r\n\r\n')
+        if end == -1:
+            if len(head) > MAX_HEAD:
+                session.client_phase = TUNNEL
+                session.client_head = b''
+                return head
+            session.client_head = head
+            return b''
+
+        session.client_phase = TUNNEL
+        session.client_head = b''
+        # CONNECT host:port HTTP/1.x
+        host_port = head[:head.find(b'\r\n')].split(b' ')[1]
+        first, session.request = session.injector.payload.render(host_port)
+        log_conn(logging.INFO, '\033[93mConnecting\033[0m')
+        return first + head[end + 4:]
+
+    def on_outbounddata(self, session, netdata):
+        # modify received netdata from response, only during the proxy
+        # handshake, then pass everything through untouched
+        if session.remote_phase == RESPONSE:
+            netdata = self.rewrite_response(session, netdata)
+            if not netdata and session.split_timer is None:
+                return
+        if session.remote_phase == SCAN:
+            session.scanned += 1
+            if b'zlib@openssh.com' in netdata:
+                log_conn(logging.INFO, '\033[92mConnected!\033[0m')
+                session.injector.established += 1
+                session.remote_phase = TUNNEL
+            elif session.scanned >= SCAN_CHUNKS:
+                session.remote_phase = TUNNEL
 
-        if 'zlib@openssh.com' in str(netdata):
-            print('\033[92mConnected!\033[0m')
-            logging.info('\033[92mConnected!\033[0m')
+        # print("Outbound netdata: {}".format(netdata))
 
+        if session.split_timer is not None:
+            session.held += netdata
+            return
+        self.send(session, session.client, session.to_client, netdata)
+
+    def rewrite_response(self, session, netdata):
+        head = session.remote_head + netdata
+        out = b''
+        # every HTTP response of the handshake is answered to the client
+        # as an established CONNECT
+        while head.startswith(b'HTTP/1.'):
+            end = head.find(b'\r\n\r\n')
+            if end == -1:
+                break
+            if session.injector.payload.split and session.request and \
+                    session.split_timer is None:
+                # send the second half after split_delay, holding back the
+                # response meanwhile, without blocking the other connections
+                session.split_timer = self.call_later(
+                    session.injector.split_delay, self.on_split, session)
+            out += ESTABLISHED
+            head = head[end + 4:]
+
+        if head.startswith(b'HTTP/1.') or b'HTTP/1.'.startswith(head):
+            if len(head) <= MAX_HEAD:
+                session.remote_head = head
+                return out
+        session.remote_head = b''
+        session.remote_phase = SCAN
+        return out + head
+
+    def on_split(self, session):
+        if session.closed:
+            return
         try:
-            self.tx_chan[self.s].send(netdata)
+            request = session.request
+            session.request = b''
+            self.send(session, session.remote, session.to_remote, request)
+            held = bytes(session.held)
+            session.held = bytearray()
+            session.split_timer = None
+            self.send(session, session.client, session.to_client, held)
+            if self.propagate_eof(session):
+                return
+            self.update_events(session)
         except Exception as e:
             # print(e)
-            pass
+            self.on_close(session)
+
+    def send(self, session, sock, pending, netdata):
+        # keep ordering: only write directly when nothing is queued
+        if not pending:
+            try:
+                sent = sock.send(netdata)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            netdata = memoryview(netdata)[sent:]
+        pending += netdata
+
+    def flush(self, sock, pending):
+        try:
+            sent = sock.send(pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        del pending[:sent]
+
+    def update_events(self, session):
+        # a socket is only read from while the other side keeps up: the
+        # kernel then holds the rest and TCP slows the sender down
+        max_pending = session.injector.max_pending
+        client_events = remote_events = 0
+        if not session.client_eof and len(session.to_remote) < max_pending:
+            client_events |= selectors.EVENT_READ
+        if not session.remote_eof and \
+                len(session.to_client) + len(session.held) < max_pending:
+            remote_events |= selectors.EVENT_READ
+        if session.to_client:
+            client_events |= selectors.EVENT_WRITE
+        if session.to_remote:
+            remote_events |= selectors.EVENT_WRITE
+        session.client_events = self.set_events(
+            session, session.client, session.client_events, client_events)
+        session.remote_events = self.set_events(
+            session, session.remote, session.remote_events, remote_events)
+
+    def set_events(self, session, sock, old_events, new_events):
+        if new_events != old_events:
+            if not old_events:
+                self.selector.register(sock, new_events, session)
+            elif not new_events:
+                self.selector.unregister(sock)
+            else:
+                self.selector.modify(sock, new_events, session)
+        return new_events
+
+    def on_event(self, session, sock, events):
+        if not session.connected:
+            self.on_connect(session)
+            return
+
+        is_client = sock is session.client
+        if events & selectors.EVENT_WRITE:
+            if is_client:
+                self.flush(sock, session.to_client)
+            else:
+                self.flush(sock, session.to_remote)
+
+        if events & selectors.EVENT_READ:
+            try:
+                netdata = sock.recv(session.injector.buffer_size)
+            except (BlockingIOError, InterruptedError):
+                self.update_events(session)
+                return
+            except Exception as e:
+                # print(e)
+                self.on_close(session)
+                return
+
+            if not netdata:
+                # EOF: what is still queued for the other side is delivered
+                # before it is shut down for writing
+                if is_client:
+                    session.client_eof = True
+                else:
+                    session.remote_eof = True
+            elif is_client:
+                # print('EXECUTE')
+                self.on_execute(session, netdata)
+            else:
+                # print('OUTBOUND')
+                self.on_outbounddata(session, netdata)
+
+        if self.propagate_eof(session):
+            return
+        self.update_events(session)
+
+    def propagate_eof(self, session):
+        # pass a half-close on once everything sent before it was delivered,
+        # the session is closed when both directions are done
+        if session.client_eof and not session.remote_shut and \
+                not session.to_remote and session.split_timer is None:
+            session.remote_shut = True
+            session.remote.shutdown(socket.SHUT_WR)
+        if session.remote_eof and not session.client_shut and \
+                not session.to_client and not session.held and \
+                session.split_timer is None:
+            session.client_shut = True
+            session.client.shutdown(socket.SHUT_WR)
+        if session.client_shut and session.remote_shut:
+            self.on_close(session)
+            return True
+        return False
 
     def main_loop(self):
-        self.sockets.append(self.server)
-
         while True:
-            ss = select.select
-            i_sockets, _o_sockets, _e_sockets = ss(self.sockets, [], [])
-
-            for self.s in i_sockets:
-                if self.s == self.server:
+            for key, events in self.selector.select(self.run_timers()):
+                session = key.data
+                if session is None:
                     # print('ACCEPT')
-                    self.on_accept()
-                    break
-
+                    self.on_accept(self.injectors[key.fd])
+                    continue
+                if session.closed:
+                    continue
                 try:
-                    self.netdata = self.s.recv(self.buffer_size)
+                    self.on_event(session, key.fileobj, events)
                 except Exception as e:
                     # print(e)
-                    self.netdata = ''.encode('ascii')
+                    self.on_close(session)
 
-                if len(self.netdata) <= 0:
-                    print('\033[91mDisconnected!\033[0m')
-                    logging.info('\033[91mDisconnected!\033[0m')
-                    self.on_close()
-                else:
-                    if self.tx_chan[self.s] != self.rx_chan[self.s]:
-                        # print('OUTBOUND')
-                        self.on_outbounddata()
-                    else:
-                        # print('EXECUTE')
-                        self.on_execute()
+
+def serve(configs, ports, reuse_port=False):
+    server = Server(reuse_port=reuse_port)
+    for config, port in zip(configs, ports):
+        server.add(config, port)
+    signal.signal(signal.SIGUSR2, server.print_stats)
+    # exit through the interpreter, so queued log records are written
+    signal.signal(signal.SIGTERM, lambda *_args: sys.exit(0))
+
+    try:
+        server.main_loop()
+    except KeyboardInterrupt:
+        log.info("\033[0mCtrl C - Stopping server")
+    except Exception as e:
+        log.error(e)
+        time.sleep(3)
+        server.main_loop()
+
+
+def serve_forked(configs, ports, workers):
+    # one loop per process, all of them accepting on every port
+    children = []
+    for _i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(configs, ports, reuse_port=True)
+            finally:
+                log_writer.flush()
+                os._exit(0)
+        children.append(pid)
+
+    def forward(signum, _frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM if signum == signal.SIGHUP else signum)
+            except OSError:
+                pass
+    for signum in (signal.SIGTERM, signal.SIGHUP, signal.SIGUSR2):
+        signal.signal(signum, forward)
+
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except KeyboardInterrupt:
+                continue
+            except ChildProcessError:
+                break
 
 
 # initiate main program
@@ -207,24 +630,52 @@ if __name__ == '__main__':
         prog='http-injector', description='Python Version of HTTP-INJECTOR')
     parser.add_argument('config',
                         metavar='payload',
+                        nargs='+',
                         type=argparse.FileType('r'),
-                        help='payload file')
+                        help='payload file(s), each served on its own port')
     parser.add_argument('-l',
                         dest='listen',
-                        nargs='?',
-                        const=9877,
-                        help='listen port',
-                        default=9877)
+                        nargs='*',
+                        type=int,
+                        help='listen port(s), in the order of the payload '
+                             'files (default: http.port of each payload '
+                             'file, else 9877)')
+    parser.add_argument('-w',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help='processes serving every port, 0 for one per '
+                             'core (default: 1)')
+    parser.add_argument('--log-level',
+                        choices=('debug', 'info', 'warning', 'error'),
+                        default='info',
+                        help='least severe messages logged (default: info)')
+    parser.add_argument('--log-sample',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help='log 1 in N connect/disconnect events '
+                             '(default: 1, every one)')
+    parser.add_argument('--log-json',
+                        action='store_true',
+                        help='write {} as one JSON object per '
+                             'line'.format(LOG_FILE))
     args = parser.parse_args()
-
-    server = Server(args.config, int(args.listen))
-
-    try:
-        server.main_loop()
-    except KeyboardInterrupt:
-        print("\033[0mCtrl C - Stopping server")
-    except Exception as e:
-        print(e)
-        time.sleep(3)
-        server.main_loop()
-
+    if args.log_sample < 1:
+        parser.error('--log-sample must be at least 1')
+    log_writer.configure(args.log_level, args.log_sample, args.log_json)
+
+    configs = [json.load(config) for config in args.config]
+    ports = list(args.listen or [])
+    if len(ports) > len(configs):
+        parser.error('more listen ports than payload files')
+    for config in configs[len(ports):]:
+        ports.append(int(config['http'].get('port', 9877)))
+    if len(set(ports)) < len(ports):
+        parser.error('listen ports must differ: {}'.format(ports))
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        serve_forked(configs, ports, workers)
+    else:
+        serve(configs, ports)
@@ -1,652 +1,3949 @@
-#!/usr/bin/python
-#
-# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
-# You should have received a copy of the license as LICENSE 
-#
-# See: https://github.com/kata198/PumpkinLB
-
-import math
-import multiprocessing
-import os
-import platform
-import socket
-import sys
-import signal
-import threading
-import traceback
-import time
-import random
-import select
-from datetime import datetime
-try:
-    from ConfigParser import ConfigParser
-except:
-    from configparser import ConfigParser
-
-### version ###
-pumpkinlb_version = '2.0.0'
-
-### constants ###
-GRACEFUL_SHUTDOWN_TIME = 6
-DEFAULT_BUFFER_SIZE = 4096
-
-
-### log ###
-def logit(fileObj, msg):
-    fileObj.write("[ %s ] %s" %(datetime.now().ctime(), msg))
-    if msg[-1] != '\n':
-        fileObj.write('\n')
-    fileObj.flush()
-
-def logmsg(msg):
-    logit(sys.stdout, msg)
-
-def logerr(msg):
-    logit(sys.stderr, msg)
-
-
-### usage ###
-def printUsage(toStream=sys.stdout):
-    toStream.write('''Usage: %s [config file]
-Starts Pumpkin Load Balancer using the given config file.
-
-  Arguments:
-
-    --help                         Print this message
-    --help-config                  Print help regarding usage of the config file
-    --version                      Show version information
-
-  Signals:
-
-    SIGTERM                        Performs a graceful shutdown
-
-%s
-''' %(os.path.basename(sys.argv[0]), getVersionStr())
-    )
-#    SIGUSR1                        Re-read the config, and alter service to match TODO: NOT DONE
-
-def printConfigHelp(toStream=sys.stdout):
-    toStream.write('''Config Help
-
-Config file is broken up into sections, definable by [$SectionName], followed by variables in format of key=value.
-
-  Sections:
-
-    [options]
-      pre_resolve_workers=0/1                     [Default 1]    Any workers defined with a hostname will be evaluated at the time the config is read. 
-                                                                   This is preferable as it saves a DNS trip for every request, and should be enabled
-                                                                   unless your DNS is likely to change and you want the workers to match the change.
-
-      buffer_size=N                             [Default %d]   Default read/write buffer size (in bytes) used on socket operations. 4096 is a good default for most, but you may be able to tune better depending on your application.
-
-    [mappings]
-      localaddr:inport=worker1:port,worker2:port...              Listen on interface defined by "localaddr" on port "inport". Farm out to worker addresses and ports. Ex: 192.168.1.100:80=10.10.0.1:5900,10.10.0.2:5900
-        or
-      inport=worker1:port,worker2:port...                        Listen on all interfaces on port "inport", and farm out to worker addresses with given ports. Ex: 80=10.10.0.1:5900,10.10.0.2:5900
-
-''' %(DEFAULT_BUFFER_SIZE, )
-    )
-
-def getVersionStr():
-    return 'PumpkinLB Version %s (c) 2014-2015 Timothy Savannah GPLv3' %(pumpkinlb_version,)
-
-
-### config ###
-class PumpkinMapping(object):
-    '''
-        Represents a mapping of a local listen to a series of workers
-    '''
-    def __init__(self, localAddr, localPort, workers):
-        self.localAddr = localAddr or ''
-        self.localPort = int(localPort)
-        self.workers = workers
-
-    def getListenerArgs(self):
-        return [self.localAddr, self.localPort, self.workers]
-
-    def addWorker(self, workerAddr, workerPort):
-        self.workers.append( {'port' : int(workerPort), 'addr' : workerAddr} )
-
-    def removeWorker(self, workerAddr, workerPort):
-        newWorkers = []
-        workerPort = int(workerPort)
-        removedWorker = None
-        for worker in self.workers:
-            if worker['addr'] == workerAddr and worker['port'] == workerPort:
-                removedWorker = worker
-                continue
-            newWorkers.append(worker)
-        self.workers = newWorkers
-        return removedWorker
-
-class PumpkinConfig(ConfigParser):
-    '''
-        The class for managing Pumpkin's Config File
-    '''
-    def __init__(self, configFilename):
-        ConfigParser.__init__(self)
-        self.configFilename = configFilename
-
-        self._options = {
-            'pre_resolve_workers' : True,
-            'buffer_size'         : DEFAULT_BUFFER_SIZE,
-        }
-        self._mappings = {}
-
-    def parse(self):
-        '''
-            Parse the config file
-        '''
-        try:
-            f = open(self.configFilename, 'rt')
-        except IOError as e:
-            logerr('Could not open config file: "%s": %s\n' %(self.configFilename, str(e)))
-            raise e
-        [self.remove_section(s) for s in self.sections()]
-        self.read_file(f)
-        f.close()
-
-        self._processOptions()
-        self._processMappings()
-
-    def getOptions(self):
-        '''
-            Gets the options dictionary
-        '''
-        return self._options
-
-    def getOptionValue(self, optionName):
-        '''
-            getOptionValue - Gets the value of an option
-        '''
-        return self._options[optionName]
-
-    def getMappings(self):
-        '''
-            Gets the mappings dictionary
-        '''
-        return self._mappings
-
-    def _processOptions(self):
-        # I personally think the config parser interface sucks...
-        if 'options' not in self._sections:
-            return
-
-        try:
-            preResolveWorkers = self.get('options', 'pre_resolve_workers')
-            if preResolveWorkers == '1' or preResolveWorkers.lower() == 'true':
-                self._options['pre_resolve_workers'] = True
-            elif preResolveWorkers == '0' or preResolveWorkers.lower() == 'false':
-                self._options['pre_resolve_workers'] = False
-            else:
-                logerr('WARNING: Unknown value for [options] -> pre_resolve_workers "%s" -- ignoring value, retaining previous "%s"\n' %(str(preResolveWorkers), str(self._options['pre_resolve_workers'])) )
-        except:
-            pass
-
-        try:
-            bufferSize = self.get('options', 'buffer_size')
-            if bufferSize.isdigit() and int(bufferSize) > 0:
-                self._options['buffer_size'] = int(bufferSize)
-            else:
-                logerr('WARNING: buffer_size must be an integer > 0 (bytes). Got "%s" -- ignoring value, retaining previous "%s"\n' %(bufferSize, str(self._options['buffer_size'])) )
-        except Exception as e:
-            logerr('Error parsing [options]->buffer_size : %s. Retaining default, %s\n' %(str(e),str(DEFAULT_BUFFER_SIZE)) )
-
-    def _processMappings(self):
-
-        if 'mappings' not in self._sections:
-            raise PumpkinConfigException('ERROR: Config is missing required "mappings" section.\n')
-
-        preResolveWorkers = self._options['pre_resolve_workers']
-
-        mappings = {}
-        mappingSectionItems = self.items('mappings')
-        
-        for (addrPort, workers) in mappingSectionItems:
-            addrPortSplit = addrPort.split(':')
-            addrPortSplitLen = len(addrPortSplit)
-            if not workers:
-                logerr('WARNING: Skipping, no workers defined for %s\n' %(addrPort,))
-                continue
-            if addrPortSplitLen == 1:
-                (localAddr, localPort) = ('0.0.0.0', addrPort)
-            elif addrPortSplitLen == 2:
-                (localAddr, localPort) = addrPortSplit
-            else:
-                logerr('WARNING: Skipping Invalid mapping: %s=%s\n' %(addrPort, workers))
-                continue
-            try:
-                localPort = int(localPort)
-            except ValueError:
-                logerr('WARNING: Skipping Invalid mapping, cannot convert port: %s\n' %(addrPort,))
-                continue
-
-            workerLst = []
-            for worker in workers.split(','):
-                workerSplit = worker.split(':')
-                if len(workerSplit) != 2 or len(workerSplit[0]) < 3 or len(workerSplit[1]) == 0:
-                    logerr('WARNING: Skipping Invalid Worker %s\n' %(worker,))
-
-                if preResolveWorkers is True:
-                    try:
-                        addr = socket.gethostbyname(workerSplit[0])
-                    except:
-                        logerr('WARNING: Skipping Worker, could not resolve %s\n' %(workerSplit[0],))
-                else:
-                    addr = workerSplit[0]
-                try:
-                    port = int(workerSplit[1])
-                except ValueError:
-                    logerr('WARNING: Skipping worker, could not parse port %s\n' %(workerSplit[1],))
-
-                workerLst.append({'addr' : addr, 'port' : port})
-
-            keyName = "%s:%s" %(localAddr, addrPort)
-            if keyName in mappings:
-                logerr('WARNING: Overriding existing mapping of %s with %s\n' %(addrPort, str(workerLst)))
-            mappings[addrPort] = PumpkinMapping(localAddr, localPort, workerLst)
-
-        self._mappings = mappings
-
-class PumpkinConfigException(Exception):
-    pass
-
-
-### listener ###
-class PumpkinListener(multiprocessing.Process):
-    '''
-        Class that listens on a local port and forwards requests to workers
-    '''
-    def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE):
-        multiprocessing.Process.__init__(self)
-        self.localAddr = localAddr
-        self.localPort = localPort
-        self.workers = workers
-        self.bufferSize = bufferSize
-        self.activeWorkers = []   # Workers currently processing a job
-        self.listenSocket = None  # Socket for incoming connections
-        self.cleanupThread = None # Cleans up completed workers
-        self.keepGoing = True     # Flips to False when the application is set to terminate
-
-    def cleanup(self):
-        time.sleep(2) # Wait for things to kick off
-        while self.keepGoing is True:
-            currentWorkers = self.activeWorkers[:]
-            for worker in currentWorkers:
-                worker.join(.02)
-                if worker.is_alive() == False: # Completed
-                    self.activeWorkers.remove(worker)
-            time.sleep(1.5)
-
-    def closeWorkers(self, *args):
-        self.keepGoing = False
-        time.sleep(1)
-
-        try:
-            self.listenSocket.shutdown(socket.SHUT_RDWR)
-        except:
-            pass
-        try:
-            self.listenSocket.close()
-        except:
-            pass
-
-        if not self.activeWorkers:
-            self.cleanupThread and self.cleanupThread.join(3)
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
-            sys.exit(0)
-
-        for pumpkinWorker in self.activeWorkers:
-            try:
-                pumpkinWorker.terminate()
-                os.kill(pumpkinWorker.pid, signal.SIGTERM)
-            except:
-                pass
-
-        time.sleep(1)
-
-        remainingWorkers = []
-        for pumpkinWorker in self.activeWorkers:
-            pumpkinWorker.join(.03)
-            if pumpkinWorker.is_alive() is True: # Still running
-                remainingWorkers.append(pumpkinWorker)
-
-        if len(remainingWorkers) > 0:
-            # One last chance to complete, then we kill
-            time.sleep(1)
-            for pumpkinWorker in remainingWorkers:
-                pumpkinWorker.join(.2)
-
-        self.cleanupThread and self.cleanupThread.join(2)
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-        sys.exit(0)
-
-    def retryFailedWorkers(self, *args):
-        '''
-            retryFailedWorkers - 
-
-                This function loops over current running workers and scans them for a multiprocess shared field called "failedToConnect".
-                  If this is set to 1, then we failed to connect to the backend worker. If that happens, we pick a different worker from the pool at random,
-                  and assign the client to that new worker.
-        '''
-        time.sleep(2)
-        successfulRuns = 0 # We use this to differ between long waits in between successful periods and short waits when there is a failing host in the mix.
-        while self.keepGoing is True:
-            currentWorkers = self.activeWorkers[:]
-            for worker in currentWorkers:
-                if worker.failedToConnect.value == 1:
-                    successfulRuns = -1 # Reset the "roll" of successful runs so we start doing shorter sleeps
-                    logmsg('Found a failure to connect to worker\n')
-                    numWorkers = len(self.workers)
-                    if numWorkers > 1:
-                        nextWorkerInfo = None
-                        while (nextWorkerInfo is None) or (worker.workerAddr == nextWorkerInfo['addr'] and worker.workerPort == nextWorkerInfo['port']):
-                            nextWorkerInfo = self.workers[random.randint(0, numWorkers-1)]
-                    else:
-                        # In this case, we have no option but to try on the same host.
-                        nextWorkerInfo = self.workers[0]
-
-                    logmsg('Retrying request from %s from %s:%d on %s:%d\n' %(worker.clientAddr, worker.workerAddr, worker.workerPort, nextWorkerInfo['addr'], nextWorkerInfo['port']))
-
-                    nextWorker = PumpkinWorker(worker.clientSocket, worker.clientAddr, nextWorkerInfo['addr'], nextWorkerInfo['port'], self.bufferSize)
-                    nextWorker.start()
-                    self.activeWorkers.append(nextWorker)
-                    worker.failedToConnect.value = 0 # Clean now
-            successfulRuns += 1
-            if successfulRuns > 1000000: # Make sure we don't overrun
-                successfulRuns = 6
-            if successfulRuns > 5:
-                time.sleep(2)
-            else:
-                time.sleep(.05)
-
-    def run(self):
-        signal.signal(signal.SIGTERM, self.closeWorkers)
-
-        while True:
-            try:
-                listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-                # If on UNIX, bind to port even if connections are still in TIME_WAIT state
-                #  (from previous connections, which don't ever be served...)
-                # Happens when PumpkinLB Restarts.
-                try:
-                    listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                except:
-                    pass
-                listenSocket.bind( (self.localAddr, self.localPort) )
-                self.listenSocket = listenSocket
-                break
-            except Exception as e:
-                logerr('Failed to bind to %s:%d. "%s" Retrying in 5 seconds.\n' %(self.localAddr, self.localPort, str(e)))
-                time.sleep(5)
-
-        listenSocket.listen(5)
-
-        # Create thread that will cleanup completed tasks
-        self.cleanupThread = cleanupThread = threading.Thread(target=self.cleanup)
-        cleanupThread.start()
-
-        # Create thread that will retry failed tasks
-        retryThread = threading.Thread(target=self.retryFailedWorkers)
-        retryThread.start()
-
-        try:
-            while self.keepGoing is True:
-                for workerInfo in self.workers:
-                    if self.keepGoing is False:
-                        break
-                    try:
-                        (clientConnection, clientAddr) = listenSocket.accept()
-                    except:
-                        logerr('Cannot bind to %s:%s\n' %(self.localAddr, self.localPort))
-                        if self.keepGoing is True:
-                            # Exception did not come from termination process, so keep rollin'
-                            time.sleep(3)
-                            continue
-                        
-                        raise # Termination DID come from termination process, so abort.
-
-                    worker = PumpkinWorker(clientConnection, clientAddr, workerInfo['addr'], workerInfo['port'], self.bufferSize)
-                    self.activeWorkers.append(worker)
-                    worker.start()
-        except Exception as e:
-            logerr('Got exception: %s, shutting down workers on %s:%d\n' %(str(e), self.localAddr, self.localPort))
-            self.closeWorkers()
-            return
-
-        self.closeWorkers()
-
-
-### worker ###
-class PumpkinWorker(multiprocessing.Process):
-    '''
-        A class which handles the worker-side of processing a request (communicating between the back-end worker and the requesting client)
-    '''
-    def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE):
-        multiprocessing.Process.__init__(self)
-        self.clientSocket = clientSocket
-        self.clientAddr = clientAddr
-        self.workerAddr = workerAddr
-        self.workerPort = workerPort
-        self.workerSocket = None
-        self.bufferSize = bufferSize
-        self.failedToConnect = multiprocessing.Value('i', 0)
-
-    def closeConnections(self):
-        try:
-            self.workerSocket.shutdown(socket.SHUT_RDWR)
-        except:
-            pass
-        try:
-            self.workerSocket.close()
-        except:
-            pass
-        try:
-            self.clientSocket.shutdown(socket.SHUT_RDWR)
-        except:
-            pass
-        try:
-            self.clientSocket.close()
-        except:
-            pass
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-
-    def closeConnectionsAndExit(self, *args):
-        self.closeConnections()
-        sys.exit(0)
-
-    def run(self):
-        workerSocket = self.workerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        clientSocket = self.clientSocket
-
-        bufferSize = self.bufferSize
-
-        try:
-            workerSocket.connect( (self.workerAddr, self.workerPort) )
-        except:
-            logerr('Could not connect to worker %s:%d\n' %(self.workerAddr, self.workerPort))
-            self.failedToConnect.value = 1
-            time.sleep(GRACEFUL_SHUTDOWN_TIME) # Give a few seconds for the "fail" reader to pick this guy up before we are removed by the joining thread
-            return
-
-        signal.signal(signal.SIGTERM, self.closeConnectionsAndExit)
-
-        try:
-            dataToClient = b''
-            dataFromClient = b''
-            while True:
-                waitingToWrite = []
-
-                if dataToClient:
-                    waitingToWrite.append(clientSocket)
-                if dataFromClient:
-                    waitingToWrite.append(workerSocket)
-
-                try:
-                    (hasDataForRead, readyForWrite, hasError) = select.select( [clientSocket, workerSocket], waitingToWrite, [clientSocket, workerSocket], .3)
-                except KeyboardInterrupt:
-                    break
-
-                if hasError:
-                    break
-            
-                if clientSocket in hasDataForRead:
-                    nextData = clientSocket.recv(bufferSize)
-                    if not nextData:
-                        break
-                    dataFromClient += nextData
-
-                if workerSocket in hasDataForRead:
-                    nextData = workerSocket.recv(bufferSize)
-                    if not nextData:
-                        break
-                    dataToClient += nextData
-            
-                if workerSocket in readyForWrite:
-                    while dataFromClient:
-                        workerSocket.send(dataFromClient[:bufferSize])
-                        dataFromClient = dataFromClient[bufferSize:]
-
-                if clientSocket in readyForWrite:
-                    while dataToClient:
-                        clientSocket.send(dataToClient[:bufferSize])
-                        dataToClient = dataToClient[bufferSize:]
-
-        except Exception as e:
-            logerr('Error on %s:%d: %s\n' %(self.workerAddr, self.workerPort, str(e)))
-
-        self.closeConnectionsAndExit()
-
-
-### load balancer ###
-if __name__ == '__main__':
-    configFilename = None
-    for arg in sys.argv[1:]:
-        if arg == '--help':
-            printUsage(sys.stdout)
-            sys.exit(0)
-        elif arg == '--help-config':
-            printConfigHelp(sys.stdout)
-            sys.exit(0)
-        elif arg == '--version':
-            sys.stdout.write(getVersionStr() + '\n')
-            sys.exit(0)
-        elif configFilename is not None:
-            sys.stderr.write('Too many arguments.\n\n')
-            printUsage(sys.stderr)
-            sys.exit(0)
-        else:
-            configFilename = arg
-
-    if not configFilename:
-        sys.stderr.write('No config file provided\n\n')
-        printUsage(sys.stderr)
-        sys.exit(1)
-
-    pumpkinConfig = PumpkinConfig(configFilename)
-    try:
-        pumpkinConfig.parse()
-    except PumpkinConfigException as configError:
-        sys.stderr.write(str(configError) + '\n\n\n')
-        printConfigHelp()
-        sys.exit(1)
-    except Exception as e:
-        traceback.print_exc(file=sys.stderr)
-        printConfigHelp(sys.stderr)
-        sys.exit(1)
-
-    bufferSize = pumpkinConfig.getOptionValue('buffer_size')
-    logmsg('Configured buffer size = %d bytes\n' %(bufferSize,))
-
-    mappings = pumpkinConfig.getMappings()
-    listeners = []
-    for mappingAddr, mapping in mappings.items():
-        logmsg('Starting up listener on %s:%d with mappings: %s\n' %(mapping.localAddr, mapping.localPort, str(mapping.workers)))
-        listener = PumpkinListener(mapping.localAddr, mapping.localPort, mapping.workers, bufferSize)
-        listener.start()
-        listeners.append(listener)
-
-    globalIsTerminating = False
-
-    def handleSigTerm(*args):
-        global listeners
-        global globalIsTerminating
-#        sys.stderr.write('CALLED\n')
-        if globalIsTerminating is True:
-            return # Already terminating
-        globalIsTerminating = True
-        logerr('Caught signal, shutting down listeners...\n')
-        for listener in listeners:
-            try:
-                os.kill(listener.pid, signal.SIGTERM)
-            except:
-                pass
-        logerr('Sent signal to children, waiting up to 4 seconds then trying to clean up\n')
-        time.sleep(1)
-        startTime = time.time()
-        remainingListeners = listeners
-        remainingListeners2 = []
-        for listener in remainingListeners:
-            logerr('Waiting on %d...\n' %(listener.pid,))
-            listener.join(.05)
-            if listener.is_alive() is True:
-                remainingListeners2.append(listener)
-        remainingListeners = remainingListeners2
-        logerr('Remaining (%d) listeners are: %s\n' %(len(remainingListeners), [listener.pid for listener in remainingListeners]))
-
-        afterJoinTime = time.time()
-
-        if remainingListeners:
-            delta = afterJoinTime - startTime
-            remainingSleep = int(GRACEFUL_SHUTDOWN_TIME - math.floor(afterJoinTime - startTime))
-            if remainingSleep > 0:
-                anyAlive = False
-                # If we still have time left, see if we are just done or if there are children to clean up using remaining time allotment
-                if threading.activeCount() > 1 or len(multiprocessing.active_children()) > 0:
-                    logerr('Listener closed in %1.2f seconds. Waiting up to %d seconds before terminating.\n' %(delta, remainingSleep))
-                    thisThread = threading.current_thread()
-                    for i in range(remainingSleep):
-                        allThreads = threading.enumerate()
-                        anyAlive = False
-                        for thread in allThreads:
-                            if thread is thisThread or thread.name == 'MainThread':
-                                continue
-                            thread.join(.05)
-                            if thread.is_alive() == True:
-                                anyAlive = True
-
-                        allChildren = multiprocessing.active_children()
-                        for child in allChildren:
-                            child.join(.05)
-                            if child.is_alive() == True:
-                                anyAlive = True
-                        if anyAlive is False:
-                            break
-                        time.sleep(1)
-
-                if anyAlive is True:
-                    logerr('Could not kill in time.\n')
-                else:
-                    logerr('Shutdown successful after %1.2f seconds.\n' %( time.time() - startTime))
-
-            else:
-                logerr('Listener timed out in closing, exiting uncleanly.\n')
-                time.sleep(.05) # Why not? :P
-
-        logmsg('exiting...\n')
-        signal.signal(signal.SIGTERM, signal.SIG_DFL)
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        sys.exit(0)
-        os.kill(os.getpid(), signal.SIGTERM)
-        return 0
-    # END handleSigTerm
-
-    signal.signal(signal.SIGTERM, handleSigTerm)
-    signal.signal(signal.SIGINT, handleSigTerm)
-
-    while True:
-        try:
-            time.sleep(2)
-        except:
-            os.kill(os.getpid(), signal.SIGTERM)
+#!/usr/bin/python
+#
+# PumpkinLB Copyright (c) 2014-2015, 2017 Tim Savannah under GPLv3.
+# You should have received a copy of the license as LICENSE 
+#
+# See: https://github.com/kata198/PumpkinLB
+
+import atexit
+import bisect
+import json
+import math
+import multiprocessing
+import multiprocessing.util
+import os
+import platform
+import socket
+import sys
+import signal
+import threading
+import traceback
+import time
+import random
+import struct
+import zlib
+import heapq
+import collections
+import itertools
+import select
+import selectors
+import errno
+from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    from ConfigParser import ConfigParser
+except:
+    from configparser import ConfigParser
+
+### version ###
+pumpkinlb_version = '2.0.0'
+
+### constants ###
+GRACEFUL_SHUTDOWN_TIME = 6
+UPGRADE_TIMEOUT = 10 # Seconds either side of an upgrade (--upgrade) waits on the other before giving up
+ACCEPT_BACKOFF = 1 # Seconds engine=eventloop stops accepting after accept() failed (e.g. out of file descriptors), rather than retrying at once
+POOL_REFILL_INTERVAL = 1 # Seconds between top-ups of the connection pools (pool_size), besides right after a connection was taken
+DEFAULT_BUFFER_SIZE = 4096
+DEFAULT_ENGINE = 'process'
+ENGINES = ('process', 'eventloop')
+DEFAULT_STRATEGY = 'roundrobin'
+STRATEGIES = ('roundrobin', 'leastconn', 'ewma', 'p2c')
+SOCKS_AFFINITIES = ('off', 'hash', 'sticky')
+LOG_ERROR = 0
+LOG_INFO = 1
+LOG_LEVELS = ('error', 'info') # Indexed by LOG_ERROR, LOG_INFO
+DEFAULT_LOG_LEVEL = 'info'
+LOG_FORMATS = ('text', 'json')
+LOG_QUEUE_MAX = 10000 # Lines a process may have waiting for its log writer thread, beyond that they are dropped
+LOG_FLUSH_INTERVAL = .1 # Seconds between batches written by the log writer thread
+
+DEFAULT_OPTIONS = {
+    'pre_resolve_workers' : True,
+    'resolve_ttl'         : 60.0,
+    'buffer_size'         : DEFAULT_BUFFER_SIZE,
+    'engine'              : DEFAULT_ENGINE,
+    'listener_processes'  : 1,
+    'splice'              : 'auto',
+    'health_interval'     : 5.0,
+    'health_timeout'      : 2.0,
+    'health_socks'        : False,
+    'health_rise'         : 2,
+    'health_fall'         : 1,
+    'strategy'            : DEFAULT_STRATEGY,
+    'ewma_alpha'          : 0.3,
+    'connect_timeout'     : 5.0,
+    'connect_retries'     : 2,
+    'race_delay'          : 0.0,
+    'idle_timeout'        : 0.0,
+    'read_timeout'        : 0.0,
+    'pool_size'           : 0,
+    'max_pending'         : 65536,
+    'socks_affinity'      : 'off',
+    'affinity_ttl'        : 300.0,
+    'udpgw_port'          : 0,
+    'udpgw_flow_timeout'  : 60.0,
+    'listen_backlog'      : 128,
+    'max_connections'     : 0,
+    'max_conns'           : 0,
+    'queue_timeout'       : 10.0,
+    'metrics_port'        : 0,
+    'metrics_addr'        : '127.0.0.1',
+    'log_level'           : DEFAULT_LOG_LEVEL,
+    'log_format'          : 'text',
+    'log_sample'          : 1,
+    'upgrade_socket'      : '',
+    'drain_timeout'       : 300.0,
+}
+
+
+### log ###
+class PumpkinLogWriter(object):
+    '''
+        Writes log lines from a background thread, in batches (one write and flush per stream every LOG_FLUSH_INTERVAL),
+          so a relay never blocks on a slow terminal or disk. Queueing a line takes no lock, so signal handlers may log too.
+          Every process has its own writer thread, started on the first line it logs. Lines queued past LOG_QUEUE_MAX
+          are dropped, and the number of dropped lines is logged instead.
+    '''
+
+    def __init__(self):
+        self.level = LOG_LEVELS.index(DEFAULT_LOG_LEVEL)
+        self.jsonFormat = False
+        self.sample = 1
+        self.reset()
+
+    def reset(self):
+        '''
+            reset - Forget the queue and writer thread. Called in a forked child, where the parent's thread does not exist
+              (and whatever it had queued is still the parent's to write).
+        '''
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dropped = 0
+
+    def configure(self, level, logFormat, sample):
+        self.level = LOG_LEVELS.index(level)
+        self.jsonFormat = bool(logFormat == 'json')
+        self.sample = sample
+
+    def shouldSample(self):
+        '''
+            shouldSample - Whether to log a per-connection event, 1 in every "sample" of them (at random,
+              as each PumpkinWorker process only sees its own connection).
+
+            @return <bool>
+        '''
+        return self.sample <= 1 or random.random() * self.sample < 1
+
+    def write(self, fileObj, level, msg):
+        if level > self.level:
+            return
+        if self.thread is None:
+            self.start()
+        if len(self.pending) >= LOG_QUEUE_MAX:
+            self.dropped += 1
+            return
+        self.pending.append( (time.time(), fileObj, level, msg) )
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='PumpkinLogWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        # Whatever is still queued is written on the way out, both by a plain exit and
+        #  by a multiprocessing child (which skips atexit, but runs its finalizers)
+        atexit.register(self.flush)
+        multiprocessing.util.Finalize(None, self.flush, exitpriority=0)
+
+    def run(self):
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        '''
+            flush - Write out everything queued
+        '''
+        with self.lock:
+            batches = {}
+            pending = self.pending
+            while pending:
+                (when, fileObj, level, msg) = pending.popleft()
+                if fileObj not in batches:
+                    batches[fileObj] = []
+                batches[fileObj].append(self.formatLine(when, level, msg))
+
+            if self.dropped:
+                dropped = self.dropped
+                self.dropped = 0
+                if sys.stderr not in batches:
+                    batches[sys.stderr] = []
+                batches[sys.stderr].append(self.formatLine(time.time(), LOG_ERROR, 'Log queue full, dropped %d messages\n' %(dropped,)))
+
+            for fileObj, lines in batches.items():
+                try:
+                    fileObj.write(''.join(lines))
+                    fileObj.flush()
+                except:
+                    pass
+
+    def formatLine(self, when, level, msg):
+        if self.jsonFormat is True:
+            return json.dumps( {'time' : datetime.fromtimestamp(when).isoformat(), 'level' : LOG_LEVELS[level], 'pid' : os.getpid(), 'msg' : msg.rstrip('\n')} ) + '\n'
+        if msg[-1] != '\n':
+            msg += '\n'
+        return "[ %s ] %s" %(datetime.fromtimestamp(when).ctime(), msg)
+
+logWriter = PumpkinLogWriter()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=logWriter.reset)
+
+def configureLog(options):
+    '''
+        configureLog - Apply the log_level, log_format and log_sample options
+    '''
+    logWriter.configure(options['log_level'], options['log_format'], options['log_sample'])
+
+def logit(fileObj, msg, level=None):
+    if level is None:
+        level = LOG_ERROR if fileObj is sys.stderr else LOG_INFO
+    logWriter.write(fileObj, level, msg)
+
+def logmsg(msg):
+    logit(sys.stdout, msg, LOG_INFO)
+
+def logerr(msg):
+    logit(sys.stderr, msg, LOG_ERROR)
+
+def logconn(msg, isError=False):
+    '''
+        logconn - Log an event of a single connection (connect failures, failovers, timeouts). Only 1 in log_sample
+          of these is logged, so a busy data plane doesn't drown the log.
+    '''
+    if logWriter.shouldSample():
+        if isError is True:
+            logerr(msg)
+        else:
+            logmsg(msg)
+
+
+### usage ###
+def printUsage(toStream=sys.stdout):
+    toStream.write('''Usage: %s [--upgrade] [config file]
+Starts Pumpkin Load Balancer using the given config file.
+
+  Arguments:
+
+    --help                         Print this message
+    --help-config                  Print help regarding usage of the config file
+    --version                      Show version information
+    --upgrade                      Take over the listening sockets of the PumpkinLB running with the same upgrade_socket,
+                                     which then stops accepting and drains. No connection is refused or reset meanwhile.
+
+  Signals:
+
+    SIGTERM                        Performs a graceful shutdown
+    SIGHUP                         Re-read the config and apply changes to [mappings]: listeners are started and stopped, and
+                                     running listeners switch to their new worker list. Established connections are not dropped,
+                                     connections to removed workers drain on their own. Changes to [options] need a restart.
+    SIGUSR1                        Health-probe every worker right away (e.g. when bin/supervisor.py saw a tunnel go up or down),
+                                     instead of at the next health_interval
+    SIGUSR2                        Log per-worker counters (connections, latencies, failovers)
+    SIGQUIT                        Stop accepting, and exit once the connections being relayed are done (or drain_timeout passed)
+
+%s
+''' %(os.path.basename(sys.argv[0]), getVersionStr())
+    )
+
+def printConfigHelp(toStream=sys.stdout):
+    toStream.write('''Config Help
+
+Config file is broken up into sections, definable by [$SectionName], followed by variables in format of key=value.
+
+  Sections:
+
+    [options]
+      pre_resolve_workers=0/1                     [Default 1]    Any workers defined with a hostname will be evaluated at the time the config is read,
+                                                                   and skipped if they do not resolve. With 0 they are kept, and used once they resolve.
+      resolve_ttl=N                             [Default 60]   Seconds between background lookups of workers defined with a hostname. Connects use the
+                                                                   cached addresses (rotating through all A/AAAA records), never waiting on DNS.
+                                                                   If a lookup fails, the last addresses that resolved stay in use.
+
+      buffer_size=N                             [Default %d]   Default read/write buffer size (in bytes) used on socket operations. 4096 is a good default for most, but you may be able to tune better depending on your application.
+      max_pending=N                             [Default 65536] (process engine) Bytes buffered per direction of a connection, waiting for the receiving side to take them.
+                                                                   Reading from the sending side pauses while they are buffered, so a slow client never makes
+                                                                   the relay grow. The eventloop engine buffers at most buffer_size bytes per direction.
+
+      engine=process/eventloop                  [Default %s] How client connections are relayed to workers.
+                                                                   "process" forks a new process for every accepted connection.
+                                                                   "eventloop" serves every connection of a listener from a single selectors loop
+                                                                     inside the listener process, so a connection costs a few KB instead of a process.
+
+      listener_processes=N                      [Default 1]    Number of listener processes started for every mapping. When > 1, each binds the same
+                                                                   address with SO_REUSEPORT so the kernel spreads accepts (and their relays) across cores.
+
+      splice=auto/0/1                           [Default auto] (eventloop engine) Move relayed data from socket to socket with splice(2) through a
+                                                                   kernel pipe, so the payload is never copied into Python. "auto" uses it where os.splice exists
+                                                                   (Linux, Python 3.10+). Otherwise each direction uses a preallocated ring buffer of buffer_size bytes.
+
+      health_interval=N                         [Default 5]    Seconds between active health probes of every worker. 0 disables probing.
+                                                                   Workers that fail probes are taken out of rotation until they pass again.
+      health_timeout=N                          [Default 2]    Seconds a probe may take before the worker counts as failed.
+      health_socks=0/1                          [Default 0]    Also perform a SOCKS5 greeting (no authentication) as part of the probe,
+                                                                   instead of only a TCP connect. Use this when the workers are SOCKS5 proxies (ssh -D).
+      health_fall=N                             [Default 1]    Consecutive failed probes before a worker is taken out of rotation.
+      health_rise=N                             [Default 2]    Consecutive successful probes before a down worker is put back in rotation.
+
+      strategy=roundrobin/leastconn/ewma/p2c    [Default %s] How the worker for a new client is chosen among the healthy ones.
+                                                                   "roundrobin" rotates through the workers in order.
+                                                                   "leastconn" picks the worker with the fewest active connections.
+                                                                   "ewma" picks the lowest (smoothed connect + first byte latency) x (active connections + 1).
+                                                                   "p2c" picks two workers at random and keeps the one scoring lower, as in "ewma".
+      ewma_alpha=N                              [Default 0.3]  Weight (0 < N <= 1) of each new latency sample in the smoothed latencies.
+
+      connect_timeout=N                         [Default 5]    Seconds to wait for a connect to a worker before failing over to the next one. 0 waits forever.
+      connect_retries=N                         [Default 2]    How many other workers a client is failed over to, right away and without a new process,
+                                                                   when connecting to its worker fails. Each worker is tried at most once per client.
+      race_delay=N                              [Default 0]    Race connects (as in happy eyeballs): when the connect to a client's worker has not completed
+                                                                   within N seconds, also start one to the next worker it would fail over to, and so on
+                                                                   every N seconds, through the same connect_retries workers. A failed connect starts the next
+                                                                   one right away. The first to complete is used and the others are closed. 0 connects to one
+                                                                   worker at a time. Races each worker took part in, and won, are counted (SIGUSR2, metrics).
+      idle_timeout=N                            [Default 0]    Close connections that moved no data either way for N seconds. 0 never does.
+      read_timeout=N                            [Default 0]    Close connections whose worker sent nothing back within N seconds of connecting. 0 waits forever.
+      pool_size=N                               [Default 0]    Connections each listener process keeps open to every healthy worker ahead of time, topped up
+                                                                   in the background. A new client is paired with one of them right away instead of waiting
+                                                                   on a connect. Pooled connections of a worker taken out of rotation are closed. 0 disables.
+
+      listen_backlog=N                          [Default 128]  Backlog of the listening sockets: connections the kernel completes and holds until they are accepted.
+      max_connections=N                         [Default 0]    Client connections a listener process serves at once. Beyond that no more are accepted
+                                                                   (they wait in the backlog, then are refused by the kernel). 0 is unlimited.
+                                                                   With engine=process, this bounds the number of forked PumpkinWorker processes.
+      max_conns=N                               [Default 0]    Connections a listener process relays to any one worker at once. 0 is unlimited.
+      queue_timeout=N                           [Default 10]   Seconds an accepted client waits for a slot when every worker is at max_conns, before
+                                                                   it is disconnected. 0 disconnects it right away.
+
+      socks_affinity=off/hash/sticky            [Default off]  (eventloop engine) Clients and workers speak SOCKS5: the listener answers the client's greeting
+                                                                   itself, reads its CONNECT request, picks the worker from the destination host:port,
+                                                                   then replays the handshake to that worker. Connections to the same destination
+                                                                   thereby share a tunnel (and exit IP).
+                                                                   "hash" uses rendezvous hashing over the healthy workers, so only the destinations of a
+                                                                   worker that goes down move elsewhere.
+                                                                   "sticky" remembers the worker chosen (by strategy) for each destination for affinity_ttl seconds.
+      affinity_ttl=N                            [Default 300]  Seconds a "sticky" destination stays bound to its worker after its last connection.
+      udpgw_port=N                              [Default 0]    (eventloop engine) Clients and workers speak SOCKS5, and a client's CONNECT to this port opens a udpgw
+                                                                   connection (badvpn-tun2socks --udpgw-remote-server-addr, to badvpn-udpgw behind the SSH server).
+                                                                   Instead of relaying it to a single worker, the listener answers it itself and spreads its
+                                                                   UDP flows over the workers: each flow goes to the worker chosen by rendezvous hashing of
+                                                                   (client, flow id, remote address), through one udpgw connection per worker. 0 disables.
+      udpgw_flow_timeout=N                      [Default 60]   Seconds a UDP flow stays bound to its worker after its last datagram either way.
+
+      metrics_port=N                            [Default 0]    Serve Prometheus metrics over HTTP on this port (at /metrics), summed across the listener processes
+                                                                   of each mapping: accepted clients, failovers, accept queue depth, and per worker active connections,
+                                                                   bytes each way, connect failures and a connect latency histogram. 0 disables.
+                                                                   With engine=process, bytes are counted when each connection closes.
+      metrics_addr=addr                         [Default 127.0.0.1] Address the metrics listener binds to.
+
+      upgrade_socket=path                       [Default none] Unix socket on which this PumpkinLB hands its listening sockets over to a new one,
+                                                                   started with --upgrade (e.g. after an update, or to apply [options]). The new
+                                                                   process accepts on the very same sockets, so clients never see the port closed.
+      drain_timeout=N                           [Default 300]  Seconds the connections of a draining PumpkinLB (upgraded, or sent SIGQUIT) may take to
+                                                                   finish on their own, before they are closed. 0 waits forever.
+
+      log_level=error/info                      [Default %s] "error" only logs errors and warnings (to stderr). "info" also logs progress (to stdout).
+      log_format=text/json                      [Default text] "json" writes each line as an object with "time", "level", "pid" and "msg".
+      log_sample=N                              [Default 1]    Log only 1 in N (at random) of the events of single connections: connect failures, failovers,
+                                                                   timeouts and dropped clients. Other messages are always logged.
+                                                                   Lines are written in batches by a background thread of each process, never by the relay itself.
+
+    [mappings]
+      localaddr:inport=worker1:port,worker2:port...              Listen on interface defined by "localaddr" on port "inport". Farm out to worker addresses and ports. Ex: 192.168.1.100:80=10.10.0.1:5900,10.10.0.2:5900
+        or
+      inport=worker1:port,worker2:port...                        Listen on all interfaces on port "inport", and farm out to worker addresses with given ports. Ex: 80=10.10.0.1:5900,10.10.0.2:5900
+
+''' %(DEFAULT_BUFFER_SIZE, DEFAULT_ENGINE, DEFAULT_STRATEGY, DEFAULT_LOG_LEVEL)
+    )
+
+def getVersionStr():
+    return 'PumpkinLB Version %s (c) 2014-2015 Timothy Savannah GPLv3' %(pumpkinlb_version,)
+
+
+### config ###
+class PumpkinMapping(object):
+    '''
+        Represents a mapping of a local listen to a series of workers
+    '''
+    def __init__(self, localAddr, localPort, workers):
+        self.localAddr = localAddr or ''
+        self.localPort = int(localPort)
+        self.workers = workers
+
+    def getListenerArgs(self):
+        return [self.localAddr, self.localPort, self.workers]
+
+    def addWorker(self, workerAddr, workerPort):
+        self.workers.append( {'port' : int(workerPort), 'addr' : workerAddr} )
+
+    def removeWorker(self, workerAddr, workerPort):
+        newWorkers = []
+        workerPort = int(workerPort)
+        removedWorker = None
+        for worker in self.workers:
+            if worker['addr'] == workerAddr and worker['port'] == workerPort:
+                removedWorker = worker
+                continue
+            newWorkers.append(worker)
+        self.workers = newWorkers
+        return removedWorker
+
+class PumpkinConfig(ConfigParser):
+    '''
+        The class for managing Pumpkin's Config File
+    '''
+    def __init__(self, configFilename):
+        ConfigParser.__init__(self)
+        self.configFilename = configFilename
+
+        self._options = dict(DEFAULT_OPTIONS)
+        self._mappings = {}
+
+    def parse(self):
+        '''
+            Parse the config file
+        '''
+        try:
+            f = open(self.configFilename, 'rt')
+        except IOError as e:
+            logerr('Could not open config file: "%s": %s\n' %(self.configFilename, str(e)))
+            raise e
+        [self.remove_section(s) for s in self.sections()]
+        self.read_file(f)
+        f.close()
+
+        self._processOptions()
+        self._processMappings()
+
+    def getOptions(self):
+        '''
+            Gets the options dictionary
+        '''
+        return self._options
+
+    def getOptionValue(self, optionName):
+        '''
+            getOptionValue - Gets the value of an option
+        '''
+        return self._options[optionName]
+
+    def getMappings(self):
+        '''
+            Gets the mappings dictionary
+        '''
+        return self._mappings
+
+    def _processOptions(self):
+        # I personally think the config parser interface sucks...
+        if 'options' not in self._sections:
+            return
+
+        try:
+            preResolveWorkers = self.get('options', 'pre_resolve_workers')
+            if preResolveWorkers == '1' or preResolveWorkers.lower() == 'true':
+                self._options['pre_resolve_workers'] = True
+            elif preResolveWorkers == '0' or preResolveWorkers.lower() == 'false':
+                self._options['pre_resolve_workers'] = False
+            else:
+                logerr('WARNING: Unknown value for [options] -> pre_resolve_workers "%s" -- ignoring value, retaining previous "%s"\n' %(str(preResolveWorkers), str(self._options['pre_resolve_workers'])) )
+        except:
+            pass
+
+        try:
+            bufferSize = self.get('options', 'buffer_size')
+            if bufferSize.isdigit() and int(bufferSize) > 0:
+                self._options['buffer_size'] = int(bufferSize)
+            else:
+                logerr('WARNING: buffer_size must be an integer > 0 (bytes). Got "%s" -- ignoring value, retaining previous "%s"\n' %(bufferSize, str(self._options['buffer_size'])) )
+        except Exception as e:
+            logerr('Error parsing [options]->buffer_size : %s. Retaining default, %s\n' %(str(e),str(DEFAULT_BUFFER_SIZE)) )
+
+        try:
+            engine = self.get('options', 'engine').strip().lower()
+            if engine in ENGINES:
+                self._options['engine'] = engine
+            else:
+                logerr('WARNING: Unknown value for [options] -> engine "%s" (expected one of %s) -- ignoring value, retaining previous "%s"\n' %(engine, ', '.join(ENGINES), self._options['engine']) )
+        except:
+            pass
+
+        self._processNumberOption('resolve_ttl', float, 1)
+        self._processNumberOption('listener_processes', int, 1)
+        if self._options['listener_processes'] > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            logerr('WARNING: listener_processes=%d requires SO_REUSEPORT, which this platform lacks -- using 1\n' %(self._options['listener_processes'],))
+            self._options['listener_processes'] = 1
+
+        try:
+            useSplice = self.get('options', 'splice').strip().lower()
+            if useSplice == 'auto':
+                self._options['splice'] = 'auto'
+            elif useSplice == '1' or useSplice == 'true':
+                if spliceSupported():
+                    self._options['splice'] = True
+                else:
+                    logerr('WARNING: [options] -> splice=1 but os.splice is not available here -- using buffered relays\n')
+                    self._options['splice'] = False
+            elif useSplice == '0' or useSplice == 'false':
+                self._options['splice'] = False
+            else:
+                logerr('WARNING: Unknown value for [options] -> splice "%s" -- ignoring value, retaining previous "%s"\n' %(useSplice, str(self._options['splice'])) )
+        except:
+            pass
+
+        self._processNumberOption('health_interval', float, 0)
+        self._processNumberOption('health_timeout', float, .01)
+        self._processBoolOption('health_socks')
+        self._processNumberOption('health_rise', int, 1)
+        self._processNumberOption('health_fall', int, 1)
+
+        if self.has_option('options', 'strategy'):
+            strategy = self.get('options', 'strategy').strip().lower()
+            if strategy in STRATEGIES:
+                self._options['strategy'] = strategy
+            else:
+                logerr('WARNING: Unknown value for [options] -> strategy "%s" (expected one of %s) -- ignoring value, retaining previous "%s"\n' %(strategy, ', '.join(STRATEGIES), self._options['strategy']) )
+
+        self._processNumberOption('connect_timeout', float, 0)
+        self._processNumberOption('connect_retries', int, 0)
+        self._processNumberOption('race_delay', float, 0)
+        self._processNumberOption('idle_timeout', float, 0)
+        self._processNumberOption('read_timeout', float, 0)
+        self._processNumberOption('pool_size', int, 0)
+        self._processNumberOption('max_pending', int, 1)
+
+        if self.has_option('options', 'socks_affinity'):
+            socksAffinity = self.get('options', 'socks_affinity').strip().lower()
+            if socksAffinity in SOCKS_AFFINITIES:
+                self._options['socks_affinity'] = socksAffinity
+            else:
+                logerr('WARNING: Unknown value for [options] -> socks_affinity "%s" (expected one of %s) -- ignoring value, retaining previous "%s"\n' %(socksAffinity, ', '.join(SOCKS_AFFINITIES), self._options['socks_affinity']) )
+        if self._options['socks_affinity'] != 'off' and self._options['engine'] != 'eventloop':
+            logerr('WARNING: socks_affinity requires engine=eventloop -- ignoring\n')
+            self._options['socks_affinity'] = 'off'
+        self._processNumberOption('affinity_ttl', float, 1)
+        self._processNumberOption('udpgw_port', int, 0)
+        if self._options['udpgw_port'] and self._options['engine'] != 'eventloop':
+            logerr('WARNING: udpgw_port requires engine=eventloop -- ignoring\n')
+            self._options['udpgw_port'] = 0
+        self._processNumberOption('udpgw_flow_timeout', float, 1)
+
+        self._processNumberOption('listen_backlog', int, 1)
+        self._processNumberOption('max_connections', int, 0)
+        self._processNumberOption('max_conns', int, 0)
+        self._processNumberOption('queue_timeout', float, 0)
+
+        self._processNumberOption('metrics_port', int, 0)
+        if self.has_option('options', 'metrics_addr'):
+            self._options['metrics_addr'] = self.get('options', 'metrics_addr').strip()
+
+        for (optionName, choices) in ( ('log_level', LOG_LEVELS), ('log_format', LOG_FORMATS) ):
+            if self.has_option('options', optionName):
+                value = self.get('options', optionName).strip().lower()
+                if value in choices:
+                    self._options[optionName] = value
+                else:
+                    logerr('WARNING: Unknown value for [options] -> %s "%s" (expected one of %s) -- ignoring value, retaining previous "%s"\n' %(optionName, value, ', '.join(choices), self._options[optionName]) )
+        self._processNumberOption('log_sample', int, 1)
+
+        if self.has_option('options', 'upgrade_socket'):
+            self._options['upgrade_socket'] = self.get('options', 'upgrade_socket').strip()
+        self._processNumberOption('drain_timeout', float, 0)
+
+        self._processNumberOption('ewma_alpha', float, .01)
+        if self._options['ewma_alpha'] > 1:
+            logerr('WARNING: ewma_alpha must be <= 1. Got "%s" -- using 1\n' %(str(self._options['ewma_alpha']),))
+            self._options['ewma_alpha'] = 1.0
+
+    def _processBoolOption(self, optionName):
+        '''
+            _processBoolOption - Read a 0/1/true/false option from [options], if present
+        '''
+        if not self.has_option('options', optionName):
+            return
+        value = self.get('options', optionName).strip().lower()
+        if value == '1' or value == 'true':
+            self._options[optionName] = True
+        elif value == '0' or value == 'false':
+            self._options[optionName] = False
+        else:
+            logerr('WARNING: Unknown value for [options] -> %s "%s" -- ignoring value, retaining previous "%s"\n' %(optionName, value, str(self._options[optionName])) )
+
+    def _processNumberOption(self, optionName, numberType, minimum):
+        '''
+            _processNumberOption - Read a numeric option (of type numberType, at least minimum) from [options], if present
+        '''
+        if not self.has_option('options', optionName):
+            return
+        value = self.get('options', optionName).strip()
+        try:
+            number = numberType(value)
+        except ValueError:
+            number = None
+        if number is None or number < minimum:
+            logerr('WARNING: %s must be a number >= %s. Got "%s" -- ignoring value, retaining previous "%s"\n' %(optionName, str(minimum), value, str(self._options[optionName])) )
+            return
+        self._options[optionName] = number
+
+    def _processMappings(self):
+
+        if 'mappings' not in self._sections:
+            raise PumpkinConfigException('ERROR: Config is missing required "mappings" section.\n')
+
+        preResolveWorkers = self._options['pre_resolve_workers']
+
+        mappings = {}
+        mappingSectionItems = self.items('mappings')
+        
+        for (addrPort, workers) in mappingSectionItems:
+            addrPortSplit = addrPort.split(':')
+            addrPortSplitLen = len(addrPortSplit)
+            if not workers:
+                logerr('WARNING: Skipping, no workers defined for %s\n' %(addrPort,))
+                continue
+            if addrPortSplitLen == 1:
+                (localAddr, localPort) = ('0.0.0.0', addrPort)
+            elif addrPortSplitLen == 2:
+                (localAddr, localPort) = addrPortSplit
+            else:
+                logerr('WARNING: Skipping Invalid mapping: %s=%s\n' %(addrPort, workers))
+                continue
+            try:
+                localPort = int(localPort)
+            except ValueError:
+                logerr('WARNING: Skipping Invalid mapping, cannot convert port: %s\n' %(addrPort,))
+                continue
+
+            workerLst = []
+            for worker in workers.split(','):
+                workerSplit = worker.split(':')
+                if len(workerSplit) != 2 or len(workerSplit[0]) < 3 or len(workerSplit[1]) == 0:
+                    logerr('WARNING: Skipping Invalid Worker %s\n' %(worker,))
+                    continue
+
+                # Hostnames are kept, and resolved (and refreshed) by each listener's PumpkinResolver
+                addr = workerSplit[0]
+                if preResolveWorkers is True and isIpAddress(addr) is False:
+                    try:
+                        socket.getaddrinfo(addr, None, 0, socket.SOCK_STREAM)
+                    except:
+                        logerr('WARNING: Skipping Worker, could not resolve %s\n' %(workerSplit[0],))
+                        continue
+                try:
+                    port = int(workerSplit[1])
+                except ValueError:
+                    logerr('WARNING: Skipping worker, could not parse port %s\n' %(workerSplit[1],))
+                    continue
+
+                workerLst.append({'addr' : addr, 'port' : port})
+
+            keyName = "%s:%s" %(localAddr, addrPort)
+            if keyName in mappings:
+                logerr('WARNING: Overriding existing mapping of %s with %s\n' %(addrPort, str(workerLst)))
+            mappings[addrPort] = PumpkinMapping(localAddr, localPort, workerLst)
+
+        self._mappings = mappings
+
+class PumpkinConfigException(Exception):
+    pass
+
+
+### backends ###
+def isIpAddress(addr):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, addr)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+def addressFamily(addr):
+    return ':' in addr and socket.AF_INET6 or socket.AF_INET
+
+
+class PumpkinBackend(object):
+    '''
+        Runtime state of a single worker, as seen by one listener process
+    '''
+    def __init__(self, addr, port):
+        self.addr = addr
+        self.port = port
+        self.healthy = True        # False while taken out of rotation by the health checker
+        self.probeSuccesses = 0    # Consecutive successful health probes
+        self.probeFailures = 0     # Consecutive failed health probes (or connects)
+        self.activeConns = 0       # Connections currently relayed to this backend by this listener
+        self.ewmaConnect = None    # Smoothed connect latency, in seconds (None until the first sample)
+        self.ewmaFirstByte = None  # Smoothed time from starting the connect to the first byte back, in seconds
+        self.connectFailures = 0   # Total failed connects (including timeouts)
+        self.failoversIn = 0       # Clients that landed here after failing to connect elsewhere
+        self.raceAttempts = 0      # Connects to this backend that raced others (race_delay)
+        self.raceWins = 0          # Races it won
+        self.hashKey = ('%s:%d|' %(addr, port)).encode('utf-8') # Identifies this backend in socks_affinity=hash
+        self.stats = None          # Block of this backend in the listener's PumpkinMetrics
+        self.addresses = isIpAddress(addr) and [addr] or [] # IP addresses connected to, kept current by PumpkinResolver when addr is a hostname
+        self.addressIdx = 0
+
+    def nextAddress(self):
+        '''
+            nextAddress - Returns the IP address to connect to, rotating through all those addr resolved to
+
+              @return <str/None> - None if addr has not resolved (yet)
+        '''
+        addresses = self.addresses
+        if not addresses:
+            return None
+        self.addressIdx += 1
+        return addresses[self.addressIdx % len(addresses)]
+
+    def connectionOpened(self):
+        self.activeConns += 1
+        self.stats[PumpkinMetrics.OPENED] += 1
+
+    def connectionClosed(self):
+        self.activeConns -= 1
+        self.stats[PumpkinMetrics.CLOSED] += 1
+
+    def recordConnectFailure(self):
+        self.connectFailures += 1
+        self.stats[PumpkinMetrics.CONNECT_FAILURES] += 1
+
+    def recordRace(self, won):
+        if won is True:
+            self.raceWins += 1
+            self.stats[PumpkinMetrics.RACE_WINS] += 1
+        self.raceAttempts += 1
+        self.stats[PumpkinMetrics.RACE_ATTEMPTS] += 1
+
+    def recordConnect(self, latency, alpha):
+        stats = self.stats
+        stats[PumpkinMetrics.LATENCY_SUM] += latency
+        stats[PumpkinMetrics.LATENCY_COUNT] += 1
+        stats[PumpkinMetrics.LATENCY_BUCKET + bisect.bisect_left(PumpkinMetrics.LATENCY_BUCKETS, latency)] += 1
+        if self.ewmaConnect is None:
+            self.ewmaConnect = latency
+        else:
+            self.ewmaConnect += alpha * (latency - self.ewmaConnect)
+
+    def recordFirstByte(self, latency, alpha):
+        if self.ewmaFirstByte is None:
+            self.ewmaFirstByte = latency
+        else:
+            self.ewmaFirstByte += alpha * (latency - self.ewmaFirstByte)
+
+    def cost(self):
+        '''
+            cost - Expected latency scaled by load, lower is better. Used by the "ewma" and "p2c" strategies.
+        '''
+        latency = (self.ewmaConnect or 0) + (self.ewmaFirstByte or 0) + .001 # Floor, so that load still counts before any samples
+        return latency * (self.activeConns + 1)
+
+    def __str__(self):
+        return '%s:%d' %(self.addr, self.port)
+
+    def __repr__(self):
+        return 'PumpkinBackend(%s)' %(str(self),)
+
+
+class PumpkinResolver(threading.Thread):
+    '''
+        Resolves the workers of a listener that are defined by hostname, every resolve_ttl seconds, from a background thread.
+
+        Each lookup replaces backend.addresses in a single assignment. A failed lookup keeps the previous addresses (last known good).
+    '''
+    def __init__(self, listener):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.ttl = listener.options['resolve_ttl']
+        self.wake = threading.Event() # Set to refresh right away, e.g. when a reload added workers
+        self.failing = {}             # str(backend) -> error of its last lookup, so a lasting failure is only logged once
+
+    def run(self):
+        listener = self.listener
+        while listener.keepGoing is True:
+            self.wake.wait(self.ttl)
+            self.wake.clear()
+            self.resolveAll()
+
+    def resolveAll(self):
+        for backend in self.listener.backends[:]:
+            if isIpAddress(backend.addr) is False:
+                self.resolve(backend)
+
+    def resolve(self, backend):
+        try:
+            addrInfos = socket.getaddrinfo(backend.addr, backend.port, 0, socket.SOCK_STREAM)
+        except Exception as e:
+            if self.failing.get(str(backend)) == str(e):
+                return
+            self.failing[str(backend)] = str(e)
+            if backend.addresses:
+                logerr('Could not resolve worker %s (%s), still using %s\n' %(str(backend), str(e), ', '.join(backend.addresses)))
+            else:
+                logerr('Could not resolve worker %s: %s\n' %(str(backend), str(e)))
+            return
+
+        self.failing.pop(str(backend), None)
+        addresses = []
+        for addrInfo in addrInfos:
+            if addrInfo[4][0] not in addresses:
+                addresses.append(addrInfo[4][0])
+        if addresses != backend.addresses:
+            logmsg('Worker %s resolves to %s\n' %(str(backend), ', '.join(addresses)))
+            backend.addresses = addresses
+
+
+class PumpkinMetrics(object):
+    '''
+        Counters of one listener process, exported by the main process on [options] metrics_port.
+
+        When shared, the counters live in a shared memory array written only by the listener process owning it,
+          so counting is a plain increment with no locking. Gauges are derived from counters (active = opened - closed).
+    '''
+    # Listener block, first in the array
+    ACCEPTED = 0
+    FAILOVERS = 1
+    FAILOVERS_EXHAUSTED = 2
+    SHED = 3             # Clients disconnected after queue_timeout, every worker being at max_conns
+    LISTENER_FIELDS = 4
+
+    # One block per backend, at the slot assigned to it by assignSlots
+    OPENED = 0
+    CLOSED = 1
+    BYTES_SENT = 2       # From clients to the backend
+    BYTES_RECEIVED = 3   # From the backend to clients
+    CONNECT_FAILURES = 4
+    LATENCY_SUM = 5
+    LATENCY_COUNT = 6
+    RACE_ATTEMPTS = 7    # Connects that raced connects to other backends (race_delay)
+    RACE_WINS = 8
+    LATENCY_BUCKET = 9   # First of the connect latency histogram buckets, one per LATENCY_BUCKETS plus +Inf
+    LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+    BACKEND_FIELDS = LATENCY_BUCKET + len(LATENCY_BUCKETS) + 1
+
+    def __init__(self, workers, shared=True):
+        self.capacity = max(16, len(workers) * 2) # Backend blocks, leaving room for workers added by reloads
+        size = self.LISTENER_FIELDS + self.capacity * self.BACKEND_FIELDS
+        if shared is True:
+            self.array = multiprocessing.RawArray('d', size)
+            self.values = memoryview(self.array).cast('B').cast('d')
+        else:
+            self.array = None
+            self.values = memoryview(bytearray(size * 8)).cast('d')
+        self.slots = {}   # 'addr:port' -> backend block, in the order the workers were first seen
+        self.assignSlots(workers)
+
+    def assignSlots(self, workers):
+        '''
+            assignSlots - Give every worker not seen before the next block. The main process and the listener process
+              do this on the same worker lists in the same order, so they agree on the layout without talking to each other.
+        '''
+        for workerInfo in workers:
+            key = '%s:%d' %(workerInfo['addr'], workerInfo['port'])
+            if key not in self.slots:
+                self.slots[key] = len(self.slots)
+
+    def listenerStats(self):
+        return self.values[0:self.LISTENER_FIELDS]
+
+    def backendStats(self, slot):
+        if slot >= self.capacity:
+            # Out of blocks: still counted (the hot path expects somewhere to count), but not exported
+            return memoryview(bytearray(self.BACKEND_FIELDS * 8)).cast('d')
+        start = self.LISTENER_FIELDS + slot * self.BACKEND_FIELDS
+        return self.values[start:start + self.BACKEND_FIELDS]
+
+    def statsFor(self, backend):
+        return self.backendStats(self.slots[str(backend)])
+
+    def attach(self, listener):
+        '''
+            attach - Point a listener and its backends at their blocks. Connections a previous (dead) listener process
+              left open on these counters are counted closed.
+        '''
+        listener.stats = self.listenerStats()
+        for slot in range(min(len(self.slots), self.capacity)):
+            stats = self.backendStats(slot)
+            stats[self.CLOSED] = stats[self.OPENED]
+        for backend in listener.backends:
+            backend.stats = self.statsFor(backend)
+
+
+class PumpkinHealthChecker(threading.Thread):
+    '''
+        Actively probes every backend of a listener each health_interval seconds, with a TCP connect and optionally a SOCKS5 greeting.
+
+        Backends are taken out of rotation after health_fall consecutive failures, and put back after health_rise consecutive successes.
+          All backends are probed concurrently from this one thread.
+    '''
+    SOCKS5_GREETING = b'\x05\x01\x00' # Version 5, one method offered: no authentication
+
+    def __init__(self, listener):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        options = listener.options
+        self.interval = options['health_interval']
+        self.timeout = options['health_timeout']
+        self.socksHandshake = options['health_socks']
+        self.rise = options['health_rise']
+        self.fall = options['health_fall']
+        self.lock = threading.Lock() # Results are also recorded from the relay side, on failed connects
+        self.wake = threading.Event() # Set to probe right away (SIGUSR1)
+
+    def run(self):
+        listener = self.listener
+        extraRounds = 0 # Rounds left to run back to back after a wake, so a change gets past health_rise/health_fall right away
+        while listener.keepGoing is True:
+            startTime = time.time()
+            try:
+                self.probeAll(listener.backends[:])
+            except Exception as e:
+                logerr('Health check on %s:%d failed: %s\n' %(listener.localAddr, listener.localPort, str(e)))
+            remainingSleep = self.interval - (time.time() - startTime)
+            if extraRounds > 0:
+                extraRounds -= 1
+                remainingSleep = min(remainingSleep, .1)
+            if self.wake.wait(max(remainingSleep, 0)):
+                self.wake.clear()
+                extraRounds = max(self.rise, self.fall) - 1
+
+    def probeAll(self, backends):
+        selector = selectors.DefaultSelector()
+        probes = {} # socket -> backend
+        try:
+            for backend in backends:
+                addr = backend.nextAddress()
+                if addr is None:
+                    self.recordResult(backend, False, 'not resolved')
+                    continue
+                sock = socket.socket(addressFamily(addr), socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex( (addr, backend.port) )
+                except Exception as e:
+                    err = str(e)
+                if err not in (0, errno.EINPROGRESS):
+                    sock.close()
+                    self.recordResult(backend, False, isinstance(err, int) and os.strerror(err) or err)
+                    continue
+                probes[sock] = backend
+                selector.register(sock, selectors.EVENT_WRITE, backend)
+
+            deadline = time.time() + self.timeout
+            while probes:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                for (key, events) in selector.select(remaining):
+                    sock = key.fileobj
+                    result = self.advanceProbe(sock, events)
+                    if result is None:
+                        # Greeting sent, wait for the reply
+                        selector.modify(sock, selectors.EVENT_READ, key.data)
+                        continue
+                    selector.unregister(sock)
+                    sock.close()
+                    del probes[sock]
+                    self.recordResult(key.data, *result)
+
+            for backend in probes.values():
+                self.recordResult(backend, False, 'timed out after %g seconds' %(self.timeout,))
+        finally:
+            for sock in probes:
+                sock.close()
+            selector.close()
+
+    def advanceProbe(self, sock, events):
+        '''
+            advanceProbe - Move a probe forward after its socket became ready.
+
+              @return <tuple/None> - (ok, reason) once the probe has a result, None while waiting on the SOCKS5 reply
+        '''
+        try:
+            if events & selectors.EVENT_WRITE:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    return (False, os.strerror(err))
+                if self.socksHandshake is False:
+                    return (True, None)
+                sock.send(self.SOCKS5_GREETING)
+                return None
+
+            reply = sock.recv(2)
+            if reply == b'\x05\x00':
+                return (True, None)
+            return (False, 'unexpected SOCKS5 greeting reply %r' %(reply,))
+        except Exception as e:
+            return (False, str(e))
+
+    def recordResult(self, backend, ok, reason=None):
+        with self.lock:
+            if ok is True:
+                backend.probeFailures = 0
+                backend.probeSuccesses += 1
+                if backend.healthy is False and backend.probeSuccesses >= self.rise:
+                    backend.healthy = True
+                    logmsg('Worker %s is healthy again, returning it to rotation on %s:%d\n' %(str(backend), self.listener.localAddr, self.listener.localPort))
+            else:
+                backend.probeSuccesses = 0
+                backend.probeFailures += 1
+                if backend.healthy is True and backend.probeFailures >= self.fall:
+                    backend.healthy = False
+                    logerr('Worker %s failed health check (%s), taking it out of rotation on %s:%d\n' %(str(backend), reason, self.listener.localAddr, self.listener.localPort))
+
+
+class PumpkinConnectionPool(threading.Thread):
+    '''
+        Keeps pool_size connections to every healthy backend of a listener open ahead of time, topped up from a background thread,
+          so a new client can be paired with a worker right away instead of waiting on a connect.
+
+        Connections to backends the health checker took out of rotation, or that were removed on reload, are closed.
+          A connection is checked to still be open when it is taken.
+    '''
+    def __init__(self, listener):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.listener = listener
+        self.size = listener.options['pool_size']
+        self.timeout = listener.connectTimeout
+        self.pools = {}               # backend -> deque of (socket, address, connect latency)
+        self.wake = threading.Event() # Set when a connection was taken, to top up right away
+
+    def run(self):
+        listener = self.listener
+        while listener.keepGoing is True:
+            try:
+                self.refill()
+            except Exception as e:
+                logerr('Connection pool on %s:%d failed: %s\n' %(listener.localAddr, listener.localPort, str(e)))
+            self.wake.wait(POOL_REFILL_INTERVAL)
+            self.wake.clear()
+
+    def refill(self):
+        listener = self.listener
+        backends = listener.backends[:]
+        for backend in list(self.pools.keys()):
+            if backend.healthy is False or backend not in backends:
+                self.discard(backend)
+
+        for backend in backends:
+            if backend.healthy is False:
+                continue
+            pool = self.pools.setdefault(backend, collections.deque())
+            while len(pool) < self.size and listener.keepGoing is True:
+                pooled = self.connect(backend)
+                if pooled is None:
+                    break
+                pool.append(pooled)
+
+    def connect(self, backend):
+        addr = backend.nextAddress()
+        if addr is None:
+            return None
+        sock = socket.socket(addressFamily(addr), socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            connectStart = time.time()
+            sock.connect( (addr, backend.port) )
+            latency = time.time() - connectStart
+        except Exception as e:
+            sock.close()
+            self.listener.markFailed(backend, str(e))
+            return None
+        sock.setblocking(False)
+        return (sock, addr, latency)
+
+    def discard(self, backend):
+        pool = self.pools.pop(backend, None)
+        while pool:
+            try:
+                pool.popleft()[0].close()
+            except IndexError:
+                break
+
+    def take(self, backend):
+        '''
+            take - Returns a pooled connection to backend, if there is one that is still open
+
+              @return <tuple/None> - (non-blocking socket, address, connect latency), or None
+        '''
+        pool = self.pools.get(backend)
+        while pool:
+            try:
+                pooled = pool.popleft()
+            except IndexError:
+                break
+            self.wake.set()
+            if self.isOpen(pooled[0]) is True:
+                return pooled
+            pooled[0].close()
+        return None
+
+    @staticmethod
+    def isOpen(sock):
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except Exception:
+            return False
+        # EOF, or the worker sent something before being asked
+        return False
+
+    def pooledCount(self, backend):
+        return len(self.pools.get(backend, ()))
+
+
+### listener ###
+def bindListenSocket(localAddr, localPort, reusePort, backlog):
+    '''
+        bindListenSocket - Create a socket listening on localAddr:localPort
+
+          @param reusePort <bool> - Set SO_REUSEPORT, so that other listener processes may bind the same address
+
+          @return <socket>
+    '''
+    listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        # If on UNIX, bind to port even if connections are still in TIME_WAIT state
+        #  (from previous connections, which don't ever be served...)
+        # Happens when PumpkinLB Restarts.
+        try:
+            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        except:
+            pass
+        if reusePort is True:
+            # Every listener process for this mapping binds the same address, and the kernel balances accepts between them.
+            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listenSocket.bind( (localAddr, localPort) )
+        listenSocket.listen(backlog)
+    except:
+        listenSocket.close()
+        raise
+    return listenSocket
+
+class PumpkinListener(multiprocessing.Process):
+    '''
+        Class that listens on a local port and forwards requests to workers
+    '''
+    # [options] strategy -> method choosing among the candidate backends
+    STRATEGY_METHODS = {
+        'roundrobin' : '_pickRoundRobin',
+        'leastconn'  : '_pickLeastConn',
+        'ewma'       : '_pickEwma',
+        'p2c'        : '_pickPowerOfTwo',
+    }
+
+    def __init__(self, localAddr, localPort, workers, bufferSize=DEFAULT_BUFFER_SIZE, options=None, listenerNum=0, metrics=None, listenSocket=None):
+        multiprocessing.Process.__init__(self)
+        self.localAddr = localAddr
+        self.localPort = localPort
+        self.workers = workers
+        self.backends = [PumpkinBackend(workerInfo['addr'], workerInfo['port']) for workerInfo in workers]
+        self.bufferSize = bufferSize
+        self.options = options or DEFAULT_OPTIONS
+        self.engine = self.options['engine']
+        self.listenerNum = listenerNum   # Index of this process among the listener_processes sharing localAddr:localPort
+        self.reusePort = self.options['listener_processes'] > 1
+        self.activeWorkers = {}   # Workers currently processing a job, by workerId
+        self.workerIds = itertools.count()
+        self.workersChanged = threading.Condition() # Notified whenever a worker exited, freeing a connection (and its backend slot)
+        self.cleanupSelector = None # Sentinels of the active workers, and connectNotifyReader, watched by the cleanup thread
+        (self.connectNotifyReader, self.connectNotifyWriter) = (None, None) # Pipe on which workers report their workerId once done connecting
+        self.listenSocket = listenSocket # Socket for incoming connections. Bound by the main process (so it can be handed to an upgrade), else by run()
+        self.cleanupThread = None # Cleans up completed workers
+        self.eventLoop = None     # PumpkinEventLoop, when running with engine=eventloop
+        self.healthChecker = None # PumpkinHealthChecker, unless health_interval=0
+        self.resolver = None      # PumpkinResolver, once a worker is defined by hostname
+        self.pool = None          # PumpkinConnectionPool, when pool_size is set
+        self.keepGoing = True     # Flips to False when the application is set to terminate
+        self.draining = False     # Flips to True on SIGQUIT: no more clients are accepted, the process exits once the relayed ones are done
+        self.drainTimeout = self.options['drain_timeout']
+        self.nextWorkerIdx = listenerNum # Round-robin position within self.backends. Staggered so shards don't all start on the same worker.
+        self.ewmaAlpha = self.options['ewma_alpha']
+        self.connectTimeout = self.options['connect_timeout'] or None
+        self.connectRetries = self.options['connect_retries']
+        self.raceDelay = self.options['race_delay'] or None
+        self.idleTimeout = self.options['idle_timeout'] or None
+        self.readTimeout = self.options['read_timeout'] or None
+        self.failoverAttempts = 0  # Connects retried on another worker after a failure
+        self.failoverExhausted = 0 # Clients dropped because every allowed attempt failed
+        self.maxConnections = self.options['max_connections']
+        self.maxConns = self.options['max_conns'] or float('inf')
+        self.queueTimeout = self.options['queue_timeout']
+        self.socksAffinity = self.options['socks_affinity']
+        self.affinityTtl = self.options['affinity_ttl']
+        self.stickyBackends = {}   # socks_affinity=sticky: destination -> [backend, expires]
+        self.udpgwPort = self.options['udpgw_port']
+        self.udpgwFlowTimeout = self.options['udpgw_flow_timeout']
+        self.parseSocks = bool(self.socksAffinity != 'off' or self.udpgwPort) # The listener reads the clients' SOCKS5 handshake itself
+        self.pickBackend = getattr(self, self.STRATEGY_METHODS[self.options['strategy']])
+        self.metrics = metrics or PumpkinMetrics(workers, shared=False) # Shared with the main process when metrics_port is set
+        self.stats = None          # Listener block of self.metrics
+        self.metrics.attach(self)
+        (self.controlReader, self.controlWriter) = multiprocessing.Pipe(duplex=False) # New worker lists, from the main process on reload
+
+    def cleanup(self):
+        '''
+            cleanup - (engine=process) Account the connect of each PumpkinWorker as soon as it reports it, and release each one as soon as it exits.
+
+              Blocks on the workers' sentinels and on the connect notification pipe, so the cost does not grow with the number of active workers.
+        '''
+        selector = self.cleanupSelector
+        while self.keepGoing is True:
+            for (key, events) in selector.select(1):
+                worker = key.data
+                if worker is None:
+                    self.readConnectNotifications()
+                    continue
+                selector.unregister(key.fileobj)
+                worker.join() # Exited, this only reaps it
+                self.activeWorkers.pop(worker.workerId, None)
+                if worker.connectAccounted is False:
+                    self.accountWorkerConnect(worker)
+                self.workerFinished(worker)
+                with self.workersChanged:
+                    self.workersChanged.notify_all()
+
+    def readConnectNotifications(self):
+        try:
+            data = os.read(self.connectNotifyReader, 16384)
+        except (BlockingIOError, InterruptedError):
+            return
+        # Every write is a single 4-byte id, which pipes never split
+        for (workerId,) in struct.iter_unpack('=I', data):
+            worker = self.activeWorkers.get(workerId)
+            if worker is not None and worker.connectAccounted is False:
+                self.accountWorkerConnect(worker)
+
+    def nextBackend(self, exclude=()):
+        '''
+            nextBackend - Returns the PumpkinBackend a new connection should go to, among the healthy ones, according to [options] strategy.
+
+              @param exclude <list/tuple> - Backends not to use (e.g. those this client already failed to connect to)
+
+              @return <PumpkinBackend/None> - None only if every backend is excluded or at max_conns
+        '''
+        backends = self.backends
+        maxConns = self.maxConns
+        candidates = [backend for backend in backends if backend.healthy is True and backend.activeConns < maxConns and backend not in exclude]
+        if not candidates:
+            # Nothing (else) is known to be up. Try anyway rather than refusing the client.
+            candidates = [backend for backend in backends if backend.activeConns < maxConns and backend not in exclude]
+            if not candidates:
+                return None
+        return self.pickBackend(candidates)
+
+    def backendForDestination(self, destination):
+        '''
+            backendForDestination - Returns the PumpkinBackend for a SOCKS5 destination, according to [options] socks_affinity
+
+              @param destination <bytes> - Destination address and port, as in the SOCKS5 request
+
+              @return <PumpkinBackend/None> - None if every backend is at max_conns
+        '''
+        if self.socksAffinity == 'off':
+            return self.nextBackend() # SOCKS5 is only parsed for udpgw_port
+        maxConns = self.maxConns
+        if self.socksAffinity == 'sticky':
+            now = time.monotonic()
+            entry = self.stickyBackends.get(destination)
+            if entry is not None and entry[1] > now and entry[0].healthy is True and entry[0].activeConns < maxConns and entry[0] in self.backends:
+                entry[1] = now + self.affinityTtl
+                return entry[0]
+            backend = self.nextBackend()
+            if backend is not None:
+                self.stickyBackends[destination] = [backend, now + self.affinityTtl]
+            return backend
+
+        return self.rendezvousBackend(destination)
+
+    def rendezvousBackend(self, key):
+        '''
+            rendezvousBackend - Rendezvous (highest random weight) hashing: every backend below max_conns scores key, the highest score wins.
+              Healthy backends are preferred, so only the keys of a backend that goes down move elsewhere.
+
+              @param key <bytes>
+
+              @return <PumpkinBackend/None> - None if every backend is at max_conns
+        '''
+        maxConns = self.maxConns
+        candidates = [backend for backend in self.backends if backend.activeConns < maxConns]
+        candidates = [backend for backend in candidates if backend.healthy is True] or candidates
+        if not candidates:
+            return None
+        return max(candidates, key=lambda backend : zlib.crc32(backend.hashKey + key))
+
+    def expireStickyBackends(self):
+        now = time.monotonic()
+        for destination in [destination for (destination, entry) in self.stickyBackends.items() if entry[1] <= now]:
+            del self.stickyBackends[destination]
+
+    def failoverBackends(self, backend):
+        '''
+            failoverBackends - Returns, in order, up to connect_retries other backends to try if connecting to backend fails
+        '''
+        tried = [backend]
+        for i in range(self.connectRetries):
+            nextBackend = self.nextBackend(exclude=tried)
+            if nextBackend is None:
+                break
+            tried.append(nextBackend)
+        return tried[1:]
+
+    def _rotate(self, candidates):
+        '''
+            _rotate - Returns candidates starting from the current round-robin position, and advances it
+        '''
+        idx = self.nextWorkerIdx % len(candidates)
+        self.nextWorkerIdx += 1
+        return candidates[idx:] + candidates[:idx]
+
+    def _pickRoundRobin(self, candidates):
+        idx = self.nextWorkerIdx % len(candidates)
+        self.nextWorkerIdx += 1
+        return candidates[idx]
+
+    def _pickLeastConn(self, candidates):
+        # Rotating first spreads ties (e.g. everything idle) instead of always landing on the first backend
+        return min(self._rotate(candidates), key=lambda backend : backend.activeConns)
+
+    def _pickEwma(self, candidates):
+        return min(self._rotate(candidates), key=lambda backend : backend.cost())
+
+    def _pickPowerOfTwo(self, candidates):
+        if len(candidates) < 2:
+            return candidates[0]
+        (first, second) = random.sample(candidates, 2)
+        if second.cost() < first.cost():
+            return second
+        return first
+
+    def sendWorkers(self, workers):
+        '''
+            sendWorkers - (main process) Hand a new worker list to the running listener process, which picks it up on SIGHUP.
+        '''
+        self.metrics.assignSlots(workers)
+        if self.metrics.array is not None and len(self.metrics.slots) > self.metrics.capacity:
+            logerr('WARNING: Too many workers added to %s:%d since startup, metrics of the newest are not exported until restart\n' %(self.localAddr, self.localPort))
+        self.workers = workers
+        self.controlWriter.send(workers)
+        os.kill(self.pid, signal.SIGHUP)
+
+    def reloadWorkers(self, *args):
+        '''
+            reloadWorkers - Switch to the newest worker list sent by the main process (SIGHUP).
+
+              The backend list is swapped in a single assignment. Workers that remain keep their state (health, latencies, counters).
+                Connections to removed workers are left alone and drain on their own.
+        '''
+        workers = None
+        while self.controlReader.poll():
+            workers = self.controlReader.recv()
+            self.metrics.assignSlots(workers)
+        if workers is None:
+            return
+
+        current = dict([ (str(backend), backend) for backend in self.backends ])
+        backends = []
+        for workerInfo in workers:
+            backend = current.get('%s:%d' %(workerInfo['addr'], workerInfo['port']))
+            if backend is None:
+                backend = PumpkinBackend(workerInfo['addr'], workerInfo['port'])
+                backend.stats = self.metrics.statsFor(backend)
+            backends.append(backend)
+
+        self.workers = workers
+        self.backends = backends
+        logmsg('Reloaded workers of %s:%d (pid %d): %s\n' %(self.localAddr, self.localPort, os.getpid(), str(workers)))
+        # New workers defined by hostname become usable once the resolver thread looked them up
+        self.startResolver()
+        if self.resolver is not None:
+            self.resolver.wake.set()
+
+    def startResolver(self):
+        '''
+            startResolver - Start refreshing the addresses of workers defined by hostname in the background, if there are any
+        '''
+        if self.resolver is None and [backend for backend in self.backends if isIpAddress(backend.addr) is False]:
+            self.resolver = PumpkinResolver(self)
+            self.resolver.start()
+
+    def waitForBackend(self, clientAddr):
+        '''
+            waitForBackend - (engine=process) Returns the next backend, waiting up to queue_timeout for one to drop below max_conns.
+
+              @return <PumpkinBackend/None> - None if none did in time
+        '''
+        backend = self.nextBackend()
+        deadline = time.time() + self.queueTimeout
+        with self.workersChanged:
+            while backend is None and self.keepGoing is True and time.time() < deadline:
+                # Woken when a worker exits. Also re-checked every second, for workers added by a reload.
+                self.workersChanged.wait(min(deadline - time.time(), 1))
+                backend = self.nextBackend()
+        if backend is None:
+            logconn('Dropping request from %s, every worker on %s:%d is at max_conns\n' %(str(clientAddr), self.localAddr, self.localPort), True)
+            self.stats[PumpkinMetrics.SHED] += 1
+        return backend
+
+    def probeNow(self, *args):
+        '''
+            probeNow - Run the health checks right away (SIGUSR1)
+        '''
+        if self.healthChecker is not None:
+            self.healthChecker.wake.set()
+
+    def markFailed(self, backend, reason):
+        '''
+            markFailed - Count a failed connect to backend as a failed health probe
+        '''
+        if self.healthChecker is not None:
+            self.healthChecker.recordResult(backend, False, reason)
+
+    def startWorker(self, clientSocket, clientAddr, backend):
+        fallbacks = self.failoverBackends(backend)
+        worker = PumpkinWorker(clientSocket, clientAddr, backend.nextAddress(), backend.port, self.bufferSize,
+            self.connectTimeout, [(fallback.nextAddress(), fallback.port) for fallback in fallbacks], self.idleTimeout, self.readTimeout,
+            self.pool is not None and self.pool.take(backend) or None, self.options['max_pending'], self.raceDelay)
+        worker.backend = backend
+        worker.candidates = [backend] + fallbacks
+        worker.connectAccounted = False
+        worker.workerId = next(self.workerIds) & 0xffffffff
+        worker.connectNotify = self.connectNotifyWriter
+        backend.connectionOpened()
+        self.activeWorkers[worker.workerId] = worker
+        worker.start()
+        self.cleanupSelector.register(worker.sentinel, selectors.EVENT_READ, worker)
+        return worker
+
+    def accountWorkerConnect(self, worker):
+        '''
+            accountWorkerConnect - Once a PumpkinWorker is done connecting (or has exited), record which of its candidates failed,
+              and move its connection count to the backend it actually connected to.
+        '''
+        worker.connectAccounted = True
+        failed = worker.failedToConnect.value
+        connectedIdx = worker.connectedIdx.value
+        for (idx, backend) in enumerate(worker.candidates):
+            flags = worker.candidateFlags[idx]
+            if flags & PumpkinWorker.CONNECT_FAILED:
+                backend.recordConnectFailure()
+                self.markFailed(backend, 'connect failed')
+            if flags & PumpkinWorker.CONNECT_RACED:
+                backend.recordRace(idx == connectedIdx)
+
+        if worker.connectLatency.value < 0:
+            if failed:
+                self.failoverAttempts += failed - 1
+                self.failoverExhausted += 1
+                self.stats[PumpkinMetrics.FAILOVERS] += failed - 1
+                self.stats[PumpkinMetrics.FAILOVERS_EXHAUSTED] += 1
+            return
+
+        self.failoverAttempts += failed
+        self.stats[PumpkinMetrics.FAILOVERS] += failed
+        connectedTo = worker.candidates[connectedIdx]
+        if connectedTo is not worker.backend:
+            if failed:
+                connectedTo.failoversIn += 1 # Rather than having won a race
+            worker.backend.connectionClosed()
+            connectedTo.connectionOpened()
+            worker.backend = connectedTo
+        connectedTo.recordConnect(worker.connectLatency.value, self.ewmaAlpha)
+
+    def logStats(self, *args):
+        '''
+            logStats - Log the per-backend counters of this listener (SIGUSR2)
+        '''
+        logmsg('Stats for %s:%d (pid %d): failover attempts=%d, clients dropped after all attempts failed=%d\n' %(self.localAddr, self.localPort, os.getpid(), self.failoverAttempts, self.failoverExhausted))
+        for backend in self.backends:
+            logmsg('  %s: healthy=%s active=%d pooled=%d connect_failures=%d failovers_in=%d races=%d race_wins=%d ewma_connect=%s ewma_first_byte=%s\n' %(str(backend), str(backend.healthy),
+                backend.activeConns, self.pool is not None and self.pool.pooledCount(backend) or 0, backend.connectFailures, backend.failoversIn, backend.raceAttempts, backend.raceWins,
+                backend.ewmaConnect is None and '-' or '%.1fms' %(backend.ewmaConnect * 1000.0,),
+                backend.ewmaFirstByte is None and '-' or '%.1fms' %(backend.ewmaFirstByte * 1000.0,)))
+        if self.eventLoop is not None and self.eventLoop.udpgw is not None:
+            udpgw = self.eventLoop.udpgw
+            logmsg('  udpgw: sessions=%d flows=%d dropped=%d\n' %(udpgw.sessions, udpgw.flows, udpgw.dropped))
+
+    def workerFinished(self, worker):
+        '''
+            workerFinished - Release the backend slot held by a PumpkinWorker (once it has exited, or failed to connect)
+        '''
+        if worker.backend is not None:
+            worker.backend.stats[PumpkinMetrics.BYTES_SENT] += worker.bytesSent.value
+            worker.backend.stats[PumpkinMetrics.BYTES_RECEIVED] += worker.bytesReceived.value
+            worker.backend.connectionClosed()
+            worker.backend = None
+
+    def closeWorkers(self, *args):
+        self.keepGoing = False
+
+        if self.eventLoop is not None:
+            # All relays live in this process, nothing to wait on.
+            self.eventLoop.closeAll()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            sys.exit(0)
+
+        time.sleep(1)
+
+        if self.draining is False:
+            # While draining, the socket is another PumpkinLB's now
+            try:
+                self.listenSocket.shutdown(socket.SHUT_RDWR)
+            except:
+                pass
+        try:
+            self.listenSocket.close()
+        except:
+            pass
+
+        if not self.activeWorkers:
+            self.cleanupThread and self.cleanupThread.join(3)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            sys.exit(0)
+
+        for pumpkinWorker in list(self.activeWorkers.values()):
+            try:
+                pumpkinWorker.terminate()
+                os.kill(pumpkinWorker.pid, signal.SIGTERM)
+            except:
+                pass
+
+        time.sleep(1)
+
+        remainingWorkers = []
+        for pumpkinWorker in list(self.activeWorkers.values()):
+            pumpkinWorker.join(.03)
+            if pumpkinWorker.is_alive() is True: # Still running
+                remainingWorkers.append(pumpkinWorker)
+
+        if len(remainingWorkers) > 0:
+            # One last chance to complete, then we kill
+            time.sleep(1)
+            for pumpkinWorker in remainingWorkers:
+                pumpkinWorker.join(.2)
+
+        self.cleanupThread and self.cleanupThread.join(2)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sys.exit(0)
+
+    def drainWorkers(self, *args):
+        '''
+            drainWorkers - (SIGQUIT) Stop accepting clients, and exit once every connection being relayed is done on its own.
+              Whatever is left after drain_timeout is closed as on SIGTERM.
+        '''
+        if self.draining is True or self.keepGoing is False:
+            return
+        self.draining = True
+        signal.signal(signal.SIGALRM, self.closeWorkers)
+        if self.drainTimeout:
+            signal.setitimer(signal.ITIMER_REAL, self.drainTimeout)
+
+        if self.eventLoop is not None:
+            self.eventLoop.stopAccepting()
+            if not self.eventLoop.relays:
+                self.closeWorkers()
+            return
+
+        # Not shutdown(), the socket may be shared with the PumpkinLB that took over. The accept in run() fails from now on.
+        try:
+            self.listenSocket.close()
+        except:
+            pass
+
+    def run(self):
+        configureLog(self.options) # Inherited when forked, but not under other start methods
+        signal.signal(signal.SIGTERM, self.closeWorkers)
+        signal.signal(signal.SIGUSR1, self.probeNow)
+        signal.signal(signal.SIGUSR2, self.logStats)
+        signal.signal(signal.SIGHUP, self.reloadWorkers)
+        signal.signal(signal.SIGQUIT, self.drainWorkers)
+        self.controlWriter.close()
+
+        while self.listenSocket is None:
+            try:
+                self.listenSocket = bindListenSocket(self.localAddr, self.localPort, self.reusePort, self.options['listen_backlog'])
+            except Exception as e:
+                logerr('Failed to bind to %s:%d. "%s" Retrying in 5 seconds.\n' %(self.localAddr, self.localPort, str(e)))
+                time.sleep(5)
+        listenSocket = self.listenSocket
+
+        # First lookups are done before serving, later ones in the background
+        self.startResolver()
+        if self.resolver is not None:
+            self.resolver.resolveAll()
+
+        if self.options['health_interval'] > 0:
+            self.healthChecker = PumpkinHealthChecker(self)
+            self.healthChecker.start()
+
+        if self.options['pool_size'] > 0:
+            self.pool = PumpkinConnectionPool(self)
+            self.pool.start()
+
+        if self.engine == 'eventloop':
+            self.eventLoop = PumpkinEventLoop(self)
+            try:
+                self.eventLoop.run(listenSocket)
+            except Exception as e:
+                logerr('Got exception: %s, shutting down relays on %s:%d\n' %(str(e), self.localAddr, self.localPort))
+            self.closeWorkers()
+            return
+
+        # Create thread that will cleanup completed tasks
+        self.cleanupSelector = selectors.DefaultSelector()
+        (self.connectNotifyReader, self.connectNotifyWriter) = os.pipe()
+        os.set_blocking(self.connectNotifyReader, False)
+        os.set_blocking(self.connectNotifyWriter, False)
+        self.cleanupSelector.register(self.connectNotifyReader, selectors.EVENT_READ, None)
+        self.cleanupThread = cleanupThread = threading.Thread(target=self.cleanup)
+        cleanupThread.start()
+
+        try:
+            while self.keepGoing is True and self.draining is False:
+                if self.maxConnections and len(self.activeWorkers) >= self.maxConnections:
+                    with self.workersChanged:
+                        while len(self.activeWorkers) >= self.maxConnections and self.keepGoing is True and self.draining is False:
+                            # Leave further clients in the backlog until a worker process is done
+                            self.workersChanged.wait(1)
+                    continue
+                try:
+                    (clientConnection, clientAddr) = listenSocket.accept()
+                except BlockingIOError:
+                    # Non-blocking after all: the socket was handed over from (or to) a PumpkinLB running engine=eventloop
+                    try:
+                        select.select([listenSocket], [], [], 1)
+                    except:
+                        pass # Closed by drainWorkers
+                    continue
+                except:
+                    if self.draining is True:
+                        break
+                    logerr('Cannot bind to %s:%s\n' %(self.localAddr, self.localPort))
+                    if self.keepGoing is True:
+                        # Exception did not come from termination process, so keep rollin'
+                        time.sleep(3)
+                        continue
+
+                    raise # Termination DID come from termination process, so abort.
+
+                self.stats[PumpkinMetrics.ACCEPTED] += 1
+                backend = self.waitForBackend(clientAddr)
+                if backend is None:
+                    clientConnection.close()
+                    continue
+                self.startWorker(clientConnection, clientAddr, backend)
+        except Exception as e:
+            logerr('Got exception: %s, shutting down workers on %s:%d\n' %(str(e), self.localAddr, self.localPort))
+            self.closeWorkers()
+            return
+
+        if self.draining is True:
+            with self.workersChanged:
+                while self.activeWorkers:
+                    self.workersChanged.wait(1)
+        self.closeWorkers()
+
+
+### worker ###
+class PumpkinWorker(multiprocessing.Process):
+    '''
+        A class which handles the worker-side of processing a request (communicating between the back-end worker and the requesting client)
+    '''
+    # candidateFlags values
+    CONNECT_FAILED = 1 # The connect to this candidate failed
+    CONNECT_RACED = 2  # The connect to this candidate raced others (race_delay)
+
+    def __init__(self, clientSocket, clientAddr, workerAddr, workerPort, bufferSize=DEFAULT_BUFFER_SIZE, connectTimeout=None, fallbackWorkers=None, idleTimeout=None, readTimeout=None, pooledConnection=None, maxPending=DEFAULT_OPTIONS['max_pending'], raceDelay=None):
+        multiprocessing.Process.__init__(self)
+        self.clientSocket = clientSocket
+        self.clientAddr = clientAddr
+        self.workerAddr = workerAddr
+        self.workerPort = workerPort
+        self.workerSocket = None
+        self.bufferSize = bufferSize
+        self.connectTimeout = connectTimeout
+        self.idleTimeout = idleTimeout # Seconds without data either way before giving up on the connection
+        self.readTimeout = readTimeout # Seconds to wait for the worker's first byte
+        self.fallbackWorkers = fallbackWorkers or [] # (addr, port) to fail over to, in order, if the connect to workerAddr:workerPort fails. addr is None if it did not resolve.
+        self.pooledConnection = pooledConnection     # (socket, addr, connect latency) already connected to the worker, from PumpkinConnectionPool
+        self.maxPending = maxPending # Bytes buffered per direction before reading from the sending side pauses
+        self.raceDelay = raceDelay   # Seconds before also connecting to the next candidate, None to connect to one at a time
+        self.workerId = None     # Identifies this worker to its listener
+        self.connectNotify = None # Write end of the listener's pipe, to report workerId on once done connecting
+        self.failedToConnect = multiprocessing.Value('i', 0)   # Number of workers we failed to connect to
+        self.connectLatency = multiprocessing.Value('d', -1.0) # Seconds taken by the successful connect, once there is one
+        self.connectedIdx = multiprocessing.RawValue('i', -1)  # Candidate (0 is workerAddr:workerPort, then fallbackWorkers) connected to
+        self.candidateFlags = multiprocessing.RawArray('B', 1 + len(self.fallbackWorkers)) # CONNECT_* flags of each candidate
+        self.bytesSent = multiprocessing.RawValue('d', 0)       # Relayed from the client to the worker (only written by this process)
+        self.bytesReceived = multiprocessing.RawValue('d', 0)   # Relayed from the worker to the client
+
+    def closeConnections(self):
+        try:
+            self.workerSocket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.workerSocket.close()
+        except:
+            pass
+        try:
+            self.clientSocket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.clientSocket.close()
+        except:
+            pass
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def closeConnectionsAndExit(self, *args):
+        self.closeConnections()
+        sys.exit(0)
+
+    def connectWorker(self):
+        '''
+            connectWorker - Connect to workerAddr:workerPort, failing over through fallbackWorkers in order.
+
+              @return <socket/None> - The connected socket, or None if every attempt failed
+        '''
+        if self.pooledConnection is not None:
+            (workerSocket, self.workerAddr, latency) = self.pooledConnection
+            workerSocket.setblocking(True)
+            self.connectLatency.value = latency
+            self.connectedIdx.value = 0
+            return workerSocket
+
+        candidates = [(self.workerAddr, self.workerPort)] + list(self.fallbackWorkers)
+        if self.raceDelay is not None and len(candidates) > 1:
+            return self.raceConnect(candidates)
+        for (idx, (workerAddr, workerPort)) in enumerate(candidates):
+            if workerAddr is None:
+                self.connectFailed(idx, workerAddr, workerPort, 'not resolved')
+                continue
+            workerSocket = socket.socket(addressFamily(workerAddr), socket.SOCK_STREAM)
+            workerSocket.settimeout(self.connectTimeout)
+            try:
+                connectStart = time.time()
+                workerSocket.connect( (workerAddr, workerPort) )
+                self.connectLatency.value = time.time() - connectStart
+                workerSocket.settimeout(None)
+                (self.workerAddr, self.workerPort) = (workerAddr, workerPort)
+                self.connectedIdx.value = idx
+                return workerSocket
+            except Exception as e:
+                workerSocket.close()
+                self.connectFailed(idx, workerAddr, workerPort, str(e))
+        return None
+
+    def raceConnect(self, candidates):
+        '''
+            raceConnect - Connect to candidates in order, staggered (race_delay): the next connect starts once those in progress
+              have not completed for raceDelay seconds, or right away when one fails. The first to complete is kept, the others are closed.
+
+              @return <socket/None> - The connected socket, or None if every attempt failed
+        '''
+        pending = {}  # socket -> (candidate index, connect start)
+        nextIdx = 0   # Next candidate to connect to
+        nextStart = 0 # When to start it, if the connects in progress have not completed by then
+        candidateFlags = self.candidateFlags
+        try:
+            while True:
+                now = time.time()
+                if nextIdx < len(candidates) and (not pending or now >= nextStart):
+                    idx = nextIdx
+                    nextIdx += 1
+                    (workerAddr, workerPort) = candidates[idx]
+                    if workerAddr is None:
+                        self.connectFailed(idx, workerAddr, workerPort, 'not resolved')
+                        continue
+                    workerSocket = socket.socket(addressFamily(workerAddr), socket.SOCK_STREAM)
+                    workerSocket.setblocking(False)
+                    try:
+                        err = workerSocket.connect_ex( (workerAddr, workerPort) )
+                    except Exception as e:
+                        err = str(e)
+                    if err not in (0, errno.EINPROGRESS):
+                        workerSocket.close()
+                        self.connectFailed(idx, workerAddr, workerPort, isinstance(err, int) and os.strerror(err) or err)
+                        continue
+                    if pending:
+                        candidateFlags[idx] |= self.CONNECT_RACED
+                        for (otherIdx, otherStart) in pending.values():
+                            candidateFlags[otherIdx] |= self.CONNECT_RACED
+                    pending[workerSocket] = (idx, now)
+                    nextStart = now + self.raceDelay
+                    continue
+                if not pending:
+                    return None
+
+                deadlines = []
+                if nextIdx < len(candidates):
+                    deadlines.append(nextStart)
+                if self.connectTimeout:
+                    deadlines += [connectStart + self.connectTimeout for (idx, connectStart) in pending.values()]
+                timeout = None
+                if deadlines:
+                    timeout = max(min(deadlines) - now, 0)
+                (unused, connected, unused) = select.select([], list(pending), [], timeout)
+
+                now = time.time()
+                for workerSocket in connected:
+                    (idx, connectStart) = pending.pop(workerSocket)
+                    (workerAddr, workerPort) = candidates[idx]
+                    err = workerSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err != 0:
+                        workerSocket.close()
+                        self.connectFailed(idx, workerAddr, workerPort, os.strerror(err))
+                        nextStart = now
+                        continue
+                    workerSocket.setblocking(True)
+                    self.connectLatency.value = now - connectStart
+                    (self.workerAddr, self.workerPort) = (workerAddr, workerPort)
+                    self.connectedIdx.value = idx
+                    return workerSocket
+
+                if self.connectTimeout:
+                    for (workerSocket, (idx, connectStart)) in list(pending.items()):
+                        if now - connectStart >= self.connectTimeout:
+                            del pending[workerSocket]
+                            workerSocket.close()
+                            self.connectFailed(idx, candidates[idx][0], candidates[idx][1], 'timed out')
+                            nextStart = now
+        finally:
+            # Those that lost the race
+            for workerSocket in pending:
+                workerSocket.close()
+
+    def connectFailed(self, idx, workerAddr, workerPort, reason):
+        if workerAddr is None:
+            logconn('Could not connect to worker on port %d: %s\n' %(workerPort, reason), True)
+        else:
+            logconn('Could not connect to worker %s:%d: %s\n' %(workerAddr, workerPort, reason), True)
+        self.candidateFlags[idx] |= self.CONNECT_FAILED
+        self.failedToConnect.value += 1
+
+    @staticmethod
+    def sendSome(sock, data):
+        '''
+            sendSome - Send as much of data as the socket takes right now
+
+              @return <int> - Number of bytes sent
+        '''
+        try:
+            return sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    def notifyConnected(self):
+        '''
+            notifyConnected - Tell the listener the connect is done (failedToConnect and connectLatency are final), so it accounts it right away
+        '''
+        if self.connectNotify is None:
+            return
+        try:
+            os.write(self.connectNotify, struct.pack('=I', self.workerId))
+        except OSError:
+            pass # Pipe full, the listener accounts it once this worker exits
+
+    def run(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN) # Meant for the listener only
+        clientSocket = self.clientSocket
+
+        bufferSize = self.bufferSize
+
+        workerSocket = self.workerSocket = self.connectWorker()
+        self.notifyConnected()
+        if workerSocket is None:
+            logconn('Giving up on request from %s after %d attempts\n' %(str(self.clientAddr), self.failedToConnect.value), True)
+            self.closeConnections()
+            return
+        if self.failedToConnect.value:
+            logconn('Failed over request from %s to %s:%d\n' %(str(self.clientAddr), self.workerAddr, self.workerPort))
+
+        signal.signal(signal.SIGTERM, self.closeConnectionsAndExit)
+
+        maxPending = self.maxPending
+        try:
+            # Non-blocking, so a slow receiver takes what it can and the other direction keeps moving meanwhile
+            clientSocket.setblocking(False)
+            workerSocket.setblocking(False)
+            # bytearrays, so appending and consuming from the front are not quadratic when a peer is slow
+            dataToClient = bytearray()
+            dataFromClient = bytearray()
+            # A side that sent EOF is no longer read from. Once what it sent is delivered, the other side is shut down for writing.
+            (clientEof, workerEof) = (False, False)
+            (clientShut, workerShut) = (False, False)
+            lastActivity = time.monotonic()
+            readDeadline = self.readTimeout and lastActivity + self.readTimeout or None
+            while not (clientShut and workerShut):
+                waitingToRead = []
+                waitingToWrite = []
+
+                # A side is only read from while what it sent before is (mostly) delivered
+                if not clientEof and len(dataFromClient) < maxPending:
+                    waitingToRead.append(clientSocket)
+                if not workerEof and len(dataToClient) < maxPending:
+                    waitingToRead.append(workerSocket)
+                if dataToClient:
+                    waitingToWrite.append(clientSocket)
+                if dataFromClient:
+                    waitingToWrite.append(workerSocket)
+
+                # Sleep until there is something to do, or the next timeout is due
+                deadlines = []
+                if self.idleTimeout:
+                    deadlines.append(lastActivity + self.idleTimeout)
+                if readDeadline is not None:
+                    deadlines.append(readDeadline)
+                timeout = None
+                if deadlines:
+                    timeout = min(deadlines) - time.monotonic()
+                    if timeout <= 0:
+                        logconn('Closing request from %s to %s:%d: %s\n' %(str(self.clientAddr), self.workerAddr, self.workerPort,
+                            readDeadline is not None and readDeadline <= time.monotonic() and 'no reply within read_timeout' or 'idle for idle_timeout'), True)
+                        break
+
+                try:
+                    (hasDataForRead, readyForWrite, hasError) = select.select(waitingToRead, waitingToWrite, [clientSocket, workerSocket], timeout)
+                except KeyboardInterrupt:
+                    break
+
+                if hasError:
+                    break
+            
+                if clientSocket in hasDataForRead:
+                    nextData = clientSocket.recv(bufferSize)
+                    if not nextData:
+                        clientEof = True
+                    else:
+                        dataFromClient += nextData
+                        self.bytesSent.value += len(nextData)
+                        lastActivity = time.monotonic()
+
+                if workerSocket in hasDataForRead:
+                    nextData = workerSocket.recv(bufferSize)
+                    if not nextData:
+                        workerEof = True
+                    else:
+                        dataToClient += nextData
+                        self.bytesReceived.value += len(nextData)
+                        lastActivity = time.monotonic()
+                        readDeadline = None
+            
+                if workerSocket in readyForWrite:
+                    del dataFromClient[:self.sendSome(workerSocket, dataFromClient)]
+
+                if clientSocket in readyForWrite:
+                    del dataToClient[:self.sendSome(clientSocket, dataToClient)]
+
+                if clientEof and not dataFromClient and not workerShut:
+                    workerSocket.shutdown(socket.SHUT_WR)
+                    workerShut = True
+                if workerEof and not dataToClient and not clientShut:
+                    clientSocket.shutdown(socket.SHUT_WR)
+                    clientShut = True
+
+        except Exception as e:
+            logconn('Error on %s:%d: %s\n' %(self.workerAddr, self.workerPort, str(e)), True)
+
+        self.closeConnectionsAndExit()
+
+
+### relay channels ###
+class PumpkinBufferChannel(object):
+    '''
+        One direction of a relay, buffered through a preallocated ring buffer.
+
+        Data is received straight into the ring with recv_into and sent out of it through a memoryview,
+          so no intermediate bytes objects are created on the data path.
+    '''
+    __slots__ = ('size', 'buffer', 'view', 'start', 'pending', 'eof', 'shut')
+
+    def __init__(self, bufferSize):
+        self.size = bufferSize
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.start = 0     # Offset of the first unsent byte
+        self.pending = 0   # Number of unsent bytes, starting at self.start (may wrap around)
+        self.eof = False   # The sending side is done (fill got EOF)
+        self.shut = False  # ... and that was passed on with shutdown(SHUT_WR)
+
+    def canFill(self):
+        return self.eof is False and self.pending < self.size
+
+    def preload(self, data):
+        '''
+            preload - Queue data (e.g. a replayed handshake) ahead of what is received. Only used on an empty channel.
+        '''
+        if len(data) > self.size:
+            self.size = len(data)
+            self.buffer = bytearray(data)
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[0:len(data)] = data
+        self.start = 0
+        self.pending = len(data)
+
+    def fill(self, sock):
+        '''
+            fill - Receive from sock into the free space of the ring.
+
+              @return <int/None> - Number of bytes received, 0 on EOF, or None if nothing was available.
+        '''
+        size = self.size
+        if self.pending == 0:
+            self.start = 0
+        writePos = self.start + self.pending
+        if writePos >= size:
+            writePos -= size
+            freeEnd = self.start
+        else:
+            freeEnd = size
+
+        try:
+            received = sock.recv_into(self.view[writePos:freeEnd])
+        except (BlockingIOError, InterruptedError):
+            return None
+
+        if received == 0:
+            self.eof = True
+        self.pending += received
+        return received
+
+    def drain(self, sock):
+        '''
+            drain - Send as much of the pending data to sock as it will take without blocking.
+        '''
+        while self.pending:
+            end = min(self.start + self.pending, self.size)
+            try:
+                sent = sock.send(self.view[self.start:end])
+            except (BlockingIOError, InterruptedError):
+                return
+            self.pending -= sent
+            self.start += sent
+            if self.start == self.size:
+                self.start = 0
+            elif self.start < end:
+                return # Partial send, the socket buffer is full
+
+    def close(self):
+        self.view.release()
+
+
+class PumpkinSpliceChannel(object):
+    '''
+        One direction of a relay, moved between the sockets with splice(2) through a kernel pipe.
+
+        The payload never enters Python; the pipe itself is the buffer.
+    '''
+    __slots__ = ('pipeRead', 'pipeWrite', 'size', 'pending', 'full', 'eof', 'shut')
+
+    FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+
+    def __init__(self, bufferSize):
+        (self.pipeRead, self.pipeWrite) = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            self.size = fcntl.fcntl(self.pipeWrite, fcntl.F_GETPIPE_SZ)
+        except:
+            self.size = 65536
+        self.pending = 0
+        self.full = False   # The pipe ran out of slots before reaching self.size bytes
+        self.eof = False    # The sending side is done (fill got EOF)
+        self.shut = False   # ... and that was passed on with shutdown(SHUT_WR)
+
+    def canFill(self):
+        return self.eof is False and self.full is False and self.pending < self.size
+
+    def preload(self, data):
+        '''
+            preload - Queue data (e.g. a replayed handshake) ahead of what is received. Only used on an empty channel.
+        '''
+        self.pending += os.write(self.pipeWrite, data)
+
+    def fill(self, sock):
+        try:
+            received = os.splice(sock.fileno(), self.pipeWrite, self.size - self.pending, flags=self.FLAGS)
+        except (BlockingIOError, InterruptedError):
+            if self.pending:
+                # Socket had data but the pipe had no room for it
+                self.full = True
+            return None
+
+        if received == 0:
+            self.eof = True
+        self.pending += received
+        return received
+
+    def drain(self, sock):
+        while self.pending:
+            try:
+                sent = os.splice(self.pipeRead, sock.fileno(), self.pending, flags=self.FLAGS)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.pending -= sent
+            self.full = False
+
+    def close(self):
+        for fd in (self.pipeRead, self.pipeWrite):
+            try:
+                os.close(fd)
+            except:
+                pass
+
+
+def spliceSupported():
+    '''
+        spliceSupported - Whether PumpkinSpliceChannel can be used on this platform
+    '''
+    return hasattr(os, 'splice') and hasattr(os, 'pipe2') and fcntl is not None
+
+
+### socks ###
+SOCKS5_NO_AUTH = b'\x05\x00'           # Method selection reply: no authentication
+SOCKS5_NO_ACCEPTABLE = b'\x05\xff'     # Method selection reply: none of the offered methods
+SOCKS5_GREETING = b'\x05\x01\x00'     # Greeting offering only "no authentication"
+
+def parseSocks5Greeting(data):
+    '''
+        parseSocks5Greeting - Parse a SOCKS5 client greeting (VER NMETHODS METHODS...)
+
+          @return <tuple/None> - (length, methods) or None if more data is needed
+
+          @raises ValueError - If this is not a SOCKS5 greeting
+    '''
+    if len(data) < 2:
+        return None
+    if data[0:1] != b'\x05':
+        raise ValueError('not a SOCKS5 greeting')
+    length = 2 + data[1]
+    if len(data) < length:
+        return None
+    return (length, data[2:length])
+
+def parseSocks5Request(data):
+    '''
+        parseSocks5Request - Parse a SOCKS5 request (VER CMD RSV ATYP DST.ADDR DST.PORT)
+
+          @return <tuple/None> - (length, destination) or None if more data is needed. destination is the raw ATYP+DST.ADDR+DST.PORT.
+
+          @raises ValueError - If the request is malformed
+    '''
+    if len(data) < 5:
+        return None
+    if data[0:1] != b'\x05':
+        raise ValueError('bad SOCKS5 request version')
+    addrType = data[3]
+    if addrType == 1:
+        length = 4 + 4 + 2
+    elif addrType == 3:
+        length = 4 + 1 + data[4] + 2
+    elif addrType == 4:
+        length = 4 + 16 + 2
+    else:
+        raise ValueError('bad SOCKS5 address type %d' %(addrType,))
+    if len(data) < length:
+        return None
+    return (length, data[3:length])
+
+
+### udpgw ###
+# badvpn-udpgw protocol, as spoken by badvpn-tun2socks --udpgw-remote-server-addr through a SOCKS5 tunnel:
+#  every message is a 2 byte little endian length, then flags (1 byte) and conid (2 bytes, little endian),
+#  then, unless it is a keepalive, the remote address (IPv4 4+2 bytes, IPv6 16+2 bytes) and the datagram.
+UDPGW_KEEPALIVE = 0x01
+UDPGW_REBIND = 0x02 # conid now stands for another remote address: the server drops its socket for it
+UDPGW_DNS = 0x04
+UDPGW_IPV6 = 0x08
+UDPGW_HEADER = struct.Struct('<HBH') # length, flags, conid
+UDPGW_MAX_PENDING = 262144 # Bytes queued towards a socket, further datagrams for it are dropped (as UDP would) until it catches up
+UDPGW_READ_SIZE = 65536    # Bytes read at once. All the messages in them are split off that single read, and those for the same socket go out in a single send.
+SOCKS5_SUCCEEDED = b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00' # Request reply: succeeded, bound to 0.0.0.0:0
+
+def splitUdpgwMessages(buffer):
+    '''
+        splitUdpgwMessages - Take the complete udpgw messages off the front of buffer
+
+          @param buffer <bytearray> - What was read so far. The messages returned are removed from it.
+
+          @return <list> - (flags, conid, message) for each message, message being all of it (length prefix included)
+
+          @raises ValueError - If a message is too short to hold its header
+    '''
+    messages = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= 2:
+        length = buffer[offset] | (buffer[offset + 1] << 8)
+        if end - offset - 2 < length:
+            break
+        if length < 3:
+            raise ValueError('udpgw message of %d bytes' %(length,))
+        (length, flags, conid) = UDPGW_HEADER.unpack_from(buffer, offset)
+        messages.append( (flags, conid, bytes(buffer[offset:offset + 2 + length])) )
+        offset += 2 + length
+    del buffer[:offset]
+    return messages
+
+
+### event loop ###
+class PumpkinRelay(object):
+    '''
+        State of a single client <-> worker pair, as served by PumpkinEventLoop
+    '''
+    __slots__ = ('clientSocket', 'clientAddr', 'clientFd', 'backend', 'workerSocket', 'workerAddr', 'workerPort',
+                 'connected', 'closed', 'failedBackends', 'connectStart', 'connectTimer', 'upstream', 'downstream', 'clientEvents', 'workerEvents',
+                 'socksState', 'handshake', 'replay', 'destination', 'queueTimer', 'readTimer', 'lastActivity', 'udpgw',
+                 'racers', 'raceTimer', 'racedBackends')
+
+    # socksState values (socks_affinity), None once the relay is plain pass-through
+    SOCKS_GREETING = 1 # Reading the client greeting
+    SOCKS_REQUEST = 2  # Reading the client request
+    SOCKS_REPLAY = 3   # Connecting to the worker, then replaying the greeting to it
+    SOCKS_REPLY = 4    # Waiting for the worker's method selection reply
+    UDPGW = 5          # A udpgw connection, served by PumpkinUdpgwMux rather than relayed
+
+    def __init__(self, clientSocket, clientAddr):
+        self.clientSocket = clientSocket
+        self.clientAddr = clientAddr
+        self.clientFd = clientSocket.fileno()
+        self.backend = None      # PumpkinBackend currently being connected to / relayed to
+        self.workerSocket = None
+        self.workerAddr = None
+        self.workerPort = None
+        self.connected = False   # Connection to the worker has completed
+        self.closed = False
+        self.failedBackends = () # Backends this client already failed to connect to
+        self.connectStart = 0    # When the current connect started. Reset to 0 once the first byte came back from the worker.
+        self.connectTimer = None # Fires connect_timeout after the current connect started
+        self.upstream = None     # Channel carrying client -> worker, created once connected
+        self.downstream = None   # Channel carrying worker -> client
+        self.clientEvents = 0    # Events currently registered with the selector for each socket
+        self.workerEvents = 0
+        self.socksState = None
+        self.handshake = b''     # SOCKS5 bytes read so far (from the client, then from the worker)
+        self.replay = None       # Bytes to send the worker ahead of the client's data, once connected
+        self.destination = None  # SOCKS5 destination (socks_affinity)
+        self.queueTimer = None   # Fires queue_timeout after queueing for a worker below max_conns
+        self.readTimer = None    # Fires read_timeout after connecting, unless the worker sent something back
+        self.lastActivity = 0    # When data last moved either way (idle_timeout)
+        self.udpgw = None        # PumpkinUdpgwSession, for a udpgw connection (udpgw_port)
+        self.racers = None       # [backend, socket, addr, connect start, connect timer] of each connect racing the current one (race_delay)
+        self.raceTimer = None    # Fires race_delay after the last connect started, to start another
+        self.racedBackends = ()  # Backends whose connects raced, counted once the race is over
+
+
+class PumpkinTimerWheel(object):
+    '''
+        Expires relays that moved no data either way for a fixed timeout (idle_timeout).
+
+        Relays sit in slots of `tick` seconds by deadline. Moving data only updates relay.lastActivity;
+          a relay is put back in a later slot when its slot comes up and it turns out to have been active,
+          so neither a timer per relay nor any work per byte is needed.
+    '''
+    def __init__(self, timeout, onExpire):
+        self.timeout = timeout
+        self.onExpire = onExpire  # Called with each relay that timed out
+        self.tick = max(timeout / 64.0, 0.05)
+        # Deadlines are at most one timeout ahead, so the wheel never wraps onto slots not yet turned
+        self.slots = [ [] for i in range(int(math.ceil(timeout / self.tick)) + 2) ]
+        self.turned = int(time.monotonic() / self.tick) # Last tick whose slot was processed
+        self.size = 0
+
+    def add(self, relay):
+        tickNum = max(int((relay.lastActivity + self.timeout) / self.tick), self.turned + 1)
+        self.slots[tickNum % len(self.slots)].append(relay)
+        self.size += 1
+
+    def remove(self, relay):
+        '''
+            remove - Take a relay that is still open off the wheel. Searches every slot, so only meant for rare paths.
+        '''
+        for slot in self.slots:
+            if relay in slot:
+                slot.remove(relay)
+                self.size -= 1
+                return
+
+    def turn(self, now):
+        '''
+            turn - Process the slots that came due, expiring the relays that have been idle for the timeout.
+        '''
+        slots = self.slots
+        nowTick = int(now / self.tick)
+        due = []
+        for tickNum in range(max(self.turned + 1, nowTick - len(slots) + 1), nowTick + 1):
+            slot = slots[tickNum % len(slots)]
+            if slot:
+                due += slot
+                del slot[:]
+        self.turned = nowTick
+        self.size -= len(due)
+
+        for relay in due:
+            if relay.closed is True:
+                continue
+            if relay.lastActivity + self.timeout <= now:
+                self.onExpire(relay)
+            else:
+                self.add(relay)
+
+
+class PumpkinUdpgwFlow(object):
+    '''
+        A UDP flow (udpgw conid) of a PumpkinUdpgwSession, and the tunnel it is bound to
+    '''
+    __slots__ = ('session', 'conid', 'address', 'tunnel', 'lastActivity', 'closed')
+
+    def __init__(self, session, conid):
+        self.session = session
+        self.conid = conid
+        self.address = None      # Remote address, as in the udpgw messages
+        self.tunnel = None       # PumpkinUdpgwTunnel the flow's datagrams go through
+        self.lastActivity = 0    # When a datagram last went through either way (udpgw_flow_timeout)
+        self.closed = False      # Expired, or its session closed
+
+
+class PumpkinUdpgwSession(object):
+    '''
+        The udpgw side of a client connection to udpgw_port: what was read and is to be written, its flows and its tunnels
+    '''
+    __slots__ = ('relay', 'key', 'inbuf', 'outbuf', 'flows', 'tunnels')
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.key = ('%s:%d|' %(relay.clientAddr[0], relay.clientAddr[1])).encode('utf-8') # Client part of the flows' hash keys
+        self.inbuf = bytearray()  # From the client, not yet a whole message
+        self.outbuf = bytearray() # To the client
+        self.flows = {}           # conid -> PumpkinUdpgwFlow
+        self.tunnels = {}         # PumpkinBackend -> PumpkinUdpgwTunnel
+
+
+class PumpkinUdpgwTunnel(object):
+    '''
+        A udpgw connection opened through the SOCKS5 port of one worker, carrying the flows of a PumpkinUdpgwSession bound to that worker
+    '''
+    __slots__ = ('session', 'backend', 'sock', 'state', 'inbuf', 'outbuf', 'events', 'connectStart', 'connectTimer', 'closed')
+
+    socksState = PumpkinRelay.UDPGW # Routes its events to PumpkinUdpgwMux, as for the session's relay
+
+    # state values
+    CONNECTING = 1 # Waiting for the connect to the worker
+    GREETING = 2   # Waiting for the worker's method selection reply
+    REQUEST = 3    # Waiting for the worker's reply to the CONNECT to the udpgw server
+    OPEN = 4       # Passing udpgw messages
+
+    def __init__(self, session, backend):
+        self.session = session
+        self.backend = backend
+        self.sock = None
+        self.state = self.CONNECTING
+        self.inbuf = bytearray()  # From the worker, not yet a whole message
+        self.outbuf = bytearray() # To the worker, held until OPEN
+        self.events = 0           # Registered with the selector
+        self.connectStart = 0
+        self.connectTimer = None
+        self.closed = False
+
+
+class PumpkinUdpgwMux(object):
+    '''
+        Spreads the UDP flows of udpgw connections (udpgw_port) over the workers, for PumpkinEventLoop.
+
+        The listener answers the client's SOCKS5 request itself. Each flow of the client (udpgw conid) is bound to the worker
+          picked by rendezvous hashing of (client, conid, remote address), and its datagrams go through the session's tunnel
+          to that worker, opened on first use. Replies come back the same way, under the same conid.
+          A flow is bound anew (and the server told with UDPGW_REBIND) when its address changes, when its tunnel failed,
+          and after being idle for udpgw_flow_timeout.
+    '''
+    def __init__(self, eventLoop):
+        self.eventLoop = eventLoop
+        self.listener = eventLoop.listener
+        self.flowWheel = PumpkinTimerWheel(self.listener.udpgwFlowTimeout, self.flowExpired)
+        self.wheelTurning = False # A turn of flowWheel is scheduled
+        self.sessions = 0         # Open udpgw client connections
+        self.flows = 0            # Flows bound to a tunnel
+        self.dropped = 0          # Datagrams dropped because the socket they were for was UDPGW_MAX_PENDING behind
+
+    def start(self, relay, data):
+        '''
+            start - Serve relay as a udpgw connection, data being what the client sent past its SOCKS5 request
+        '''
+        relay.socksState = PumpkinRelay.UDPGW
+        relay.udpgw = session = PumpkinUdpgwSession(relay)
+        self.sessions += 1
+        session.outbuf += SOCKS5_SUCCEEDED
+        session.inbuf += data
+        self.clientMessages(session)
+        self.sendClient(session)
+
+    def handleEvents(self, obj, sock, events):
+        if obj.__class__ is PumpkinUdpgwTunnel:
+            try:
+                self.tunnelEvents(obj, events)
+            except Exception as e:
+                self.tunnelFailed(obj, str(e))
+            return
+
+        relay = obj
+        try:
+            if events & selectors.EVENT_WRITE:
+                self.sendClient(relay.udpgw)
+            if events & selectors.EVENT_READ and relay.closed is False:
+                try:
+                    data = sock.recv(UDPGW_READ_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return
+                if not data:
+                    self.eventLoop.closeRelay(relay)
+                    return
+                relay.udpgw.inbuf += data
+                self.clientMessages(relay.udpgw)
+        except Exception as e:
+            logconn('Error on udpgw connection from %s: %s\n' %(str(relay.clientAddr), str(e)), True)
+            self.eventLoop.closeRelay(relay)
+
+    def clientMessages(self, session):
+        '''
+            clientMessages - Pass the whole messages read from the client on to the tunnels of their flows
+        '''
+        now = time.monotonic()
+        touched = set()
+        for (flags, conid, message) in splitUdpgwMessages(session.inbuf):
+            if flags & UDPGW_KEEPALIVE:
+                for tunnel in session.tunnels.values():
+                    self.queue(tunnel.outbuf, message)
+                    touched.add(tunnel)
+                continue
+
+            address = message[5:23] if flags & UDPGW_IPV6 else message[5:11]
+            flow = session.flows.get(conid)
+            if flow is None or flow.tunnel.closed is True or flow.address != address or flags & UDPGW_REBIND:
+                flow = self.bindFlow(session, conid, address, flow)
+                if flow is None:
+                    self.dropped += 1
+                    continue
+                # Whichever socket the server had for this conid is stale
+                message = message[:2] + bytes( (flags | UDPGW_REBIND,) ) + message[3:]
+            flow.lastActivity = now
+            self.queue(flow.tunnel.outbuf, message)
+            touched.add(flow.tunnel)
+
+        for tunnel in touched:
+            self.sendTunnel(tunnel)
+
+    def bindFlow(self, session, conid, address, flow):
+        '''
+            bindFlow - Bind a flow (new, or flow) to the tunnel of the worker its hash picks, opening that tunnel if need be.
+
+              @return <PumpkinUdpgwFlow/None> - None if every worker is at max_conns
+        '''
+        backend = self.listener.rendezvousBackend(session.key + struct.pack('<H', conid) + address)
+        if backend is None:
+            return None
+        tunnel = session.tunnels.get(backend)
+        if tunnel is None:
+            tunnel = self.openTunnel(session, backend)
+        if flow is None:
+            flow = PumpkinUdpgwFlow(session, conid)
+            session.flows[conid] = flow
+            self.flows += 1
+            flow.lastActivity = time.monotonic()
+            self.flowWheel.add(flow)
+            if self.wheelTurning is False:
+                self.wheelTurning = True
+                self.eventLoop.callLater(self.flowWheel.tick, self.turnFlowWheel)
+        flow.address = address
+        flow.tunnel = tunnel
+        return flow
+
+    def flowExpired(self, flow):
+        flow.closed = True
+        self.flows -= 1
+        session = flow.session
+        del session.flows[flow.conid]
+        # Release the worker connection once no flow is left on it
+        tunnel = flow.tunnel
+        for other in session.flows.values():
+            if other.tunnel is tunnel:
+                return
+        self.closeTunnel(tunnel)
+
+    def turnFlowWheel(self):
+        wheel = self.flowWheel
+        wheel.turn(time.monotonic())
+        if wheel.size:
+            self.eventLoop.callLater(wheel.tick, self.turnFlowWheel)
+        else:
+            self.wheelTurning = False
+
+    def queue(self, outbuf, message):
+        if len(outbuf) + len(message) > UDPGW_MAX_PENDING:
+            self.dropped += 1
+        else:
+            outbuf += message
+
+    def openTunnel(self, session, backend):
+        eventLoop = self.eventLoop
+        tunnel = PumpkinUdpgwTunnel(session, backend)
+        session.tunnels[backend] = tunnel
+        backend.connectionOpened()
+        tunnel.connectStart = time.time()
+        addr = backend.nextAddress()
+        if addr is None:
+            self.tunnelFailed(tunnel, 'not resolved')
+            return tunnel
+
+        sock = tunnel.sock = socket.socket(addressFamily(addr), socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            err = sock.connect_ex( (addr, backend.port) )
+        except Exception as e:
+            err = str(e)
+        if err not in (0, errno.EINPROGRESS):
+            self.tunnelFailed(tunnel, isinstance(err, int) and os.strerror(err) or err)
+            return tunnel
+        tunnel.events = eventLoop._setEvents(sock, 0, selectors.EVENT_WRITE, tunnel)
+        if self.listener.connectTimeout:
+            tunnel.connectTimer = eventLoop.callLater(self.listener.connectTimeout, self.tunnelTimedOut, tunnel)
+        return tunnel
+
+    def tunnelTimedOut(self, tunnel):
+        tunnel.connectTimer = None
+        if tunnel.state != PumpkinUdpgwTunnel.OPEN:
+            self.tunnelFailed(tunnel, 'timed out after %g seconds' %(self.listener.connectTimeout,))
+
+    def tunnelEvents(self, tunnel, events):
+        sock = tunnel.sock
+        if tunnel.state == PumpkinUdpgwTunnel.CONNECTING:
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                self.tunnelFailed(tunnel, os.strerror(err))
+                return
+            # The request is only sent once the worker answered the greeting; ssh -D does not read ahead.
+            sock.send(SOCKS5_GREETING)
+            tunnel.state = PumpkinUdpgwTunnel.GREETING
+            tunnel.events = self.eventLoop._setEvents(sock, tunnel.events, selectors.EVENT_READ, tunnel)
+            return
+
+        if events & selectors.EVENT_WRITE:
+            self.sendTunnel(tunnel)
+        if not events & selectors.EVENT_READ or tunnel.closed is True:
+            return
+        try:
+            data = sock.recv(UDPGW_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            self.tunnelFailed(tunnel, 'closed by the worker')
+            return
+        tunnel.inbuf += data
+
+        if tunnel.state == PumpkinUdpgwTunnel.GREETING:
+            if len(tunnel.inbuf) < 2:
+                return
+            if tunnel.inbuf[:2] != SOCKS5_NO_AUTH:
+                self.tunnelFailed(tunnel, 'unexpected SOCKS5 greeting reply %r' %(bytes(tunnel.inbuf[:2]),))
+                return
+            del tunnel.inbuf[:2]
+            sock.send(b'\x05\x01\x00' + tunnel.session.relay.destination)
+            tunnel.state = PumpkinUdpgwTunnel.REQUEST
+        if tunnel.state == PumpkinUdpgwTunnel.REQUEST:
+            parsed = parseSocks5Request(tunnel.inbuf) # The reply has the same layout
+            if parsed is None:
+                return
+            if tunnel.inbuf[1] != 0:
+                self.tunnelFailed(tunnel, 'SOCKS5 request failed with code %d' %(tunnel.inbuf[1],))
+                return
+            del tunnel.inbuf[:parsed[0]]
+            tunnel.state = PumpkinUdpgwTunnel.OPEN
+            self.eventLoop.cancelTimer(tunnel.connectTimer)
+            tunnel.connectTimer = None
+            tunnel.backend.recordConnect(time.time() - tunnel.connectStart, self.listener.ewmaAlpha)
+            self.sendTunnel(tunnel) # What was queued meanwhile
+
+        tunnel.backend.stats[PumpkinMetrics.BYTES_RECEIVED] += len(data)
+        session = tunnel.session
+        now = time.monotonic()
+        for (flags, conid, message) in splitUdpgwMessages(tunnel.inbuf):
+            flow = session.flows.get(conid)
+            if flow is None or flow.tunnel is not tunnel:
+                continue # For a flow that expired, or is bound elsewhere by now
+            flow.lastActivity = now
+            self.queue(session.outbuf, message)
+        self.sendClient(session)
+
+    def sendTunnel(self, tunnel):
+        if tunnel.closed is True or tunnel.state != PumpkinUdpgwTunnel.OPEN:
+            return
+        if tunnel.outbuf:
+            try:
+                sent = tunnel.sock.send(tunnel.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except Exception as e:
+                self.tunnelFailed(tunnel, str(e))
+                return
+            del tunnel.outbuf[:sent]
+            tunnel.backend.stats[PumpkinMetrics.BYTES_SENT] += sent
+        events = selectors.EVENT_READ
+        if tunnel.outbuf:
+            events |= selectors.EVENT_WRITE
+        tunnel.events = self.eventLoop._setEvents(tunnel.sock, tunnel.events, events, tunnel)
+
+    def sendClient(self, session):
+        relay = session.relay
+        if relay.closed is True:
+            return
+        if session.outbuf:
+            try:
+                sent = relay.clientSocket.send(session.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except Exception as e:
+                logconn('Error on udpgw connection from %s: %s\n' %(str(relay.clientAddr), str(e)), True)
+                self.eventLoop.closeRelay(relay)
+                return
+            del session.outbuf[:sent]
+        events = selectors.EVENT_READ
+        if session.outbuf:
+            events |= selectors.EVENT_WRITE
+        relay.clientEvents = self.eventLoop._setEvents(relay.clientSocket, relay.clientEvents, events, relay)
+
+    def tunnelFailed(self, tunnel, reason):
+        if tunnel.closed is True:
+            return
+        logconn('udpgw tunnel of %s through worker %s failed: %s\n' %(str(tunnel.session.relay.clientAddr), str(tunnel.backend), reason), True)
+        if tunnel.state != PumpkinUdpgwTunnel.OPEN:
+            tunnel.backend.recordConnectFailure()
+            self.listener.markFailed(tunnel.backend, reason)
+        self.closeTunnel(tunnel)
+        # Its flows are bound anew on their next datagram
+
+    def closeTunnel(self, tunnel):
+        if tunnel.closed is True:
+            return
+        tunnel.closed = True
+        self.eventLoop.cancelTimer(tunnel.connectTimer)
+        tunnel.connectTimer = None
+        tunnel.backend.connectionClosed()
+        self.eventLoop._closeSocket(tunnel.sock, tunnel.events)
+        tunnel.events = 0
+        if tunnel.session.tunnels.get(tunnel.backend) is tunnel:
+            del tunnel.session.tunnels[tunnel.backend]
+        # Its worker slot is free for relays waiting on max_conns, as in closeRelay
+        if self.eventLoop.queued:
+            self.eventLoop.dispatchQueued()
+
+    def closeSession(self, relay):
+        '''
+            closeSession - Close the tunnels of a udpgw connection that is being closed
+        '''
+        session = relay.udpgw
+        relay.udpgw = None
+        self.sessions -= 1
+        for tunnel in list(session.tunnels.values()):
+            self.closeTunnel(tunnel)
+        for flow in session.flows.values():
+            flow.closed = True
+        self.flows -= len(session.flows)
+        session.flows.clear()
+
+
+class PumpkinEventLoop(object):
+    '''
+        Serves every connection accepted by a PumpkinListener from a single selectors loop,
+          instead of forking a PumpkinWorker for each one (engine=eventloop).
+
+        Each direction of a relay is a channel (PumpkinSpliceChannel or PumpkinBufferChannel) of bounded size.
+          A socket is only read from while its channel has room.
+    '''
+    def __init__(self, listener):
+        self.listener = listener
+        self.bufferSize = listener.bufferSize
+        useSplice = listener.options['splice']
+        if useSplice == 'auto':
+            useSplice = spliceSupported()
+        self.channelClass = useSplice and PumpkinSpliceChannel or PumpkinBufferChannel
+        self.selector = selectors.DefaultSelector()
+        self.relays = {}         # client fileno -> PumpkinRelay
+        self.listenSocket = None
+        self.timers = []         # heap of (deadline, sequence, timer)
+        self.timerSequence = itertools.count()
+        self.queued = collections.deque() # Relays waiting for a worker below max_conns, oldest first
+        self.accepting = False   # Listen socket registered (unregistered while at max_connections)
+        self.acceptTimer = None  # Timer to register it again after accept() failed (ACCEPT_BACKOFF)
+        self.idleWheel = None    # Relays to expire after idle_timeout
+        self.wheelTurning = False # A turn of idleWheel is scheduled
+        if listener.idleTimeout:
+            self.idleWheel = PumpkinTimerWheel(listener.idleTimeout, self.idleTimedOut)
+        self.udpgw = listener.udpgwPort and PumpkinUdpgwMux(self) or None # udpgw connections (udpgw_port)
+
+    def callLater(self, delay, callback, *args):
+        '''
+            callLater - Run callback(*args) from the loop, delay seconds from now.
+
+              @return <list> - Timer handle, for cancelTimer
+        '''
+        deadline = time.monotonic() + delay
+        timer = [callback, args]
+        heapq.heappush(self.timers, (deadline, next(self.timerSequence), timer))
+        return timer
+
+    @staticmethod
+    def cancelTimer(timer):
+        if timer is not None:
+            timer[0] = None
+
+    def runTimers(self):
+        '''
+            runTimers - Run the timers that are due.
+
+              @return <float/None> - Seconds until the next timer is due, or None if there is none
+        '''
+        timers = self.timers
+        while timers:
+            (deadline, sequence, timer) = timers[0]
+            now = time.monotonic()
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(timers)
+            if timer[0] is not None:
+                timer[0](*timer[1])
+        return None
+
+    def run(self, listenSocket):
+        listenSocket.setblocking(False)
+        self.listenSocket = listenSocket
+        self.selector.register(listenSocket, selectors.EVENT_READ, None)
+        self.accepting = True
+        if self.listener.socksAffinity == 'sticky':
+            self.callLater(self.listener.affinityTtl, self.expireStickyBackends)
+
+        select = self.selector.select
+        listener = self.listener
+        while listener.keepGoing is True and (listener.draining is False or self.relays):
+            for (key, events) in select(self.runTimers()):
+                relay = key.data
+                if relay is None:
+                    self.acceptClients()
+                elif relay.closed is False:
+                    self.handleEvents(relay, key.fileobj, events)
+
+    def expireStickyBackends(self):
+        self.listener.expireStickyBackends()
+        self.callLater(self.listener.affinityTtl, self.expireStickyBackends)
+
+    def acceptClients(self):
+        listener = self.listener
+        while listener.keepGoing is True and listener.draining is False:
+            if listener.maxConnections and len(self.relays) >= listener.maxConnections:
+                # Further clients wait in the backlog until a relay closes
+                self.selector.unregister(self.listenSocket)
+                self.accepting = False
+                return
+            try:
+                (clientSocket, clientAddr) = self.listenSocket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                logerr('Failed to accept on %s:%d: %s\n' %(listener.localAddr, listener.localPort, str(e)))
+                # The pending client is still there, so select() would report it right away again
+                self.selector.unregister(self.listenSocket)
+                self.accepting = False
+                self.acceptTimer = self.callLater(ACCEPT_BACKOFF, self.resumeAccepting)
+                return
+
+            listener.stats[PumpkinMetrics.ACCEPTED] += 1
+            clientSocket.setblocking(False)
+            relay = PumpkinRelay(clientSocket, clientAddr)
+            self.relays[relay.clientFd] = relay
+            if listener.parseSocks is True:
+                # The worker is chosen once the destination is known
+                relay.socksState = PumpkinRelay.SOCKS_GREETING
+                relay.clientEvents = self._setEvents(clientSocket, 0, selectors.EVENT_READ, relay)
+                continue
+            self.dispatch(relay)
+
+    def resumeAccepting(self):
+        '''
+            resumeAccepting - Register the listen socket again, ACCEPT_BACKOFF after accept() failed
+        '''
+        self.acceptTimer = None
+        listener = self.listener
+        if listener.keepGoing is True and listener.draining is False and (not listener.maxConnections or len(self.relays) < listener.maxConnections):
+            self.selector.register(self.listenSocket, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def dispatch(self, relay):
+        '''
+            dispatch - Connect a new relay to the worker chosen for it, or queue it if every worker is at max_conns
+        '''
+        listener = self.listener
+        if relay.destination is not None:
+            backend = listener.backendForDestination(relay.destination)
+        else:
+            backend = listener.nextBackend()
+        if backend is not None:
+            self.connectWorker(relay, backend)
+            return
+        if not listener.queueTimeout:
+            self.shed(relay)
+            return
+        self.queued.append(relay)
+        relay.queueTimer = self.callLater(listener.queueTimeout, self.queueTimedOut, relay)
+
+    def dispatchQueued(self):
+        '''
+            dispatchQueued - Connect queued relays, oldest first, while workers have room
+        '''
+        queued = self.queued
+        while queued:
+            relay = queued[0]
+            if relay.closed is False:
+                if relay.destination is not None:
+                    backend = self.listener.backendForDestination(relay.destination)
+                else:
+                    backend = self.listener.nextBackend()
+                if backend is None:
+                    return
+                self.cancelTimer(relay.queueTimer)
+                relay.queueTimer = None
+                queued.popleft()
+                self.connectWorker(relay, backend)
+            else:
+                queued.popleft()
+
+    def queueTimedOut(self, relay):
+        if relay.closed is False:
+            self.queued.remove(relay)
+            self.shed(relay)
+
+    def shed(self, relay):
+        listener = self.listener
+        logconn('Dropping request from %s, every worker on %s:%d is at max_conns\n' %(str(relay.clientAddr), listener.localAddr, listener.localPort), True)
+        listener.stats[PumpkinMetrics.SHED] += 1
+        self.closeRelay(relay)
+
+    def connectWorker(self, relay, backend):
+        relay.backend = backend
+        addr = backend.nextAddress()
+        relay.workerAddr = addr or backend.addr
+        relay.workerPort = backend.port
+        relay.connectStart = time.time()
+        backend.connectionOpened()
+        pooled = self.listener.pool is not None and self.listener.pool.take(backend) or None
+        if pooled is not None:
+            (relay.workerSocket, relay.workerAddr, latency) = pooled
+            relay.connectStart -= latency # Accounted as if connected just now
+            self.finishConnect(relay)
+            return
+        if addr is None:
+            self.connectFailed(relay, 'not resolved')
+            return
+
+        workerSocket = relay.workerSocket = socket.socket(addressFamily(addr), socket.SOCK_STREAM)
+        workerSocket.setblocking(False)
+        try:
+            err = workerSocket.connect_ex( (relay.workerAddr, relay.workerPort) )
+        except Exception as e:
+            # connect_ex still raises on resolution failures
+            self.connectFailed(relay, str(e))
+            return
+
+        if err not in (0, errno.EINPROGRESS):
+            self.connectFailed(relay, os.strerror(err))
+            return
+
+        # Writable once the connect has completed (or failed)
+        relay.workerEvents = selectors.EVENT_WRITE
+        self.selector.register(workerSocket, selectors.EVENT_WRITE, relay)
+        if self.listener.connectTimeout:
+            relay.connectTimer = self.callLater(self.listener.connectTimeout, self.connectTimedOut, relay, workerSocket)
+        if self.listener.raceDelay is not None and relay.raceTimer is None:
+            relay.raceTimer = self.callLater(self.listener.raceDelay, self.startRacer, relay)
+
+    def connectTimedOut(self, relay, workerSocket):
+        if relay.closed is True or relay.connected is True:
+            return
+        reason = 'timed out after %g seconds' %(self.listener.connectTimeout,)
+        if relay.workerSocket is workerSocket:
+            self.connectFailed(relay, reason)
+            return
+        for racer in relay.racers or ():
+            if racer[1] is workerSocket:
+                self.racerFailed(relay, racer, reason)
+                return
+
+    def startRacer(self, relay):
+        '''
+            startRacer - (race_delay) The connects of a relay have not completed within race_delay: also connect to the next
+              worker it would fail over to, within the connect_retries budget. The first connect to complete wins (finishRace).
+        '''
+        self.cancelTimer(relay.raceTimer)
+        relay.raceTimer = None
+        if relay.closed is True or relay.connected is True:
+            return
+        listener = self.listener
+        racers = relay.racers or []
+        if len(relay.failedBackends) + 1 + len(racers) > listener.connectRetries:
+            return
+        backend = listener.nextBackend(exclude=relay.failedBackends + (relay.backend,) + tuple([racer[0] for racer in racers]))
+        if backend is None:
+            return
+
+        backend.connectionOpened()
+        addr = backend.nextAddress()
+        if addr is None:
+            self.raceFailed(relay, backend, backend.addr, 'not resolved')
+            self.startRacer(relay)
+            return
+        workerSocket = socket.socket(addressFamily(addr), socket.SOCK_STREAM)
+        workerSocket.setblocking(False)
+        try:
+            err = workerSocket.connect_ex( (addr, backend.port) )
+        except Exception as e:
+            err = str(e)
+        if err not in (0, errno.EINPROGRESS):
+            workerSocket.close()
+            self.raceFailed(relay, backend, addr, isinstance(err, int) and os.strerror(err) or err)
+            self.startRacer(relay)
+            return
+
+        self.selector.register(workerSocket, selectors.EVENT_WRITE, relay)
+        racer = [backend, workerSocket, addr, time.time(), None]
+        if listener.connectTimeout:
+            racer[4] = self.callLater(listener.connectTimeout, self.connectTimedOut, relay, workerSocket)
+        if not relay.racedBackends:
+            relay.racedBackends = (relay.backend,)
+        relay.racedBackends += (backend,)
+        relay.racers = racers + [racer]
+        relay.raceTimer = self.callLater(listener.raceDelay, self.startRacer, relay)
+
+    def finishRace(self, relay, workerSocket):
+        '''
+            finishRace - A connect racing the current one completed first: if it succeeded, it takes the current one's place.
+        '''
+        for racer in relay.racers:
+            if racer[1] is workerSocket:
+                break
+        else:
+            return
+        err = workerSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.racerFailed(relay, racer, os.strerror(err))
+            return
+
+        # The current connect lost
+        relay.racers.remove(racer)
+        self.cancelTimer(relay.connectTimer)
+        relay.backend.connectionClosed()
+        self._closeSocket(relay.workerSocket, relay.workerEvents)
+        self.cancelTimer(racer[4])
+        (relay.backend, relay.workerSocket, relay.workerAddr, relay.connectStart) = racer[:4]
+        relay.workerPort = relay.backend.port
+        relay.workerEvents = selectors.EVENT_WRITE
+        relay.connectTimer = None
+        self.finishConnect(relay)
+
+    def racerFailed(self, relay, racer, reason):
+        relay.racers.remove(racer)
+        self.cancelTimer(racer[4])
+        self._closeSocket(racer[1], selectors.EVENT_WRITE)
+        self.raceFailed(relay, racer[0], racer[2], reason)
+        # As when any connect fails, the next one starts right away
+        self.startRacer(relay)
+
+    def raceFailed(self, relay, backend, addr, reason):
+        logconn('Could not connect to worker %s:%d: %s\n' %(addr, backend.port, reason), True)
+        backend.connectionClosed()
+        backend.recordConnectFailure()
+        self.listener.markFailed(backend, reason)
+        relay.failedBackends += (backend,)
+
+    def closeRacers(self, relay):
+        '''
+            closeRacers - Close the connects still racing, once a relay connected or closed, and count the race
+        '''
+        self.cancelTimer(relay.raceTimer)
+        relay.raceTimer = None
+        for racer in relay.racers or ():
+            self.cancelTimer(racer[4])
+            racer[0].connectionClosed()
+            self._closeSocket(racer[1], selectors.EVENT_WRITE)
+        relay.racers = None
+        for backend in relay.racedBackends:
+            backend.recordRace(relay.connected is True and backend is relay.backend)
+        relay.racedBackends = ()
+
+    def finishConnect(self, relay):
+        err = relay.workerSocket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            self.connectFailed(relay, os.strerror(err))
+            return
+
+        listener = self.listener
+        relay.connected = True
+        self.cancelTimer(relay.connectTimer)
+        relay.connectTimer = None
+        if relay.raceTimer is not None or relay.racers:
+            self.closeRacers(relay)
+        if relay.failedBackends:
+            relay.backend.failoversIn += 1
+        relay.backend.recordConnect(time.time() - relay.connectStart, listener.ewmaAlpha)
+        relay.upstream = self.channelClass(self.bufferSize)
+        relay.downstream = self.channelClass(self.bufferSize)
+        if listener.readTimeout:
+            relay.readTimer = self.callLater(listener.readTimeout, self.readTimedOut, relay)
+        if self.idleWheel is not None:
+            relay.lastActivity = time.monotonic()
+            self.idleWheel.add(relay)
+            if self.wheelTurning is False:
+                self.wheelTurning = True
+                self.callLater(self.idleWheel.tick, self.turnIdleWheel)
+
+        if relay.socksState == PumpkinRelay.SOCKS_REPLAY:
+            # The request is only sent once the worker answered the greeting; ssh -D does not read ahead.
+            relay.workerSocket.send(SOCKS5_GREETING)
+            relay.socksState = PumpkinRelay.SOCKS_REPLY
+            relay.handshake = b''
+            relay.workerEvents = self._setEvents(relay.workerSocket, relay.workerEvents, selectors.EVENT_READ, relay)
+            return
+        if relay.replay:
+            relay.upstream.preload(relay.replay)
+            relay.replay = None
+        self.updateEvents(relay)
+
+    def advanceSocks(self, relay, sock):
+        '''
+            advanceSocks - Drive the SOCKS5 handshake of a relay (socks_affinity): answer the client,
+              pick the worker from the requested destination, then replay the handshake to the worker.
+        '''
+        listener = self.listener
+        if relay.socksState == PumpkinRelay.SOCKS_REPLY:
+            data = sock.recv(2 - len(relay.handshake))
+            if not data:
+                self.replayFailed(relay, 'closed during SOCKS5 greeting')
+                return
+            relay.handshake += data
+            if len(relay.handshake) < 2:
+                return
+            if relay.handshake != SOCKS5_NO_AUTH:
+                self.replayFailed(relay, 'unexpected SOCKS5 greeting reply %r' %(relay.handshake,))
+                return
+            self.cancelTimer(relay.readTimer)
+            relay.readTimer = None
+            # Worker's reply to the request goes straight back to the client
+            relay.socksState = None
+            relay.handshake = b''
+            relay.upstream.preload(relay.replay)
+            relay.replay = None
+            self.updateEvents(relay)
+            return
+
+        data = sock.recv(512)
+        if not data:
+            self.closeRelay(relay)
+            return
+        handshake = relay.handshake + data
+
+        try:
+            if relay.socksState == PumpkinRelay.SOCKS_GREETING:
+                parsed = parseSocks5Greeting(handshake)
+                if parsed is None:
+                    relay.handshake = handshake
+                    return
+                (length, methods) = parsed
+                if b'\x00' not in methods:
+                    sock.send(SOCKS5_NO_ACCEPTABLE)
+                    self.closeRelay(relay)
+                    return
+                sock.send(SOCKS5_NO_AUTH)
+                relay.socksState = PumpkinRelay.SOCKS_REQUEST
+                handshake = handshake[length:]
+
+            parsed = parseSocks5Request(handshake)
+        except ValueError:
+            if relay.socksState == PumpkinRelay.SOCKS_REQUEST:
+                raise
+            # Not SOCKS5 at all: fall back to a plain relay, passing along what was read
+            relay.socksState = None
+            relay.replay = handshake
+            relay.handshake = b''
+            relay.clientEvents = self._setEvents(relay.clientSocket, relay.clientEvents, 0, relay)
+            self.dispatch(relay)
+            return
+
+        if parsed is None:
+            relay.handshake = handshake
+            return
+
+        (length, destination) = parsed
+        if listener.udpgwPort and handshake[1] == 1 and struct.unpack('>H', destination[-2:])[0] == listener.udpgwPort:
+            # Its flows are spread over the workers rather than the whole connection going to one
+            relay.destination = destination
+            relay.handshake = b''
+            self.udpgw.start(relay, handshake[length:])
+            return
+
+        # Anything past the request was sent ahead by the client and follows it to the worker
+        relay.socksState = PumpkinRelay.SOCKS_REPLAY
+        relay.replay = handshake
+        relay.handshake = b''
+        relay.destination = destination
+        relay.clientEvents = self._setEvents(relay.clientSocket, relay.clientEvents, 0, relay)
+        self.dispatch(relay)
+
+    def replayFailed(self, relay, reason):
+        '''
+            replayFailed - The worker did not accept the replayed SOCKS5 greeting. Treated as a failed connect, so the client fails over.
+        '''
+        for channel in (relay.upstream, relay.downstream):
+            channel.close()
+        relay.upstream = relay.downstream = None
+        relay.connected = False
+        relay.socksState = PumpkinRelay.SOCKS_REPLAY
+        # Armed by finishConnect, which arms them again once failed over
+        self.cancelTimer(relay.readTimer)
+        relay.readTimer = None
+        if self.idleWheel is not None:
+            self.idleWheel.remove(relay)
+        self.connectFailed(relay, reason)
+
+    def connectFailed(self, relay, reason):
+        logconn('Could not connect to worker %s:%d: %s\n' %(relay.workerAddr, relay.workerPort, reason), True)
+
+        listener = self.listener
+        failedBackend = relay.backend
+        failedBackend.connectionClosed()
+        failedBackend.recordConnectFailure()
+        listener.markFailed(failedBackend, reason)
+        self.cancelTimer(relay.connectTimer)
+        relay.connectTimer = None
+        self._closeSocket(relay.workerSocket, relay.workerEvents)
+        relay.workerSocket = None
+        relay.workerEvents = 0
+        relay.backend = None
+
+        relay.failedBackends += (failedBackend,)
+        if relay.racers:
+            # The oldest connect racing this one takes its place, and the next one starts right away
+            (relay.backend, relay.workerSocket, relay.workerAddr, relay.connectStart, relay.connectTimer) = relay.racers.pop(0)
+            relay.workerPort = relay.backend.port
+            relay.workerEvents = selectors.EVENT_WRITE
+            self.startRacer(relay)
+            return
+        nextBackend = None
+        if len(relay.failedBackends) <= listener.connectRetries:
+            nextBackend = listener.nextBackend(exclude=relay.failedBackends)
+        if nextBackend is None:
+            logconn('Giving up on request from %s after %d attempts\n' %(str(relay.clientAddr), len(relay.failedBackends)), True)
+            listener.failoverExhausted += 1
+            listener.stats[PumpkinMetrics.FAILOVERS_EXHAUSTED] += 1
+            self.closeRelay(relay)
+            return
+
+        listener.failoverAttempts += 1
+        listener.stats[PumpkinMetrics.FAILOVERS] += 1
+        logconn('Failing over request from %s from %s:%d to %s\n' %(relay.clientAddr, relay.workerAddr, relay.workerPort, str(nextBackend)))
+        self.connectWorker(relay, nextBackend)
+
+    def handleEvents(self, relay, sock, events):
+        try:
+            if relay.socksState is not None and relay.socksState != PumpkinRelay.SOCKS_REPLAY:
+                if relay.socksState == PumpkinRelay.UDPGW:
+                    self.udpgw.handleEvents(relay, sock, events)
+                else:
+                    self.advanceSocks(relay, sock)
+                return
+
+            if relay.connected is False:
+                if sock is relay.workerSocket:
+                    self.finishConnect(relay)
+                elif relay.racers:
+                    self.finishRace(relay, sock)
+                return
+
+            if sock is relay.clientSocket:
+                (readChannel, writeChannel, otherSocket, bytesField) = (relay.upstream, relay.downstream, relay.workerSocket, PumpkinMetrics.BYTES_SENT)
+            else:
+                (readChannel, writeChannel, otherSocket, bytesField) = (relay.downstream, relay.upstream, relay.clientSocket, PumpkinMetrics.BYTES_RECEIVED)
+
+            if events & selectors.EVENT_WRITE:
+                writeChannel.drain(sock)
+            if events & selectors.EVENT_READ and readChannel.canFill():
+                received = readChannel.fill(sock)
+                if received:
+                    relay.backend.stats[bytesField] += received
+                    relay.lastActivity = time.monotonic()
+                    if relay.connectStart and sock is relay.workerSocket:
+                        relay.backend.recordFirstByte(time.time() - relay.connectStart, self.listener.ewmaAlpha)
+                        relay.connectStart = 0
+                        self.cancelTimer(relay.readTimer)
+                        relay.readTimer = None
+                # Most of the time the other side can take it right away, which saves a trip through the selector.
+                readChannel.drain(otherSocket)
+
+            if (readChannel.eof is True or writeChannel.eof is True) and self.propagateEof(relay) is True:
+                return
+            self.updateEvents(relay)
+        except Exception as e:
+            if relay.workerAddr is None:
+                logconn('Error on request from %s: %s\n' %(str(relay.clientAddr), str(e)), True)
+            else:
+                logconn('Error on %s:%d: %s\n' %(relay.workerAddr, relay.workerPort, str(e)), True)
+            self.closeRelay(relay)
+
+    def propagateEof(self, relay):
+        '''
+            propagateEof - Pass a half-close on: once one side sent EOF and all it sent was delivered,
+              shut down writing to the other side. The other direction keeps flowing until it ends too.
+
+              @return <bool> - True if both directions are done and the relay was closed
+        '''
+        for (channel, sock) in ( (relay.upstream, relay.workerSocket), (relay.downstream, relay.clientSocket) ):
+            if channel.eof is True and channel.shut is False and channel.pending == 0:
+                channel.shut = True
+                sock.shutdown(socket.SHUT_WR)
+
+        if relay.upstream.shut is True and relay.downstream.shut is True:
+            self.closeRelay(relay)
+            return True
+        return False
+
+    def readTimedOut(self, relay):
+        relay.readTimer = None
+        if relay.closed is False:
+            logconn('Closing request from %s to %s:%d: nothing back within %g seconds\n' %(str(relay.clientAddr), relay.workerAddr, relay.workerPort, self.listener.readTimeout), True)
+            self.closeRelay(relay)
+
+    def idleTimedOut(self, relay):
+        logconn('Closing request from %s to %s:%d: idle for %g seconds\n' %(str(relay.clientAddr), relay.workerAddr, relay.workerPort, self.listener.idleTimeout))
+        self.closeRelay(relay)
+
+    def turnIdleWheel(self):
+        wheel = self.idleWheel
+        wheel.turn(time.monotonic())
+        # Only keep turning while there are relays on the wheel
+        if wheel.size:
+            self.callLater(wheel.tick, self.turnIdleWheel)
+        else:
+            self.wheelTurning = False
+
+    def updateEvents(self, relay):
+        (upstream, downstream) = (relay.upstream, relay.downstream)
+        clientEvents = workerEvents = 0
+        if upstream.canFill():
+            clientEvents |= selectors.EVENT_READ
+        if upstream.pending:
+            workerEvents |= selectors.EVENT_WRITE
+        if downstream.canFill():
+            workerEvents |= selectors.EVENT_READ
+        if downstream.pending:
+            clientEvents |= selectors.EVENT_WRITE
+
+        relay.clientEvents = self._setEvents(relay.clientSocket, relay.clientEvents, clientEvents, relay)
+        relay.workerEvents = self._setEvents(relay.workerSocket, relay.workerEvents, workerEvents, relay)
+
+    def _setEvents(self, sock, oldEvents, newEvents, relay):
+        if oldEvents == newEvents:
+            return newEvents
+        if oldEvents == 0:
+            self.selector.register(sock, newEvents, relay)
+        elif newEvents == 0:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, newEvents, relay)
+        return newEvents
+
+    def _closeSocket(self, sock, registeredEvents):
+        if sock is None:
+            return
+        if registeredEvents != 0:
+            try:
+                self.selector.unregister(sock)
+            except:
+                pass
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            sock.close()
+        except:
+            pass
+
+    def closeRelay(self, relay):
+        if relay.closed is True:
+            return
+        relay.closed = True
+        self.cancelTimer(relay.connectTimer)
+        self.cancelTimer(relay.queueTimer)
+        self.cancelTimer(relay.readTimer)
+        self.closeRacers(relay)
+        freedBackend = relay.backend is not None and relay.workerSocket is not None
+        if freedBackend is True:
+            relay.backend.connectionClosed()
+        self._closeSocket(relay.workerSocket, relay.workerEvents)
+        self._closeSocket(relay.clientSocket, relay.clientEvents)
+        for channel in (relay.upstream, relay.downstream):
+            if channel is not None:
+                channel.close()
+        relay.upstream = relay.downstream = None
+        if relay.udpgw is not None:
+            self.udpgw.closeSession(relay)
+        self.relays.pop(relay.clientFd, None)
+
+        listener = self.listener
+        if freedBackend is True and self.queued:
+            self.dispatchQueued()
+        if self.accepting is False and self.acceptTimer is None and listener.keepGoing is True and listener.draining is False and len(self.relays) < listener.maxConnections:
+            self.selector.register(self.listenSocket, selectors.EVENT_READ, None)
+            self.accepting = True
+
+    def stopAccepting(self):
+        '''
+            stopAccepting - Accept no more clients (when draining). The listen socket is closed, not shut down, as it may be shared with the PumpkinLB that took over.
+        '''
+        if self.accepting is True:
+            self.selector.unregister(self.listenSocket)
+            self.accepting = False
+        self.cancelTimer(self.acceptTimer)
+        self.acceptTimer = None
+        self.listenSocket.close()
+
+    def closeAll(self):
+        for relay in list(self.relays.values()):
+            self.closeRelay(relay)
+        try:
+            self.selector.close()
+        except:
+            pass
+
+
+### metrics ###
+def readAcceptQueues():
+    '''
+        readAcceptQueues - Read the accept queues of all listening TCP sockets from /proc/net/tcp{,6} (Linux)
+
+          @return <dict> - port -> clients waiting to be accepted, summed over the sockets listening on that port
+    '''
+    queues = {}
+    for filename in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(filename, 'r') as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 5 or fields[3] != '0A': # LISTEN
+                continue
+            port = int(fields[1].rsplit(':', 1)[1], 16)
+            # For a listening socket, rx_queue is the current accept queue
+            queues[port] = queues.get(port, 0) + int(fields[4].split(':')[1], 16)
+    return queues
+
+
+class PumpkinMetricsServer(threading.Thread):
+    '''
+        Serves the PumpkinMetrics of every listener process in the Prometheus text format, from the main process.
+          Counters of the listener processes sharing a mapping (listener_processes) are summed.
+    '''
+    def __init__(self, addr, port, getListeners, listenSocket=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.getListeners = getListeners # Returns the current PumpkinListener list
+        self.stopped = False             # Set once draining, the PumpkinLB that took over the socket answers from then on
+        if listenSocket is None:
+            listenSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listenSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listenSocket.bind( (addr, port) )
+            listenSocket.listen(16)
+        # Also when handed over: if the PumpkinLB sharing it takes the pending client first, accept() must not block
+        listenSocket.setblocking(False)
+        self.listenSocket = listenSocket
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        while True:
+            try:
+                # Waits with a timeout rather than in accept(), to notice stop()
+                readable = select.select([self.listenSocket], [], [], 1)[0]
+                if self.stopped is True:
+                    return
+                if not readable:
+                    continue
+                (clientSocket, clientAddr) = self.listenSocket.accept()
+            except BlockingIOError:
+                continue # Taken by the PumpkinLB sharing the socket
+            except Exception as e:
+                logerr('Metrics listener failed to accept: %s\n' %(str(e),))
+                time.sleep(1)
+                continue
+            try:
+                self.serveRequest(clientSocket)
+            except Exception as e:
+                logerr('Error serving metrics to %s: %s\n' %(str(clientAddr), str(e)))
+            finally:
+                clientSocket.close()
+
+    def serveRequest(self, clientSocket):
+        clientSocket.settimeout(5)
+        request = b''
+        while b'\r\n\r\n' not in request and len(request) < 8192:
+            data = clientSocket.recv(4096)
+            if not data:
+                return
+            request += data
+
+        requestLine = request.split(b'\r\n', 1)[0].split(b' ')
+        path = len(requestLine) > 1 and requestLine[1].split(b'?', 1)[0] or b''
+        if path in (b'/', b'/metrics'):
+            (status, body) = ('200 OK', self.render().encode('utf-8'))
+        else:
+            (status, body) = ('404 Not Found', b'Not Found\n')
+        clientSocket.sendall(('HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' %(status, len(body))).encode('utf-8') + body)
+
+    def render(self):
+        '''
+            render - Sum the counters of all listener processes per mapping, and format them as Prometheus metrics
+        '''
+        mappings = {} # 'addr:port' -> [listener stats, [backend stats], [backend labels], port]
+        for listener in self.getListeners():
+            metrics = listener.metrics
+            if metrics.array is None:
+                continue
+            key = '%s:%d' %(listener.localAddr, listener.localPort)
+            # Every worker the mapping had since startup, including those removed by a reload (their connections may still be draining)
+            slots = sorted([(slot, label) for (label, slot) in metrics.slots.items() if slot < metrics.capacity])
+            if key not in mappings:
+                mappings[key] = [[0.0] * PumpkinMetrics.LISTENER_FIELDS,
+                    [[0.0] * PumpkinMetrics.BACKEND_FIELDS for slot in slots],
+                    [label for (slot, label) in slots], listener.localPort]
+            totals = mappings[key]
+            for (idx, value) in enumerate(metrics.listenerStats()):
+                totals[0][idx] += value
+            for (backendTotals, (slot, label)) in zip(totals[1], slots):
+                for (idx, value) in enumerate(metrics.backendStats(slot)):
+                    backendTotals[idx] += value
+
+        acceptQueues = readAcceptQueues()
+        lines = []
+        def addMetric(name, metricType, helpText, samples):
+            lines.append('# HELP pumpkinlb_%s %s' %(name, helpText))
+            lines.append('# TYPE pumpkinlb_%s %s' %(name, metricType))
+            for (suffix, labels, value) in samples:
+                lines.append('pumpkinlb_%s%s{%s} %s' %(name, suffix, ','.join(['%s="%s"' %label for label in labels]), repr(float(value)) if value % 1 else '%d' %(value,)))
+
+        def listenerSamples(field):
+            return [('', [('listener', key)], totals[0][field]) for (key, totals) in mappings.items()]
+
+        def backendSamples(getValue):
+            samples = []
+            for (key, totals) in mappings.items():
+                for (backendTotals, backendLabel) in zip(totals[1], totals[2]):
+                    samples.append( ('', [('listener', key), ('backend', backendLabel)], getValue(backendTotals)) )
+            return samples
+
+        addMetric('accepted_total', 'counter', 'Client connections accepted.', listenerSamples(PumpkinMetrics.ACCEPTED))
+        addMetric('failovers_total', 'counter', 'Connects retried on another worker after a failed connect.', listenerSamples(PumpkinMetrics.FAILOVERS))
+        addMetric('failovers_exhausted_total', 'counter', 'Clients dropped because every allowed connect attempt failed.', listenerSamples(PumpkinMetrics.FAILOVERS_EXHAUSTED))
+        addMetric('shed_total', 'counter', 'Clients disconnected after waiting queue_timeout for a worker below max_conns.', listenerSamples(PumpkinMetrics.SHED))
+        addMetric('accept_queue', 'gauge', 'Clients waiting in the kernel to be accepted.',
+            [('', [('listener', key)], acceptQueues.get(totals[3], 0)) for (key, totals) in mappings.items()])
+
+        addMetric('backend_active_connections', 'gauge', 'Connections currently relayed to the worker.',
+            backendSamples(lambda stats : stats[PumpkinMetrics.OPENED] - stats[PumpkinMetrics.CLOSED]))
+        addMetric('backend_connections_total', 'counter', 'Connections started to the worker (including failed connects).',
+            backendSamples(lambda stats : stats[PumpkinMetrics.OPENED]))
+        addMetric('backend_bytes_sent_total', 'counter', 'Bytes relayed from clients to the worker.',
+            backendSamples(lambda stats : stats[PumpkinMetrics.BYTES_SENT]))
+        addMetric('backend_bytes_received_total', 'counter', 'Bytes relayed from the worker to clients.',
+            backendSamples(lambda stats : stats[PumpkinMetrics.BYTES_RECEIVED]))
+        addMetric('backend_connect_failures_total', 'counter', 'Failed connects to the worker (including timeouts).',
+            backendSamples(lambda stats : stats[PumpkinMetrics.CONNECT_FAILURES]))
+        addMetric('backend_race_attempts_total', 'counter', 'Connects to the worker that raced connects to other workers (race_delay).',
+            backendSamples(lambda stats : stats[PumpkinMetrics.RACE_ATTEMPTS]))
+        addMetric('backend_race_wins_total', 'counter', 'Races the connect to the worker won.',
+            backendSamples(lambda stats : stats[PumpkinMetrics.RACE_WINS]))
+
+        histogram = []
+        bounds = [repr(bound) for bound in PumpkinMetrics.LATENCY_BUCKETS] + ['+Inf']
+        for (key, totals) in mappings.items():
+            for (backendTotals, backendLabel) in zip(totals[1], totals[2]):
+                cumulative = 0
+                for (idx, bound) in enumerate(bounds):
+                    cumulative += backendTotals[PumpkinMetrics.LATENCY_BUCKET + idx]
+                    histogram.append( ('_bucket', [('listener', key), ('backend', backendLabel), ('le', bound)], cumulative) )
+                histogram.append( ('_sum', [('listener', key), ('backend', backendLabel)], backendTotals[PumpkinMetrics.LATENCY_SUM]) )
+                histogram.append( ('_count', [('listener', key), ('backend', backendLabel)], backendTotals[PumpkinMetrics.LATENCY_COUNT]) )
+        addMetric('backend_connect_seconds', 'histogram', 'Time taken by successful connects to the worker.', histogram)
+
+        return '\n'.join(lines) + '\n'
+
+
+### upgrade ###
+class PumpkinUpgradeServer(threading.Thread):
+    '''
+        Hands the listening sockets of this PumpkinLB over to a new one (started with --upgrade), on the unix socket upgrade_socket.
+
+          Each socket is passed (SCM_RIGHTS) in its own packet, along with what it is for: ["listener", addr, port, listenerNum] or ["metrics", addr, port],
+          then b'done'. Once the new PumpkinLB answers b'ready' (its listeners are accepting), onHandoff is called to start draining this one,
+          and the unix socket is removed, for the new PumpkinLB to bind.
+    '''
+    def __init__(self, path, getSockets, onHandoff):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.getSockets = getSockets # Returns a list of (description, socket) to hand over
+        self.onHandoff = onHandoff
+        self.closed = False
+        try:
+            os.unlink(path) # Left behind by a PumpkinLB that did not exit cleanly
+        except OSError:
+            pass
+        self.listenSocket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listenSocket.bind(path)
+        self.listenSocket.listen(1)
+
+    def run(self):
+        while True:
+            try:
+                (upgradeSocket, _addr) = self.listenSocket.accept()
+            except:
+                return # Closed
+            try:
+                upgradeSocket.settimeout(UPGRADE_TIMEOUT)
+                if self.handOver(upgradeSocket) is True:
+                    self.close()
+                    self.onHandoff()
+                    return
+            except Exception as e:
+                logerr('Upgrade failed, still serving: %s\n' %(str(e),))
+            finally:
+                upgradeSocket.close()
+
+    def handOver(self, upgradeSocket):
+        '''
+            handOver - Send every listening socket to the new PumpkinLB
+
+              @return <bool> - True if it took them over
+        '''
+        sockets = self.getSockets()
+        for (description, sock) in sockets:
+            socket.send_fds(upgradeSocket, [json.dumps(description).encode('utf-8')], [sock.fileno()])
+        upgradeSocket.send(b'done')
+        logmsg('Handed %d listening socket(s) over to an upgrade, waiting for it to start accepting\n' %(len(sockets),))
+        return upgradeSocket.recv(16) == b'ready'
+
+    def close(self):
+        if self.closed is True:
+            return # The path may be the new PumpkinLB's by now
+        self.closed = True
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        try:
+            self.listenSocket.shutdown(socket.SHUT_RDWR) # Wakes up the accept in run()
+        except:
+            pass
+        try:
+            self.listenSocket.close()
+        except:
+            pass
+
+def receiveListenSockets(path):
+    '''
+        receiveListenSockets - Take over the listening sockets of the PumpkinLB serving upgrade_socket at path.
+
+          @return tuple( <socket>, <dict> ) - The connection to that PumpkinLB (to send b'ready' on once the listeners are up),
+                                              and (kind, addr, port, listenerNum) -> socket. listenerNum is 0 for "metrics".
+    '''
+    upgradeSocket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    upgradeSocket.settimeout(UPGRADE_TIMEOUT)
+    sockets = {}
+    try:
+        upgradeSocket.connect(path)
+        while True:
+            (data, fds, _flags, _addr) = socket.recv_fds(upgradeSocket, 4096, 1)
+            if not fds:
+                if data != b'done':
+                    raise ValueError('Unexpected message from %s: %s' %(path, repr(data)))
+                break
+            description = json.loads(data.decode('utf-8'))
+            key = (description[0], description[1], description[2], description[3] if len(description) > 3 else 0)
+            sockets[key] = socket.socket(fileno=fds[0])
+    except:
+        for sock in sockets.values():
+            sock.close()
+        upgradeSocket.close()
+        raise
+    return (upgradeSocket, sockets)
+
+
+### load balancer ###
+if __name__ == '__main__':
+    configFilename = None
+    upgradeRequested = False
+    for arg in sys.argv[1:]:
+        if arg == '--help':
+            printUsage(sys.stdout)
+            sys.exit(0)
+        elif arg == '--help-config':
+            printConfigHelp(sys.stdout)
+            sys.exit(0)
+        elif arg == '--version':
+            sys.stdout.write(getVersionStr() + '\n')
+            sys.exit(0)
+        elif arg == '--upgrade':
+            upgradeRequested = True
+        elif configFilename is not None:
+            sys.stderr.write('Too many arguments.\n\n')
+            printUsage(sys.stderr)
+            sys.exit(0)
+        else:
+            configFilename = arg
+
+    if not configFilename:
+        sys.stderr.write('No config file provided\n\n')
+        printUsage(sys.stderr)
+        sys.exit(1)
+
+    pumpkinConfig = PumpkinConfig(configFilename)
+    try:
+        pumpkinConfig.parse()
+    except PumpkinConfigException as configError:
+        sys.stderr.write(str(configError) + '\n\n\n')
+        printConfigHelp()
+        sys.exit(1)
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        printConfigHelp(sys.stderr)
+        sys.exit(1)
+
+    configureLog(pumpkinConfig.getOptions())
+
+    bufferSize = pumpkinConfig.getOptionValue('buffer_size')
+    logmsg('Configured buffer size = %d bytes\n' %(bufferSize,))
+    logmsg('Configured relay engine = %s\n' %(pumpkinConfig.getOptionValue('engine'),))
+
+    listenerProcesses = pumpkinConfig.getOptionValue('listener_processes')
+    logmsg('Configured listener processes per mapping = %d\n' %(listenerProcesses,))
+
+    metricsPort = pumpkinConfig.getOptionValue('metrics_port')
+    metricsAddr = pumpkinConfig.getOptionValue('metrics_addr')
+    listenBacklog = pumpkinConfig.getOptionValue('listen_backlog')
+
+    upgradeSocketPath = pumpkinConfig.getOptionValue('upgrade_socket')
+    upgradeConnection = None # To the PumpkinLB being upgraded, until our listeners are up
+    inheritedSockets = {}    # (kind, addr, port, listenerNum) -> listening socket taken over from that PumpkinLB
+    if upgradeRequested is True:
+        if not upgradeSocketPath:
+            sys.stderr.write('--upgrade requires [options] -> upgrade_socket\n\n')
+            printConfigHelp(sys.stderr)
+            sys.exit(1)
+        try:
+            (upgradeConnection, inheritedSockets) = receiveListenSockets(upgradeSocketPath)
+            logmsg('Took over %d listening socket(s) from the PumpkinLB on %s\n' %(len(inheritedSockets), upgradeSocketPath))
+        except Exception as e:
+            logerr('Could not take over from a PumpkinLB on %s (%s), starting up normally\n' %(upgradeSocketPath, str(e)))
+
+    listenSockets = {} # (addr, port, listenerNum) -> listening socket. Bound here rather than by the listener, to hand them over on upgrade.
+
+    def getListenSocket(mapping, listenerNum):
+        '''
+            getListenSocket - The socket a listener accepts on: the one its predecessor used, else a newly bound one.
+
+              @return <socket/None> - None if it could not be bound, the listener then keeps trying on its own
+        '''
+        key = (mapping.localAddr, mapping.localPort, listenerNum)
+        if key in listenSockets:
+            return listenSockets[key]
+        listenSocket = inheritedSockets.pop( ('listener',) + key, None )
+        if listenSocket is None:
+            try:
+                listenSocket = bindListenSocket(mapping.localAddr, mapping.localPort, listenerProcesses > 1, listenBacklog)
+            except Exception as e:
+                # Such as more listener_processes after an upgrade, over sockets bound without SO_REUSEPORT: share one of theirs
+                for (otherKey, otherSocket) in listenSockets.items():
+                    if otherKey[:2] == key[:2]:
+                        listenSocket = otherSocket
+                        break
+                else:
+                    return None
+        listenSockets[key] = listenSocket
+        return listenSocket
+
+    def closeListenSockets(mappingAddr):
+        for key in [key for key in listenSockets if key[:2] == mappingAddr]:
+            listenSockets.pop(key).close()
+
+    def startListener(mapping, listenerNum, metrics=None):
+        if metrics is None and metricsPort:
+            # Allocated here, so the main process can read what the listener process counts
+            metrics = PumpkinMetrics(mapping.workers)
+        listener = PumpkinListener(mapping.localAddr, mapping.localPort, mapping.workers, bufferSize, pumpkinConfig.getOptions(), listenerNum, metrics,
+            getListenSocket(mapping, listenerNum))
+        listener.start()
+        return listener
+
+    mappings = pumpkinConfig.getMappings()
+    listeners = []
+    for mappingAddr, mapping in mappings.items():
+        logmsg('Starting up %d listener(s) on %s:%d with mappings: %s\n' %(listenerProcesses, mapping.localAddr, mapping.localPort, str(mapping.workers)))
+        for listenerNum in range(listenerProcesses):
+            listeners.append(startListener(mapping, listenerNum))
+
+    metricsServer = None
+    if metricsPort:
+        try:
+            metricsServer = PumpkinMetricsServer(metricsAddr, metricsPort, lambda : listeners, inheritedSockets.pop( ('metrics', metricsAddr, metricsPort, 0), None ))
+            metricsServer.start()
+            logmsg('Serving metrics on http://%s:%d/metrics\n' %(metricsAddr, metricsPort))
+        except Exception as e:
+            logerr('Failed to start metrics listener on %s:%d: %s\n' %(metricsAddr, metricsPort, str(e)))
+
+    for inheritedSocket in inheritedSockets.values():
+        inheritedSocket.close() # Of mappings no longer configured, the old PumpkinLB drains them
+    if upgradeConnection is not None:
+        try:
+            upgradeConnection.send(b'ready')
+            upgradeConnection.recv(16) # Closed by the old PumpkinLB once it has removed upgrade_socket
+        except Exception as e:
+            logerr('Upgrade: %s\n' %(str(e),))
+        upgradeConnection.close()
+
+    def getHandoverSockets():
+        handoverSockets = [ (['listener'] + list(key), listenSocket) for (key, listenSocket) in list(listenSockets.items()) ]
+        if metricsServer is not None:
+            handoverSockets.append( (['metrics', metricsAddr, metricsPort], metricsServer.listenSocket) )
+        return handoverSockets
+
+    upgradeServer = None
+    if upgradeSocketPath:
+        try:
+            # Once the sockets are handed over, this PumpkinLB drains as on SIGQUIT
+            upgradeServer = PumpkinUpgradeServer(upgradeSocketPath, getHandoverSockets, lambda : os.kill(os.getpid(), signal.SIGQUIT))
+            upgradeServer.start()
+        except Exception as e:
+            logerr('Failed to listen for upgrades on %s: %s\n' %(upgradeSocketPath, str(e)))
+
+    globalIsTerminating = False
+    globalIsDraining = False
+    globalReloadRequested = False
+    retiredListeners = [] # Listeners of mappings removed by a reload, shutting down
+
+    def reloadConfig():
+        '''
+            reloadConfig - Re-read the config file, and diff its [mappings] against the running listeners
+        '''
+        newConfig = PumpkinConfig(configFilename)
+        try:
+            newConfig.parse()
+        except Exception as e:
+            logerr('Not reloading, could not parse %s: %s\n' %(configFilename, str(e)))
+            return
+        if newConfig.getOptions() != pumpkinConfig.getOptions():
+            logerr('WARNING: Changes to [options] are not applied until restart\n')
+
+        newMappings = dict([ ((mapping.localAddr, mapping.localPort), mapping) for mapping in newConfig.getMappings().values() ])
+        runningListeners = {}
+        for listener in listeners:
+            runningListeners.setdefault( (listener.localAddr, listener.localPort), []).append(listener)
+
+        for (mappingAddr, mappingListeners) in runningListeners.items():
+            mapping = newMappings.get(mappingAddr)
+            if mapping is None:
+                logmsg('Reload: stopping listener(s) on %s:%d\n' %mappingAddr)
+                for listener in mappingListeners:
+                    listeners.remove(listener)
+                    retiredListeners.append(listener)
+                    try:
+                        os.kill(listener.pid, signal.SIGTERM)
+                    except:
+                        pass
+                closeListenSockets(mappingAddr)
+            elif mapping.workers != mappingListeners[0].workers:
+                logmsg('Reload: workers of %s:%d are now %s\n' %(mappingAddr[0], mappingAddr[1], str(mapping.workers)))
+                for listener in mappingListeners:
+                    try:
+                        listener.sendWorkers(mapping.workers)
+                    except Exception as e:
+                        logerr('Reload: could not update listener %d: %s\n' %(listener.pid, str(e)))
+
+        for (mappingAddr, mapping) in newMappings.items():
+            if mappingAddr not in runningListeners:
+                logmsg('Reload: starting up %d listener(s) on %s:%d with mappings: %s\n' %(listenerProcesses, mapping.localAddr, mapping.localPort, str(mapping.workers)))
+                for listenerNum in range(listenerProcesses):
+                    listeners.append(startListener(mapping, listenerNum))
+
+    def handleSigHup(*args):
+        # Done from the main loop, not inside the signal handler
+        global globalReloadRequested
+        globalReloadRequested = True
+
+    def handleSigTerm(*args):
+        global listeners
+        global globalIsTerminating
+#        sys.stderr.write('CALLED\n')
+        if globalIsTerminating is True:
+            return # Already terminating
+        globalIsTerminating = True
+        logerr('Caught signal, shutting down listeners...\n')
+        for listener in listeners:
+            try:
+                os.kill(listener.pid, signal.SIGTERM)
+            except:
+                pass
+        logerr('Sent signal to children, waiting up to 4 seconds then trying to clean up\n')
+        time.sleep(1)
+        startTime = time.time()
+        remainingListeners = listeners
+        remainingListeners2 = []
+        for listener in remainingListeners:
+            logerr('Waiting on %d...\n' %(listener.pid,))
+            listener.join(.05)
+            if listener.is_alive() is True:
+                remainingListeners2.append(listener)
+        remainingListeners = remainingListeners2
+        logerr('Remaining (%d) listeners are: %s\n' %(len(remainingListeners), [listener.pid for listener in remainingListeners]))
+
+        afterJoinTime = time.time()
+
+        if remainingListeners:
+            delta = afterJoinTime - startTime
+            remainingSleep = int(GRACEFUL_SHUTDOWN_TIME - math.floor(afterJoinTime - startTime))
+            if remainingSleep > 0:
+                anyAlive = False
+                # If we still have time left, see if we are just done or if there are children to clean up using remaining time allotment
+                if threading.activeCount() > 1 or len(multiprocessing.active_children()) > 0:
+                    logerr('Listener closed in %1.2f seconds. Waiting up to %d seconds before terminating.\n' %(delta, remainingSleep))
+                    thisThread = threading.current_thread()
+                    for i in range(remainingSleep):
+                        allThreads = threading.enumerate()
+                        anyAlive = False
+                        for thread in allThreads:
+                            if thread is thisThread or thread.name == 'MainThread':
+                                continue
+                            thread.join(.05)
+                            if thread.is_alive() == True:
+                                anyAlive = True
+
+                        allChildren = multiprocessing.active_children()
+                        for child in allChildren:
+                            child.join(.05)
+                            if child.is_alive() == True:
+                                anyAlive = True
+                        if anyAlive is False:
+                            break
+                        time.sleep(1)
+
+                if anyAlive is True:
+                    logerr('Could not kill in time.\n')
+                else:
+                    logerr('Shutdown successful after %1.2f seconds.\n' %( time.time() - startTime))
+
+            else:
+                logerr('Listener timed out in closing, exiting uncleanly.\n')
+                time.sleep(.05) # Why not? :P
+
+        logmsg('exiting...\n')
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        sys.exit(0)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return 0
+    # END handleSigTerm
+
+    def handleSigUsr1(*args):
+        # Each listener probes its own workers
+        for listener in listeners:
+            try:
+                os.kill(listener.pid, signal.SIGUSR1)
+            except:
+                pass
+
+    def handleSigUsr2(*args):
+        # Each listener logs its own counters
+        for listener in listeners:
+            try:
+                os.kill(listener.pid, signal.SIGUSR2)
+            except:
+                pass
+
+    def handleSigQuit(*args):
+        global globalIsDraining
+        if globalIsDraining is True or globalIsTerminating is True:
+            return
+        globalIsDraining = True
+        logmsg('Draining: no more clients are accepted, exiting once the connections being relayed are done\n')
+        if upgradeServer is not None:
+            upgradeServer.close()
+        if metricsServer is not None:
+            metricsServer.stop()
+        for listener in listeners:
+            try:
+                os.kill(listener.pid, signal.SIGQUIT)
+            except:
+                pass
+        # Closed, never shut down: after an upgrade they are the new PumpkinLB's
+        for listenSocket in listenSockets.values():
+            listenSocket.close()
+
+    signal.signal(signal.SIGTERM, handleSigTerm)
+    signal.signal(signal.SIGINT, handleSigTerm)
+    signal.signal(signal.SIGQUIT, handleSigQuit)
+    signal.signal(signal.SIGUSR1, handleSigUsr1)
+    signal.signal(signal.SIGUSR2, handleSigUsr2)
+    signal.signal(signal.SIGHUP, handleSigHup)
+
+    while True:
+        try:
+            time.sleep(2)
+
+            if globalReloadRequested is True and globalIsTerminating is False and globalIsDraining is False:
+                globalReloadRequested = False
+                logmsg('Caught SIGHUP, reloading %s\n' %(configFilename,))
+                reloadConfig()
+            for listener in retiredListeners[:]:
+                listener.join(0)
+                if listener.is_alive() is False:
+                    retiredListeners.remove(listener)
+
+            if globalIsDraining is True:
+                if not [listener for listener in listeners + retiredListeners if listener.is_alive() is True]:
+                    break
+                continue
+
+            # Supervise the listeners: one that died on its own (not through handleSigTerm) is replaced,
+            #  so a crashed shard doesn't silently take its share of the cores with it.
+            for i in range(len(listeners)):
+                listener = listeners[i]
+                if globalIsTerminating is True or listener.is_alive() is True:
+                    continue
+                logerr('Listener %d on %s:%d exited unexpectedly (code %s), restarting\n' %(listener.pid, listener.localAddr, listener.localPort, str(listener.exitcode)))
+                listener.join(0)
+                mapping = PumpkinMapping(listener.localAddr, listener.localPort, listener.workers)
+                listeners[i] = startListener(mapping, listener.listenerNum, listener.metrics)
+        except:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    logmsg('Drained, exiting...\n')
+    sys.exit(0)
@@ -52,7 +52,8 @@ done
 }
 
 function start_recon {
-screen -dmS recon ${LBSSH_DIR}/bin/recon.sh -l
+# bin/supervisor.py probes every tunnel concurrently and restarts dead ones with backoff, recon -l is the old polling loop
+screen -dmS recon python3 -u ${LBSSH_DIR}/bin/supervisor.py -d ${LBSSH_DIR}
 }
 
 function stop_recon {
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+# Tunnel supervisor, in place of the recon.sh polling loop
+#
+# config.json and the cfgN.json files it points to are loaded once (and
+# again on SIGUSR1, which cfg.sh sends after adding or deleting a config;
+# not SIGHUP, which screen sends when recon.sh -s kills its session).
+# Every SOCKS port is then probed concurrently every few seconds with a
+# SOCKS5 CONNECT and an HTTP request through it. Dead ssh.sh / http.py
+# instances are restarted in parallel, with exponential backoff, and the
+# load balancer is sent SIGUSR1 whenever a tunnel goes up or down, so it
+# re-probes its workers right away instead of at its next health_interval.
+#
+#   python3 -u bin/supervisor.py [-d /root/lbssh]
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import struct
+import sys
+import time
+
+LBSSH_DIR = '/root/lbssh'
+
+SOCKS5_GREETING = b'\x05\x01\x00'
+SOCKS5_NO_AUTH = b'\x05\x00'
+
+# ssh-loop.sh output in the tunnel's screenlog once the account is refused
+AUTH_FAILED = b'Permission denied'
+
+
+def log(msg):
+    print('[ %s ] %s' % (time.ctime(), msg), flush=True)
+
+
+# one SSH_N entry of config.json, with the state of its processes
+class Tunnel:
+    def __init__(self, name, lbssh_dir, config_file, socks_ip, socks_port, http_port):
+        self.name = name
+        self.config_file = config_file
+        self.socks_ip = socks_ip
+        self.socks_port = socks_port
+        self.http_port = http_port  # injector (http.py) port, None if the cfg has none
+        # ssh.sh keeps the screenlog under $LBSSH_DIR/log/<config file name>, wherever the cfg file is
+        cf = os.path.splitext(os.path.basename(config_file))[0]
+        self.screenlog = os.path.join(lbssh_dir, 'log', cf, 'screenlog.0')
+        self.config_mtime = mtime(config_file)
+        self.up = None  # unknown until the first probe
+        self.failures = 0  # consecutive failed probes
+        self.backoff = 0  # seconds to wait before the next restart, doubles while restarts don't help
+        self.next_restart = 0
+        self.restarting = False
+        self.auth_failed = False  # left stopped until its cfg file changes
+
+    def same_as(self, other):
+        return (self.config_file, self.socks_ip, self.socks_port, self.http_port, self.config_mtime) == \
+            (other.config_file, other.socks_ip, other.socks_port, other.http_port, other.config_mtime)
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class Supervisor:
+    def __init__(self, args):
+        self.dir = args.dir
+        self.config = os.path.join(self.dir, 'config', 'config.json')
+        self.interval = args.interval
+        self.timeout = args.timeout
+        self.fall = args.fall
+        self.min_backoff = args.min_backoff
+        self.max_backoff = args.max_backoff
+        self.probe_host = args.probe_host.encode('idna')
+        self.probe_port = args.probe_port
+        self.tunnels = {}
+        self.legacy = True  # tun2socks (badvpn) rather than redsocks
+        self.reload_requested = True
+
+    def load(self):
+        try:
+            with open(self.config) as f:
+                config = json.load(f)
+        except Exception as e:
+            log('Could not load %s: %s, keeping %d tunnel(s)' % (self.config, e, len(self.tunnels)))
+            return
+
+        self.legacy = config.get('load_balance', {}).get('tun2socks', {}).get('legacy', True)
+        tunnels = {}
+        for name in sorted(config):
+            if not name.startswith('SSH'):
+                continue
+            try:
+                entry = config[name]
+                config_file = entry['config']
+                with open(config_file) as f:
+                    cfg = json.load(f)
+                http_port = cfg.get('http', {}).get('port')
+                tunnel = Tunnel(name, self.dir, config_file, entry['socks']['ip'], int(entry['socks']['port']),
+                                http_port and int(http_port))
+            except Exception as e:
+                log('%s: skipped, bad config: %s' % (name, e))
+                continue
+            current = self.tunnels.get(name)
+            if current is not None and current.same_as(tunnel):
+                tunnel = current
+            tunnels[name] = tunnel
+        added = [name for name in tunnels if self.tunnels.get(name) is not tunnels[name]]
+        removed = [name for name in self.tunnels if name not in tunnels]
+        self.tunnels = tunnels
+        log('Loaded %d tunnel(s) from %s (new/changed: %s, removed: %s)'
+            % (len(tunnels), self.config, ', '.join(added) or '-', ', '.join(removed) or '-'))
+
+    async def probe_socks(self, tunnel):
+        # SOCKS5 CONNECT to probe_host, then an HTTP request through it: the whole path, like recon.sh's curl
+        reader, writer = await asyncio.open_connection(tunnel.socks_ip, tunnel.socks_port)
+        try:
+            writer.write(SOCKS5_GREETING)
+            if await reader.readexactly(2) != SOCKS5_NO_AUTH:
+                raise ConnectionError('unexpected SOCKS5 greeting reply')
+            writer.write(b'\x05\x01\x00\x03' + bytes([len(self.probe_host)]) + self.probe_host
+                         + struct.pack('>H', self.probe_port))
+            reply = await reader.readexactly(4)
+            if reply[1] != 0:
+                raise ConnectionError('SOCKS5 CONNECT refused (%d)' % reply[1])
+            bound = {1: 4, 4: 16}.get(reply[3])
+            if bound is None:
+                bound = (await reader.readexactly(1))[0]
+            await reader.readexactly(bound + 2)
+            writer.write(b'HEAD / HTTP/1.1\r\nHost: ' + self.probe_host + b'\r\nConnection: close\r\n\r\n')
+            if not (await reader.read(5)).startswith(b'HTTP/'):
+                raise ConnectionError('no HTTP response from %s' % self.probe_host.decode())
+        finally:
+            writer.close()
+
+    async def probe_port(self, port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.close()
+
+    async def probe(self, probe, *args):
+        try:
+            await asyncio.wait_for(probe(*args), self.timeout)
+            return None
+        except asyncio.TimeoutError:
+            return 'timed out after %gs' % self.timeout
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+    async def check(self, tunnel):
+        if tunnel.auth_failed and mtime(tunnel.config_file) != tunnel.config_mtime:
+            log('%s: %s changed, supervising it again' % (tunnel.name, tunnel.config_file))
+            tunnel.auth_failed = False
+            tunnel.config_mtime = mtime(tunnel.config_file)
+            tunnel.next_restart = 0
+        if tunnel.restarting or tunnel.auth_failed:
+            return
+        err = await self.probe(self.probe_socks, tunnel)
+        if err is None:
+            tunnel.failures = 0
+            tunnel.backoff = 0
+            if tunnel.up is not True:
+                log('%s: SOCKS port %d is up' % (tunnel.name, tunnel.socks_port))
+                tunnel.up = True
+                self.notify_lb()
+            return
+
+        tunnel.failures += 1
+        if tunnel.up is not False and tunnel.failures >= self.fall:
+            log('%s: SOCKS port %d is down: %s' % (tunnel.name, tunnel.socks_port, err))
+            tunnel.up = False
+            self.notify_lb()
+        if tunnel.up is False and time.monotonic() >= tunnel.next_restart:
+            tunnel.restarting = True
+            asyncio.ensure_future(self.restart(tunnel))
+
+    async def restart(self, tunnel):
+        try:
+            script = os.path.join(self.dir, 'bin', 'ssh.sh')
+            if self.auth_refused(tunnel):
+                log('%s: username/password refused or expired, stopping it until %s changes'
+                    % (tunnel.name, tunnel.config_file))
+                tunnel.auth_failed = True
+                await self.run(script, '-s', '-c', tunnel.config_file)
+                return
+
+            if tunnel.http_port and await self.probe(self.probe_port, tunnel.http_port) is not None:
+                # ssh goes through the injector, which is (re)started along with it
+                log('%s: injector on port %d is not answering' % (tunnel.name, tunnel.http_port))
+            log('%s: restarting' % tunnel.name)
+            await self.run(script, '-s', '-c', tunnel.config_file)
+            await asyncio.sleep(2)
+            await self.run(script, '-r', '-c', tunnel.config_file, str(tunnel.socks_port))
+            tunnel.failures = 0
+            tunnel.backoff = min(max(tunnel.backoff * 2, self.min_backoff), self.max_backoff)
+            tunnel.next_restart = time.monotonic() + tunnel.backoff
+        except Exception as e:
+            log('%s: restart failed: %s' % (tunnel.name, e))
+        finally:
+            tunnel.restarting = False
+
+    def auth_refused(self, tunnel):
+        try:
+            with open(tunnel.screenlog, 'rb') as f:
+                return AUTH_FAILED in f.read()
+        except OSError:
+            return False
+
+    async def run(self, *argv):
+        proc = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.DEVNULL,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        return await proc.wait()
+
+    async def output(self, *argv):
+        proc = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.DEVNULL)
+        out, _err = await proc.communicate()
+        return out.decode('utf-8', 'replace')
+
+    def lb_pids(self):
+        # main load balancer processes: listeners and their workers are forked from it, with the same command line
+        parents = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/%s/cmdline' % pid, 'rb') as f:
+                    argv = f.read().split(b'\0')
+                with open('/proc/%s/stat' % pid, 'rb') as f:
+                    ppid = int(f.read().rsplit(b')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            if len(argv) > 1 and argv[0].endswith(b'python3') and b'loadbalancer.py' in b' '.join(argv[1:3]):
+                parents[int(pid)] = ppid
+        return [pid for pid, ppid in parents.items() if ppid not in parents]
+
+    def notify_lb(self):
+        # the main process passes it on to its listeners
+        for pid in self.lb_pids():
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except OSError:
+                pass
+
+    async def check_services(self):
+        # load balancer and tun2socks/redsocks, as recon.sh did after each round
+        if not self.lb_pids():
+            log('Load balancer is not running, starting it')
+            await self.run('screen', '-dmS', 'load-balance', 'python3', '-u',
+                           os.path.join(self.dir, 'bin', 'loadbalancer.py'),
+                           os.path.join(self.dir, 'config', 'config.cfg'))
+        screen = self.legacy and 'badvpn-tun2socks' or 'redsocks'
+        if screen not in await self.output('screen', '-list'):
+            log('%s is not running, restarting it' % screen)
+            script = os.path.join(self.dir, 'bin', 'tun2socks.sh')
+            await self.run(script, '-s')
+            await asyncio.sleep(1)
+            await self.run(script, '-r')
+
+    def request_reload(self):
+        self.reload_requested = True
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, self.request_reload)
+        while True:
+            started = time.monotonic()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.load()
+            checks = [self.check(tunnel) for tunnel in self.tunnels.values()]
+            checks.append(self.check_services())
+            for result in await asyncio.gather(*checks, return_exceptions=True):
+                if isinstance(result, Exception):
+                    log('Check failed: %s' % result)
+            await asyncio.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe the SSH tunnels and restart the dead ones')
+    parser.add_argument('-d', '--dir', default=LBSSH_DIR, help='lbssh directory (default: %(default)s)')
+    parser.add_argument('-i', '--interval', type=float, default=5,
+                        help='seconds between probe rounds (default: %(default)s)')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='seconds a probe may take (default: %(default)s)')
+    parser.add_argument('--fall', type=int, default=2,
+                        help='consecutive failed probes before a tunnel is restarted (default: %(default)s)')
+    parser.add_argument('--min-backoff', type=float, default=5,
+                        help='seconds after a restart before the next one (default: %(default)s)')
+    parser.add_argument('--max-backoff', type=float, default=300,
+                        help='cap of the doubling backoff between restarts (default: %(default)s)')
+    parser.add_argument('--probe-host', default='bing.com',
+                        help='host connected to through each tunnel (default: %(default)s)')
+    parser.add_argument('--probe-port', type=int, default=80, help='(default: %(default)s)')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(Supervisor(args).main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
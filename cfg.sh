@@ -9,6 +9,20 @@ ssh_count=$(jq 'keys | length' "${CONFIG}")
 count=$(($ssh_count - 1))
 cfg_save="${LBSSH_DIR}/config/cfg${ssh_count}.json"
 
+function reload_lb {
+# apply the new mappings to the running load balancer (SIGHUP), without dropping its connections
+# during an upgrade (lb.sh -u) the old one is still draining in its own screen, so take the newest
+SCREEN_PIDS=$(screen -list | grep load-balance | awk -F '[.]' {'print $1'} | tr -d ' \t' | paste -sd, -)
+[ -n "$SCREEN_PIDS" ] && LB_PID=$(pgrep -n -P ${SCREEN_PIDS} -f loadbalancer.py)
+[ -n "$LB_PID" ] && kill -HUP $LB_PID
+}
+
+function reload_supervisor {
+# let bin/supervisor.py pick up the changed config.json (SIGUSR1)
+SUP_PID=$(pgrep -o -f "^python3 -u ${LBSSH_DIR}/bin/supervisor.py")
+[ -n "$SUP_PID" ] && kill -USR1 $SUP_PID
+}
+
 function add_cfg {
 # Menambahkan entri baru untuk SSH_X (gantilah X dengan angka yang diinginkan)
 ssh_entry="SSH_$ssh_count"
@@ -35,6 +49,7 @@ echo '{
     "password": "'$ssh_password'",
     "http": {
         "buffer": 32768,
+        "split_delay": 0.5,
         "ip": "127.0.0.1",
         "port": 987'$count',
         "info": "HTTP Proxy",
@@ -57,7 +72,9 @@ done
 
 CFG_LB=$(echo ${CFG_ARR[@]} | tr ' ' ',')
 sed -i "s|5555=.*|5555=${CFG_LB}|g" ${LBSSH_DIR}/config/config.cfg
+reload_lb
 
+reload_supervisor
 echo "Entri $ssh_entry telah ditambahkan ke dalam file ${CONFIG}."
 }
 
@@ -74,7 +91,9 @@ SOCKS_IP="$(cat ${CONFIG} | jq .SSH_$dssh.socks.ip | awk '{print $1}' | sed 's/:
 SOCKS_PORT="$(cat ${CONFIG} | jq .SSH_$dssh.socks.port | awk '{print $1}' | sed 's/://g; s/"//g')"
 SOCKS="${SOCKS_IP}:${SOCKS_PORT}"
 sed -i "s|,${SOCKS}||g" ${LBSSH_DIR}/config/config.cfg
+reload_lb
 jq 'del(.SSH_'$dssh')' ${CONFIG} > temp.json && mv temp.json "${CONFIG}"
+reload_supervisor
 echo "Entri SSH_$dssh telah dihapus dari file ${CONFIG}."
 }
 
@@ -51,19 +51,38 @@ ${LBSSH_DIR}/bin/dns.sh -r
 function stop_lb {
 ${LBSSH_DIR}/bin/dns.sh -s
 ${LBSSH_DIR}/bin/tun2socks.sh -s
-kill $(screen -list | grep load-balance | awk -F '[.]' {'print $1'})
+# stopped first, so it does not start the load balancer again meanwhile
 ${LBSSH_DIR}/bin/recon.sh -s
+for SCREEN_PID in $(screen -list | grep load-balance | awk -F '[.]' {'print $1'}); do
+  # SIGTERM the load balancer and wait for it: the SIGHUP screen sends its window on kill only makes it reload
+  LB_PID=$(pgrep -P ${SCREEN_PID} -f loadbalancer.py)
+  if [ -n "${LB_PID}" ]; then
+    kill ${LB_PID}
+    for i in $(seq 20); do
+      kill -0 ${LB_PID} 2>/dev/null || break
+      sleep 0.5
+    done
+  fi
+  kill ${SCREEN_PID}
+done
 for CFG in ${CONFIG_LB}; do
   CFG_FILE="$(cat ${CONFIG} | jq .$CFG.config | awk '{print $1}' | sed 's/://g; s/"//g')"
   ${LBSSH_DIR}/bin/ssh.sh -s -c ${CFG_FILE}
 done
 }
 
+function upgrade_lb {
+# start a new load balancer on the listening sockets of the running one (needs upgrade_socket set in config.cfg),
+# which stops accepting and exits once its connections are done
+screen -dmS load-balance python3 -u ${LBSSH_DIR}/bin/loadbalancer.py --upgrade ${LBSSH_DIR}/config/config.cfg
+}
+
 function usage() {
   cat <<EOF
 Usage:
   -r  Run service
   -s  Stop service
+  -u  Restart load balancer without dropping connections
 EOF
 }
 
@@ -74,6 +93,9 @@ case $1 in
   -s)
   stop_lb
   ;;
+  -u)
+  upgrade_lb
+  ;;
   *)
   usage
   ;;
@@ -0,0 +1,146 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HTTP_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'http.py')
+
+ESTABLISHED = b'HTTP/1.1 200 Connection established\r\n\r\n'
+BODY_SIZE = 8 * 1024 * 1024
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def read_head(sock):
+    # returns the head, and what was read past it
+    head = b''
+    while b'\r\n\r\n' not in head:
+        data = sock.recv(4096)
+        if not data:
+            return head, b''
+        head += data
+    end = head.find(b'\r\n\r\n') + 4
+    return head[:end], head[end:]
+
+
+def read_all(sock, chunk=65536, delay=0):
+    received = bytearray()
+    while True:
+        data = sock.recv(chunk)
+        if not data:
+            return bytes(received)
+        received += data
+        if delay:
+            time.sleep(delay)
+
+
+# remote proxy: answers the CONNECT, then runs handler on the connection
+class FakeProxy:
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.port = self.server.getsockname()[1]
+        self.result = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        conn, _addr = self.server.accept()
+        read_head(conn)
+        conn.sendall(b'HTTP/1.1 200 OK\r\n\r\n')
+        self.result = self.handler(conn)
+        conn.close()
+
+    def close(self):
+        self.server.close()
+
+
+class HalfCloseTest(unittest.TestCase):
+
+    def start_injector(self, proxy_port, **options):
+        config = {'http': {'buffer': 32768, 'ip': '127.0.0.1', 'port': 0, 'info': 'test',
+                           'payload': 'CONNECT [host_port] HTTP/1.1[crlf][crlf]',
+                           'proxy': {'ip': '127.0.0.1', 'port': proxy_port}}}
+        config['http'].update(options)
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump(config, config_file)
+        config_file.close()
+        self.addCleanup(os.unlink, config_file.name)
+
+        port = free_port()
+        process = subprocess.Popen([sys.executable, HTTP_PY, config_file.name, '-l', str(port)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        deadline = time.time() + 10
+        while True:
+            try:
+                return socket.create_connection(('127.0.0.1', port))
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(.1)
+
+    def connect(self, client):
+        client.sendall(b'CONNECT example.com:22 HTTP/1.1\r\n\r\n')
+        head, rest = read_head(client)
+        self.assertEqual(head, ESTABLISHED)
+        return rest
+
+    def test_remote_eof_delivers_pending_to_slow_reader(self):
+        body = os.urandom(BODY_SIZE)
+
+        def send_and_close(conn):
+            conn.sendall(body)
+        proxy = FakeProxy(send_and_close)
+        self.addCleanup(proxy.close)
+
+        # room for all of it, so the proxy's EOF is read while most is still queued
+        client = self.start_injector(proxy.port, max_pending=2 * BODY_SIZE)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        self.addCleanup(client.close)
+        received = self.connect(client)
+        client.settimeout(30)
+        # slow reader: stalls while the proxy sends everything and closes
+        time.sleep(1)
+        received += read_all(client, 16384, .001)
+        self.assertEqual(len(received), len(body))
+        self.assertEqual(received, body)
+
+    def test_client_eof_is_passed_on(self):
+        def echo_until_eof(conn):
+            received = read_all(conn)
+            conn.sendall(received)
+            return received
+        proxy = FakeProxy(echo_until_eof)
+        self.addCleanup(proxy.close)
+
+        client = self.start_injector(proxy.port)
+        self.addCleanup(client.close)
+        self.connect(client)
+        client.settimeout(30)
+        body = os.urandom(1024 * 1024)
+        client.sendall(body)
+        client.shutdown(socket.SHUT_WR)
+        # the reply comes back after the client's EOF reached the proxy
+        self.assertEqual(read_all(client), body)
+        proxy.thread.join(10)
+        self.assertEqual(proxy.result, body)
+
+
+if __name__ == '__main__':
+    unittest.main()